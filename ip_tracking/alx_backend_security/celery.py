@@ -19,10 +19,38 @@ app.conf.beat_schedule = {
         "task": "ip_tracking.tasks.detect_anomalies",
         "schedule": crontab(minute=0),  # Run every hour at minute 0
     },
+    "detect-anomalies-incremental-every-minute": {
+        "task": "ip_tracking.tasks.detect_anomalies_incremental",
+        "schedule": 60.0,  # No-op unless IP_TRACKING_INCREMENTAL_DETECTION is set
+    },
+    "detect-statistical-anomalies-hourly": {
+        "task": "ip_tracking.tasks.detect_statistical_anomalies",
+        "schedule": crontab(minute=5),  # Once the previous hour's logs are in
+    },
+    "detect-path-scanners-every-minute": {
+        "task": "ip_tracking.tasks.detect_path_scanners",
+        "schedule": 60.0,  # No-op unless distinct-path counting is enabled
+    },
+    "detect-subnet-anomalies-hourly": {
+        "task": "ip_tracking.tasks.detect_subnet_anomalies",
+        "schedule": crontab(minute=0),  # No-op unless subnet detection is enabled
+    },
     "cleanup-old-logs-daily": {
         "task": "ip_tracking.tasks.cleanup_old_logs",
         "schedule": crontab(hour=3, minute=0),  # Run daily at 3 AM
     },
+    "enrich-request-log-geolocation-every-minute": {
+        "task": "ip_tracking.tasks.enrich_request_log_geolocation",
+        "schedule": crontab(),  # Run every minute
+    },
+    "consume-request-log-stream-every-10-seconds": {
+        "task": "ip_tracking.tasks.consume_request_log_stream",
+        "schedule": 10.0,  # No-op unless the stream has entries
+    },
+    "flush-request-rollups-every-minute": {
+        "task": "ip_tracking.tasks.flush_request_rollups",
+        "schedule": crontab(),  # Run every minute
+    },
     "auto-block-suspicious-ips-every-6-hours": {
         "task": "ip_tracking.tasks.auto_block_suspicious_ips",
         "schedule": crontab(minute=0, hour="*/6"),  # Run every 6 hours
@@ -48,7 +48,8 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
-    "ip_tracking.middleware.IPTrackingMiddleware",
+    # Sync- and async-capable; runs natively on the event loop under ASGI
+    "ip_tracking.middleware.AsyncIPTrackingMiddleware",
 ]
 
 ROOT_URLCONF = "alx_backend_security.urls"
@@ -171,3 +172,127 @@ CELERY_ACCEPT_CONTENT = ["json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = "UTC"
+
+# IP tracking configuration
+# Where request logs go, one of ip_tracking.sinks:
+#   ORMSink          save each row on the request path
+#   BufferedORMSink  queue rows in memory and write them with bulk_create
+#   RedisStreamSink  append rows to a Redis Stream; the consume_request_logs
+#                    command or consume_request_log_stream task stores them
+#   FileSink         append rows as JSON lines to IP_TRACKING_LOG_FILE
+#   NullSink         discard rows
+IP_TRACKING_LOG_SINK = "ip_tracking.sinks.ORMSink"
+IP_TRACKING_LOG_BUFFER_BATCH_SIZE = 500  # Flush once this many logs are queued
+IP_TRACKING_LOG_BUFFER_MAX_AGE = 2.0  # Flush logs older than this (seconds)
+IP_TRACKING_LOG_BUFFER_MAX_PENDING = 10000  # Drop new logs beyond this
+IP_TRACKING_LOG_STREAM_MAXLEN = 1000000  # Approximate cap on stream length
+IP_TRACKING_LOG_STREAM_BATCH_SIZE = 1000  # Entries per bulk_create
+IP_TRACKING_LOG_FILE = BASE_DIR / "request_logs.jsonl"
+# Redis server for streams and counters (defaults to the cache's)
+IP_TRACKING_REDIS_URL = None
+
+# Fetch each request's blocklist flag and geolocation entry from the cache
+# in one round trip, and write misses back in one
+IP_TRACKING_REQUEST_LOOKUP = False
+
+# Count requests per IP and minute (and per tracked path prefix) in Redis;
+# flush_request_rollups stores closed minutes in RequestRollup/PathRollup,
+# which detect_anomalies, the dashboard and the admin then read
+IP_TRACKING_ROLLUPS_ENABLED = False
+IP_TRACKING_ROLLUP_PATH_PREFIXES = ["/admin", "/login", "/register", "/api"]
+IP_TRACKING_ROLLUP_EXACT_PATHS = ["/login"]
+
+# Anomaly rules evaluated by detect_anomalies and the realtime detector, in
+# order. Each rule flags IPs with more than "threshold" requests within
+# "window" seconds (default 3600), optionally only to an exact "path" or
+# below a "path_prefix". "action" is "flag" or "block"; "reason" is a format
+# string with {count}; "dedupe_reason" limits the 24 hour dedupe to earlier
+# flags whose reason contains it. None uses ip_tracking.rules.DEFAULT_ANOMALY_RULES:
+# more than 100 requests, 20 per sensitive prefix or 10 logins per hour.
+# Example: {"name": "api_burst", "path_prefix": "/api", "window": 60,
+#           "threshold": 300, "action": "block"}
+IP_TRACKING_ANOMALY_RULES = None
+
+# Detect anomalies every minute from the request logs saved since the last
+# run, kept as per-rule minute counters, instead of re-reading the last hour
+IP_TRACKING_INCREMENTAL_DETECTION = False
+IP_TRACKING_INCREMENTAL_DETECTION_BATCH_SIZE = 100000  # Logs read per run
+# Seconds a run waits for request log ids skipped by a previous run to commit
+IP_TRACKING_INCREMENTAL_DETECTION_GAP_TIMEOUT = 600
+
+# Split the hourly detect_anomalies run into this many IP range shards that
+# Celery workers process in parallel (a chord; needs CELERY_RESULT_BACKEND)
+IP_TRACKING_DETECTION_SHARDS = 1
+
+# Flag statistical outliers (requires numpy): hours far above an IP's own
+# EWMA baseline of the previous 24 hours, and IPs whose 25 hour total to a
+# rule's path is far above all other IPs
+IP_TRACKING_BASELINE_ENABLED = False
+IP_TRACKING_BASELINE_EWMA_ALPHA = 0.3
+IP_TRACKING_BASELINE_SPIKE_THRESHOLD = 4.0  # z-score against the IP's baseline
+IP_TRACKING_BASELINE_PERSISTENCE_THRESHOLD = 6.0  # Robust z-score against all IPs
+IP_TRACKING_BASELINE_MIN_COUNT = 20  # Never flag IPs with fewer requests
+
+# Flag subnets (/24 for IPv4, /64 for IPv6 by default) whose IPs together
+# made more than the threshold of requests within the last hour, catching
+# scrapers that rotate through a range; with SUBNET_AUTO_BLOCK set,
+# auto_block_suspicious_ips blocks flagged subnets as BlockedNetwork ranges
+IP_TRACKING_SUBNET_DETECTION = False
+IP_TRACKING_SUBNET_IPV4_PREFIX = 24
+IP_TRACKING_SUBNET_IPV6_PREFIX = 64
+IP_TRACKING_SUBNET_THRESHOLD = 500  # Requests per hour from one subnet
+IP_TRACKING_SUBNET_MIN_IPS = 5  # Active IPs a subnet needs to be flagged
+IP_TRACKING_SUBNET_MAX_ROWS = 100000  # IPv6 IPs masked per run, busiest first
+IP_TRACKING_SUBNET_AUTO_BLOCK = False
+
+# Flag IPs within seconds of crossing an anomaly rule threshold, using
+# per-IP sliding-window counters in Redis updated by the middleware
+IP_TRACKING_REALTIME_DETECTION = False
+IP_TRACKING_REALTIME_AUTO_BLOCK = False  # Also block flagged IPs right away
+
+# Count distinct paths per IP in Redis HyperLogLogs (at most 12KB per IP and
+# window) and flag IPs above the threshold every minute, catching
+# vulnerability scanners that request many paths at a low rate
+IP_TRACKING_DISTINCT_PATHS_ENABLED = False
+IP_TRACKING_DISTINCT_PATHS_WINDOW = 3600  # Seconds
+IP_TRACKING_DISTINCT_PATHS_THRESHOLD = 200  # Distinct paths per window
+
+# Approximate per-IP request counts: each worker keeps a Count-Min Sketch and
+# top-K and merges them into Redis; shown as top talkers and used by
+# detect_anomalies to only aggregate IPs that may exceed a threshold
+IP_TRACKING_HEAVY_HITTERS_ENABLED = False
+IP_TRACKING_HEAVY_HITTERS_PREFILTER = False  # May miss IPs outside the top-K
+IP_TRACKING_HEAVY_HITTERS_TOP_K = 100
+IP_TRACKING_HEAVY_HITTERS_WIDTH = 2048
+IP_TRACKING_HEAVY_HITTERS_DEPTH = 4
+IP_TRACKING_HEAVY_HITTERS_WINDOW = 3600  # Seconds
+IP_TRACKING_HEAVY_HITTERS_MERGE_INTERVAL = 5.0  # Seconds
+
+# Log requests without country/city and let the
+# enrich_request_log_geolocation Celery task fill them in
+IP_TRACKING_DEFER_GEOLOCATION = False
+
+# Geolocation backends, tried in order until one knows the address. To
+# resolve offline, set IP_TRACKING_GEOLOCATION_DATABASE and put
+# "ip_tracking.geolocation.LocalDatabaseBackend" first (keep HTTPBackend as
+# a fallback or remove it)
+IP_TRACKING_GEOLOCATION_BACKENDS = [
+    "ip_tracking.geolocation.HTTPBackend",
+]
+# MaxMind .mmdb file or CSV of start_ip,end_ip,country,city ranges
+IP_TRACKING_GEOLOCATION_DATABASE = None
+# Cluster-wide requests per minute to the geolocation API (batch endpoint limit)
+IP_TRACKING_GEOLOCATION_RATE_LIMIT = 15
+
+# Check blocks against an in-process snapshot of all active BlockedIP entries.
+# Each worker checks the global blocklist version at most this often (ms)
+IP_TRACKING_BLOCKLIST_SNAPSHOT = False
+IP_TRACKING_BLOCKLIST_CHECK_INTERVAL = 1000
+# Keep a Bloom filter of blocked IPs instead of a full set; filter hits are
+# confirmed against the per-IP cache/database
+IP_TRACKING_BLOCKLIST_BLOOM = False
+IP_TRACKING_BLOCKLIST_BLOOM_FP_RATE = 0.001
+# Share the blocklist between all workers through a memory-mapped file
+# instead of per-process snapshots (None to disable). Write it on deploy
+# with manage.py publish_blocklist; block changes rewrite it afterwards
+IP_TRACKING_BLOCKLIST_FILE = None
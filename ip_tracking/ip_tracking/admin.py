@@ -1,6 +1,20 @@
+from datetime import timedelta
 from django.utils import timezone
 from django.contrib import admin
-from .models import RequestLog, BlockedIP, SuspiciousIP
+from django.db import transaction
+from django.db.models import OuterRef, Subquery, Sum
+from .models import (
+    RequestLog,
+    BlockedIP,
+    BlockedNetwork,
+    SuspiciousIP,
+    RequestRollup,
+    PathRollup,
+    DetectionState,
+    DetectionCounter,
+)
+from .blocklist import publish_blocklist
+from .rollups import bucket_start, get_bucket, use_rollups
 
 
 # pylint: disable=no-member
@@ -48,6 +62,7 @@ class BlockedIPAdmin(admin.ModelAdmin):
     def activate_blocks(self, request, queryset):
         """Activate selected IP blocks"""
         count = queryset.update(is_active=True)
+        publish_blocklist()
         self.message_user(request, f"{count} IP block(s) activated.")
 
     activate_blocks.short_description = "Activate selected IP blocks"
@@ -55,28 +70,82 @@ class BlockedIPAdmin(admin.ModelAdmin):
     def deactivate_blocks(self, request, queryset):
         """Deactivate selected IP blocks"""
         count = queryset.update(is_active=False)
+        publish_blocklist()
         self.message_user(request, f"{count} IP block(s) deactivated.")
 
     deactivate_blocks.short_description = "Deactivate selected IP blocks"
 
 
+@admin.register(BlockedNetwork)
+class BlockedNetworkAdmin(admin.ModelAdmin):
+    """Blocked networks admin view"""
+
+    list_display = ("network", "is_active", "created_at", "reason_preview")
+    list_filter = ("is_active", "created_at")
+    search_fields = ("network", "reason")
+    readonly_fields = ("created_at",)
+    date_hierarchy = "created_at"
+
+    fieldsets = (
+        ("Network Information", {"fields": ("network", "is_active")}),
+        ("Details", {"fields": ("reason", "created_at")}),
+    )
+
+    def reason_preview(self, obj):
+        """Show a preview of the reason"""
+        if obj.reason:
+            return obj.reason[:50] + "..." if len(obj.reason) > 50 else obj.reason
+        return "No reason provided"
+
+    reason_preview.short_description = "Reason"
+
+    actions = ["activate_blocks", "deactivate_blocks"]
+
+    def activate_blocks(self, request, queryset):
+        """Activate selected network blocks"""
+        count = queryset.update(is_active=True)
+        publish_blocklist()
+        self.message_user(request, f"{count} network block(s) activated.")
+
+    activate_blocks.short_description = "Activate selected network blocks"
+
+    def deactivate_blocks(self, request, queryset):
+        """Deactivate selected network blocks"""
+        count = queryset.update(is_active=False)
+        publish_blocklist()
+        self.message_user(request, f"{count} network block(s) deactivated.")
+
+    deactivate_blocks.short_description = "Deactivate selected network blocks"
+
+
 @admin.register(SuspiciousIP)
 class SuspiciousIPAdmin(admin.ModelAdmin):
     """Suspicious IP admin view"""
     list_display = (
         "ip_address",
+        "prefix_length",
         "request_count",
+        "recent_requests",
         "is_resolved",
         "flagged_at",
         "reason_preview",
     )
     list_filter = ("is_resolved", "flagged_at")
     search_fields = ("ip_address", "reason", "notes")
-    readonly_fields = ("ip_address", "reason", "flagged_at", "request_count")
+    readonly_fields = (
+        "ip_address",
+        "prefix_length",
+        "reason",
+        "flagged_at",
+        "request_count",
+    )
     date_hierarchy = "flagged_at"
 
     fieldsets = (
-        ("IP Information", {"fields": ("ip_address", "request_count")}),
+        (
+            "IP Information",
+            {"fields": ("ip_address", "prefix_length", "request_count")},
+        ),
         ("Flag Details", {"fields": ("reason", "flagged_at")}),
         ("Resolution", {"fields": ("is_resolved", "resolved_at", "notes")}),
     )
@@ -87,6 +156,28 @@ class SuspiciousIPAdmin(admin.ModelAdmin):
 
     reason_preview.short_description = "Reason"
 
+    def get_queryset(self, request):
+        """Annotate each flag with its IP's requests in the last hour"""
+        queryset = super().get_queryset(request)
+        if use_rollups():
+            since = bucket_start(get_bucket(timezone.now() - timedelta(hours=1)))
+            recent = (
+                RequestRollup.objects.filter(
+                    ip_address=OuterRef("ip_address"), bucket__gte=since
+                )
+                .values("ip_address")
+                .annotate(total=Sum("count"))
+                .values("total")
+            )
+            queryset = queryset.annotate(requests_last_hour=Subquery(recent))
+        return queryset
+
+    def recent_requests(self, obj):
+        """Requests in the last hour, from the rollups"""
+        return getattr(obj, "requests_last_hour", None) or 0
+
+    recent_requests.short_description = "Requests (1h)"
+
     actions = ["mark_as_resolved", "mark_as_unresolved", "block_selected_ips"]
 
     def mark_as_resolved(self, request, queryset):
@@ -104,13 +195,31 @@ class SuspiciousIPAdmin(admin.ModelAdmin):
 
     mark_as_unresolved.short_description = "Mark as unresolved"
 
+    @transaction.atomic
     def block_selected_ips(self, request, queryset):
-        """Block all IPs in selected flags"""
+        """
+        Block all IPs in selected flags, and the networks of subnet flags.
+        Runs in one transaction, so the blocklist is published once.
+        """
 
         blocked_count = 0
         for suspicious_ip in queryset:
+            if suspicious_ip.prefix_length is not None:
+                blocked_network, created = BlockedNetwork.objects.get_or_create(
+                    network=suspicious_ip.network,
+                    defaults={
+                        "reason": f"Blocked from suspicious activity: {suspicious_ip.reason}",
+                        "is_active": True,
+                    },
+                )
+                if created:
+                    blocked_count += 1
+                elif not blocked_network.is_active:
+                    blocked_network.is_active = True
+                    blocked_network.save()
+                    blocked_count += 1
             # Check if already blocked
-            if not BlockedIP.objects.filter(
+            elif not BlockedIP.objects.filter(
                 ip_address=suspicious_ip.ip_address, is_active=True
             ).exists():
                 BlockedIP.objects.create(
@@ -129,3 +238,44 @@ class SuspiciousIPAdmin(admin.ModelAdmin):
         self.message_user(request, f"{blocked_count} IP(s) blocked and flags resolved.")
 
     block_selected_ips.short_description = "Block selected IPs"
+
+
+@admin.register(RequestRollup)
+class RequestRollupAdmin(admin.ModelAdmin):
+    """Per-minute request rollups admin view"""
+
+    list_display = ("ip_address", "bucket", "count")
+    list_filter = ("bucket",)
+    search_fields = ("ip_address",)
+    readonly_fields = ("ip_address", "bucket", "count")
+    date_hierarchy = "bucket"
+
+
+@admin.register(PathRollup)
+class PathRollupAdmin(admin.ModelAdmin):
+    """Per-minute path rollups admin view"""
+
+    list_display = ("ip_address", "path_prefix", "bucket", "count")
+    list_filter = ("path_prefix", "bucket")
+    search_fields = ("ip_address", "path_prefix")
+    readonly_fields = ("ip_address", "path_prefix", "bucket", "count")
+    date_hierarchy = "bucket"
+
+
+@admin.register(DetectionState)
+class DetectionStateAdmin(admin.ModelAdmin):
+    """Incremental detection watermark admin view"""
+
+    list_display = ("name", "last_log_id", "updated_at")
+    readonly_fields = ("name", "last_log_id", "updated_at")
+
+
+@admin.register(DetectionCounter)
+class DetectionCounterAdmin(admin.ModelAdmin):
+    """Incremental detection counters admin view"""
+
+    list_display = ("ip_address", "rule", "bucket", "count")
+    list_filter = ("rule", "bucket")
+    search_fields = ("ip_address",)
+    readonly_fields = ("ip_address", "rule", "bucket", "count")
+    date_hierarchy = "bucket"
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class IpTrackingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ip_tracking'
+
+    def ready(self):
+        # Register signal handlers
+        from . import signals  # noqa: F401 pylint: disable=import-outside-toplevel,unused-import
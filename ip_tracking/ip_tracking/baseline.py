@@ -0,0 +1,266 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+from .models import PathRollup, RequestLog, RequestRollup
+from .rollups import use_rollups
+from .rules import get_detection_plan
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - optional dependency
+    np = None
+
+SLOT_SECONDS = 3600  # One hourly slot per column
+HISTORY_SLOTS = 24  # Slots before the current one the baselines are built from
+EWMA_ALPHA = 0.3  # Weight of the most recent history slot
+SPIKE_THRESHOLD = 4.0  # z-score of the current slot against the IP's baseline
+PERSISTENCE_THRESHOLD = 6.0  # Robust z-score of an IP's total against all IPs
+MIN_COUNT = 20  # Requests below which an IP is never an outlier
+TOTAL_FEATURE = "requests"
+
+
+def use_baseline():
+    """Whether detect_statistical_anomalies runs"""
+    return getattr(settings, "IP_TRACKING_BASELINE_ENABLED", False)
+
+
+class TrafficMatrix:
+    """
+    Hourly request counts of every active IP address as NumPy arrays.
+
+    features maps "requests" and every path matcher of the anomaly rules
+    (e.g. "/admin", or "/login$" for an exact path) to a pair of an array of
+    indexes into ip_addresses and a float32 array of shape (IPs, slots)
+    holding only the IPs with requests for that feature. The last column is
+    the most recent complete hour.
+    """
+
+    def __init__(self, ip_addresses, features, end):
+        self.ip_addresses = ip_addresses
+        self.features = features
+        self.end = end
+
+    @classmethod
+    def load(cls, now=None, slots=HISTORY_SLOTS + 1, path_rules=None):
+        """
+        Load the slots complete hours before now with one GROUP BY over
+        RequestLog, or over the rollup tables when they are enabled.
+        """
+        if np is None:
+            raise ImproperlyConfigured("The numpy package is required for baselines")
+
+        now = now or timezone.now()
+        end = now.replace(minute=0, second=0, microsecond=0)
+        start = end - timedelta(seconds=SLOT_SECONDS * slots)
+        if path_rules is None:
+            path_rules = [
+                rule for rule in get_detection_plan().rules if rule.rollup_key
+            ]
+        path_rules = list({rule.rollup_key: rule for rule in path_rules}.values())
+
+        index = {}
+        cells = {TOTAL_FEATURE: ([], [], [])}
+        for rule in path_rules:
+            cells[rule.rollup_key] = ([], [], [])
+
+        def add(feature, ip_address, hour, count):
+            if count:
+                ips, columns, counts = cells[feature]
+                ips.append(index.setdefault(ip_address, len(index)))
+                columns.append(int((hour - start).total_seconds()) // SLOT_SECONDS)
+                counts.append(count)
+
+        if use_rollups():
+            for ip_address, hour, count in (
+                RequestRollup.objects.filter(bucket__gte=start, bucket__lt=end)
+                .annotate(hour=TruncHour("bucket"))
+                .values_list("ip_address", "hour")
+                .annotate(total=Sum("count"))
+                .order_by()
+            ):
+                add(TOTAL_FEATURE, ip_address, hour, count)
+            for ip_address, hour, path_key, count in (
+                PathRollup.objects.filter(
+                    bucket__gte=start,
+                    bucket__lt=end,
+                    path_prefix__in=[rule.rollup_key for rule in path_rules],
+                )
+                .annotate(hour=TruncHour("bucket"))
+                .values_list("ip_address", "hour", "path_prefix")
+                .annotate(total=Sum("count"))
+                .order_by()
+            ):
+                add(path_key, ip_address, hour, count)
+        else:
+            counters = {
+                f"path_{number}": Count("id", filter=rule.path_filter())
+                for number, rule in enumerate(path_rules)
+            }
+            for row in (
+                RequestLog.objects.filter(timestamp__gte=start, timestamp__lt=end)
+                .annotate(hour=TruncHour("timestamp"))
+                .values_list("ip_address", "hour")
+                .annotate(total=Count("id"), **counters)
+                .order_by()
+            ):
+                ip_address, hour, total, *path_counts = row
+                add(TOTAL_FEATURE, ip_address, hour, total)
+                for rule, count in zip(path_rules, path_counts):
+                    add(rule.rollup_key, ip_address, hour, count)
+
+        features = {}
+        for feature, (ips, columns, counts) in cells.items():
+            rows, row_of_cell = np.unique(
+                np.array(ips, dtype=np.intp), return_inverse=True
+            )
+            matrix = np.zeros((len(rows), slots), dtype=np.float32)
+            matrix[row_of_cell, np.array(columns, dtype=np.intp)] = counts
+            features[feature] = (rows, matrix)
+        return cls(list(index), features, end)
+
+
+class StatisticalBaseline:
+    """
+    Vectorized outlier detection over a TrafficMatrix.
+
+    For every feature and all IPs at once:
+
+    - spike: the current hour against the IP's own EWMA baseline of the
+      previous hours, as a z-score using the EWMA standard deviation (at
+      least the Poisson noise of the baseline). Busy but steady sources
+      such as NAT gateways keep a high baseline and are not flagged.
+    - new: IPs without any history get a robust z-score (median and MAD
+      of log counts) of the current hour against every active IP instead.
+    - persistence (path features only): the same robust z-score of the
+      IP's total over all slots, which catches slow attackers that never
+      spike in any hour.
+
+    Each step is a few array operations over (IPs, slots) matrices, so a
+    million IPs take seconds on one core.
+    """
+
+    def __init__(
+        self,
+        alpha=EWMA_ALPHA,
+        spike_threshold=SPIKE_THRESHOLD,
+        persistence_threshold=PERSISTENCE_THRESHOLD,
+        min_count=MIN_COUNT,
+    ):
+        if np is None:
+            raise ImproperlyConfigured("The numpy package is required for baselines")
+        self.alpha = alpha
+        self.spike_threshold = spike_threshold
+        self.persistence_threshold = persistence_threshold
+        self.min_count = min_count
+
+    @classmethod
+    def from_settings(cls):
+        """Build a detector from the IP_TRACKING_BASELINE_* settings"""
+        return cls(
+            alpha=getattr(settings, "IP_TRACKING_BASELINE_EWMA_ALPHA", EWMA_ALPHA),
+            spike_threshold=getattr(
+                settings, "IP_TRACKING_BASELINE_SPIKE_THRESHOLD", SPIKE_THRESHOLD
+            ),
+            persistence_threshold=getattr(
+                settings,
+                "IP_TRACKING_BASELINE_PERSISTENCE_THRESHOLD",
+                PERSISTENCE_THRESHOLD,
+            ),
+            min_count=getattr(settings, "IP_TRACKING_BASELINE_MIN_COUNT", MIN_COUNT),
+        )
+
+    def ewma_weights(self, slots):
+        """Normalized EWMA weights of slots history columns, oldest first"""
+        weights = self.alpha * (1 - self.alpha) ** np.arange(slots - 1, -1, -1)
+        return (weights / weights.sum()).astype(np.float32)
+
+    def spike_scores(self, matrix):
+        """z-scores of the last column against the EWMA of the others"""
+        history, current = matrix[:, :-1], matrix[:, -1]
+        weights = self.ewma_weights(history.shape[1])
+        mean = history @ weights
+        variance = np.maximum((history * history) @ weights - mean * mean, 0)
+        std = np.maximum(np.sqrt(variance), np.sqrt(np.maximum(mean, 1)))
+        return (current - mean) / std
+
+    def population_scores(self, counts):
+        """Robust z-scores of log counts against all IPs with requests"""
+        logs = np.log1p(counts)
+        active = logs[counts > 0]
+        if not active.size:
+            return np.zeros_like(logs)
+        median = np.median(active)
+        mad = np.median(np.abs(active - median)) * 1.4826
+        return (logs - median) / max(mad, 0.5)
+
+    def outliers(self, traffic):
+        """
+        Return (ip_address, feature, kind, score, count) for every outlier,
+        largest score first.
+        """
+        found = []
+
+        def collect(kind, scores, counts, threshold, mask=True):
+            hits = np.flatnonzero(
+                mask & (scores > threshold) & (counts >= self.min_count)
+            )
+            found.extend(
+                (
+                    traffic.ip_addresses[rows[i]],
+                    feature,
+                    kind,
+                    float(scores[i]),
+                    int(counts[i]),
+                )
+                for i in hits
+            )
+
+        for feature, (rows, matrix) in traffic.features.items():
+            if not matrix.size:
+                continue
+            current = matrix[:, -1]
+            # IPs without history have no baseline of their own yet and are
+            # compared with every other IP instead
+            new = ~matrix[:, :-1].any(axis=1)
+            collect(
+                "spike", self.spike_scores(matrix), current, self.spike_threshold, ~new
+            )
+            collect(
+                "new",
+                self.population_scores(current),
+                current,
+                self.persistence_threshold,
+                new,
+            )
+            if feature != TOTAL_FEATURE:
+                totals = matrix.sum(axis=1)
+                collect(
+                    "persistence",
+                    self.population_scores(totals),
+                    totals,
+                    self.persistence_threshold,
+                )
+        found.sort(key=lambda outlier: outlier[3], reverse=True)
+        return found
+
+
+def describe_outlier(feature, kind, score, count):
+    """SuspiciousIP.reason of an outlier"""
+    target = "requests" if feature == TOTAL_FEATURE else f"requests to '{feature}'"
+    if kind == "spike":
+        return (
+            f"Statistical outlier: {count} {target} in the last hour "
+            f"(z={score:.1f} against its baseline)"
+        )
+    if kind == "new":
+        return (
+            f"Statistical outlier: {count} {target} in the last hour "
+            f"from a new IP (z={score:.1f} against all IPs)"
+        )
+    return (
+        f"Statistical outlier: {count} {target} in the last {HISTORY_SLOTS + 1} "
+        f"hours (z={score:.1f} against all IPs)"
+    )
@@ -0,0 +1,830 @@
+import hashlib
+import ipaddress
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.ipv6 import clean_ipv6_address
+from .models import BlockedIP, BlockedNetwork
+
+logger = logging.getLogger(__name__)
+
+BLOCKLIST_VERSION_KEY = "blocklist_version"
+BLOCKED_IP_CACHE_PREFIX = "blocked_ip_"
+BLOCKED_IP_CACHE_TIMEOUT = 300  # 5 minutes
+BLOOM_FILTER_CACHE_PREFIX = "blocklist_bloom_"
+BLOOM_FILTER_CACHE_TIMEOUT = 86400  # 24 hours
+
+# Shared blocklist file: magic, generation, address count, range count
+BLOCKLIST_FILE_MAGIC = b"IPBL"
+BLOCKLIST_FILE_HEADER = struct.Struct(">4sQQQ")
+IPV4_MAPPED_PREFIX = b"\x00" * 10 + b"\xff\xff"
+
+_snapshot = None
+_network_blocklist = None
+_snapshot_lock = threading.Lock()
+
+
+def normalize_ip(ip_address):
+    """Normalize an IPv6 address the way GenericIPAddressField stores it"""
+    if ip_address and ":" in ip_address:
+        try:
+            return clean_ipv6_address(ip_address)
+        except Exception:  # pylint: disable=broad-exception-caught
+            return ip_address
+    return ip_address
+
+
+def bump_blocklist_version():
+    """
+    Publish a new blocklist version so every worker reloads its snapshot.
+    Call this after any change to BlockedIP or BlockedNetwork that bypasses
+    model signals, such as QuerySet.update() or bulk_create().
+    """
+    cache.set(BLOCKLIST_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+class PrefixTrie:
+    """
+    Binary trie over integer IP addresses for longest-prefix matching.
+
+    Each node is a [zero_child, one_child, value] list. A lookup walks at
+    most one node per bit of the longest stored prefix, so it costs
+    O(prefix length) however many networks are stored.
+    """
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = [None, None, None]
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def insert(self, network, value):
+        """Store value for an ipaddress network object"""
+        address = int(network.network_address)
+        node = self.root
+        for depth in range(network.prefixlen):
+            bit = (address >> (self.bits - 1 - depth)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            self.size += 1
+        node[2] = value
+
+    def longest_match(self, address):
+        """Return the value of the longest prefix containing an integer IP"""
+        node = self.root
+        match = node[2]
+        shift = self.bits - 1
+        while shift >= 0:
+            node = node[(address >> shift) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                match = node[2]
+            shift -= 1
+        return match
+
+
+class NetworkBlocklist:
+    """Compiled longest-prefix-match structure for blocked networks"""
+
+    def __init__(self, networks=()):
+        self.tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        for network in networks:
+            try:
+                parsed = ipaddress.ip_network(network, strict=False)
+            except ValueError:
+                logger.warning("Ignoring invalid blocked network %s", network)
+                continue
+            self.tries[parsed.version].insert(parsed, str(parsed))
+
+    def __len__(self):
+        return len(self.tries[4]) + len(self.tries[6])
+
+    def match(self, ip_address):
+        """Return the blocked network containing ip_address, or None"""
+        if not len(self):
+            return None
+        try:
+            address = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return None
+        return self.tries[address.version].longest_match(int(address))
+
+
+class BloomFilter:
+    """
+    Compact probabilistic set of IP addresses.
+
+    Membership tests never give false negatives; false positives happen at
+    roughly the configured rate. The bit array is sized from the expected
+    number of items with the usual m = -n ln(p) / ln(2)^2 formula and
+    positions are derived from one blake2b digest by double hashing.
+    """
+
+    def __init__(self, size, hash_count, bits=None, count=0):
+        self.size = size
+        self.hash_count = hash_count
+        self.bits = bytearray(bits) if bits is not None else bytearray((size + 7) // 8)
+        self.count = count
+
+    @classmethod
+    def for_capacity(cls, capacity, fp_rate):
+        """Create an empty filter sized for capacity items at fp_rate"""
+        capacity = max(capacity, 1)
+        size = max(int(-capacity * math.log(fp_rate) / (math.log(2) ** 2)), 8)
+        hash_count = max(int(round(size / capacity * math.log(2))), 1)
+        return cls(size, hash_count)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        """Add an item to the filter"""
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(
+            bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+    def __len__(self):
+        return self.count
+
+    def estimated_fp_rate(self):
+        """False-positive rate implied by the current fill ratio"""
+        set_bits = sum(bin(byte).count("1") for byte in self.bits)
+        return (set_bits / self.size) ** self.hash_count
+
+    def to_payload(self):
+        """Serialize the filter so it can be shared through the cache"""
+        return {
+            "size": self.size,
+            "hash_count": self.hash_count,
+            "count": self.count,
+            "bits": bytes(self.bits),
+        }
+
+    @classmethod
+    def from_payload(cls, payload):
+        """Rebuild a filter produced by to_payload"""
+        return cls(
+            payload["size"],
+            payload["hash_count"],
+            bits=payload["bits"],
+            count=payload["count"],
+        )
+
+
+# pylint: disable=no-member
+def check_blocked_ip(ip_address, lookup=None):
+    """
+    Exact blocklist check for a single address.
+    Uses the per-IP cache to minimize database queries. With a
+    RequestCacheLookup the cached flag is taken from its prefetched values
+    and a miss is queued for its write-back.
+    """
+    cache_key = f"{BLOCKED_IP_CACHE_PREFIX}{ip_address}"
+
+    # Check cache first
+    if lookup is not None:
+        cached_result = lookup.get(cache_key)
+    else:
+        cached_result = cache.get(cache_key)
+    if cached_result is not None:
+        return cached_result
+
+    # Query database
+    is_blocked = BlockedIP.objects.filter(
+        ip_address=ip_address, is_active=True
+    ).exists()
+
+    # Cache the result
+    if lookup is not None:
+        lookup.set(cache_key, is_blocked, BLOCKED_IP_CACHE_TIMEOUT)
+    else:
+        cache.set(cache_key, is_blocked, BLOCKED_IP_CACHE_TIMEOUT)
+
+    return is_blocked
+
+
+async def acheck_blocked_ip(ip_address, lookup=None):
+    """Async version of check_blocked_ip"""
+    cache_key = f"{BLOCKED_IP_CACHE_PREFIX}{ip_address}"
+
+    if lookup is not None:
+        cached_result = lookup.get(cache_key)
+    else:
+        cached_result = await cache.aget(cache_key)
+    if cached_result is not None:
+        return cached_result
+
+    is_blocked = await BlockedIP.objects.filter(
+        ip_address=ip_address, is_active=True
+    ).aexists()
+
+    if lookup is not None:
+        lookup.set(cache_key, is_blocked, BLOCKED_IP_CACHE_TIMEOUT)
+    else:
+        await cache.aset(cache_key, is_blocked, BLOCKED_IP_CACHE_TIMEOUT)
+
+    return is_blocked
+
+
+class BlocklistSnapshot:
+    """
+    In-memory copy of all active BlockedIP addresses and BlockedNetwork
+    ranges.
+
+    Addresses are held in a frozenset and networks in a NetworkBlocklist, so
+    the common "not blocked" answer costs no I/O. A global version key in
+    the cache is compared at most once every check_interval seconds, and the
+    snapshot is only reloaded from the database when that version changes.
+
+    With use_bloom set, addresses are held in a BloomFilter instead of a
+    set. The filter is built once per version and shared through the cache,
+    a filter miss answers "not blocked" straight away and only a filter hit
+    goes on to the exact per-IP cache/database check.
+
+    Until the first load succeeds, addresses are checked with
+    check_blocked_ip instead and the load is retried on every call. A failed
+    reload keeps the previous snapshot until the next check.
+
+    With networks_only set, only BlockedNetwork is loaded, for the network
+    check behind the per-IP mode (see get_network_blocklist). Such a
+    snapshot answers is_network_blocked only.
+    """
+
+    def __init__(
+        self,
+        check_interval=1.0,
+        use_bloom=False,
+        bloom_fp_rate=0.001,
+        networks_only=False,
+    ):
+        self.check_interval = check_interval
+        self.use_bloom = use_bloom and not networks_only
+        self.networks_only = networks_only
+        self.bloom_fp_rate = bloom_fp_rate
+        self.addresses = None
+        self.networks = NetworkBlocklist()
+        self.version = None
+        self.next_check = 0.0
+        self._lock = threading.Lock()
+        self._arefreshing = False
+
+        # Counters
+        self.version_checks = 0
+        self.reloads = 0
+        self.bloom_hits = 0
+        self.bloom_false_positives = 0
+
+    @classmethod
+    def from_settings(cls, networks_only=False):
+        """Build a snapshot from the IP_TRACKING_BLOCKLIST_* settings"""
+        interval = getattr(settings, "IP_TRACKING_BLOCKLIST_CHECK_INTERVAL", 1000)
+        return cls(
+            check_interval=interval / 1000,
+            networks_only=networks_only,
+            use_bloom=getattr(settings, "IP_TRACKING_BLOCKLIST_BLOOM", False),
+            bloom_fp_rate=getattr(
+                settings, "IP_TRACKING_BLOCKLIST_BLOOM_FP_RATE", 0.001
+            ),
+        )
+
+    def is_blocked(self, ip_address):
+        """Check an IP address against the snapshot"""
+        if time.monotonic() >= self.next_check:
+            self.refresh()
+
+        ip_address = normalize_ip(ip_address)
+        if self.addresses is None:
+            # Not loaded yet
+            if check_blocked_ip(ip_address):
+                return True
+        elif ip_address in self.addresses:
+            if not self.use_bloom:
+                return True
+            if self._confirm(check_blocked_ip(ip_address)):
+                return True
+        return self.networks.match(ip_address) is not None
+
+    async def ais_blocked(self, ip_address):
+        """Async version of is_blocked"""
+        if time.monotonic() >= self.next_check:
+            await self.arefresh()
+
+        ip_address = normalize_ip(ip_address)
+        if self.addresses is None:
+            if await acheck_blocked_ip(ip_address):
+                return True
+        elif ip_address in self.addresses:
+            if not self.use_bloom:
+                return True
+            if self._confirm(await acheck_blocked_ip(ip_address)):
+                return True
+        return self.networks.match(ip_address) is not None
+
+    def is_network_blocked(self, ip_address):
+        """Check an IP address against the blocked networks only"""
+        if time.monotonic() >= self.next_check:
+            self.refresh()
+        return self.networks.match(ip_address) is not None
+
+    async def ais_network_blocked(self, ip_address):
+        """Async version of is_network_blocked"""
+        if time.monotonic() >= self.next_check:
+            await self.arefresh()
+        return self.networks.match(ip_address) is not None
+
+    def _confirm(self, is_blocked):
+        """Count the outcome of the exact check behind a filter hit"""
+        self.bloom_hits += 1
+        if not is_blocked:
+            self.bloom_false_positives += 1
+        return is_blocked
+
+    def refresh(self):
+        """
+        Reload the snapshot if the published version changed. The next check
+        is only scheduled once a snapshot is loaded.
+        """
+        with self._lock:
+            if time.monotonic() < self.next_check:
+                return
+            self.version_checks += 1
+            try:
+                version = cache.get(BLOCKLIST_VERSION_KEY)
+                if version is None:
+                    # First worker (or the key was evicted): publish a version
+                    version = uuid.uuid4().hex
+                    if not cache.add(BLOCKLIST_VERSION_KEY, version, None):
+                        version = cache.get(BLOCKLIST_VERSION_KEY, version)
+
+                if version != self.version or self.addresses is None:
+                    addresses = BlockedIP.objects.filter(is_active=True).values_list(
+                        "ip_address", flat=True
+                    )
+                    networks = BlockedNetwork.objects.filter(
+                        is_active=True
+                    ).values_list("network", flat=True)
+                    if self.networks_only:
+                        addresses = ()
+                    elif self.use_bloom:
+                        addresses = self.load_bloom(addresses, version)
+                    self.load(addresses, networks, version)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logger.error("Failed to refresh the blocklist snapshot: %s", e)
+                if self.addresses is None:
+                    return  # Retry the first load on the next call
+            self.next_check = time.monotonic() + self.check_interval
+
+    async def arefresh(self):
+        """Async version of refresh"""
+        if time.monotonic() < self.next_check or self._arefreshing:
+            return
+        # One refresh per event loop at a time, the others use the snapshot
+        # (or the per-IP check) they have
+        self._arefreshing = True
+        self.version_checks += 1
+        try:
+            version = await cache.aget(BLOCKLIST_VERSION_KEY)
+            if version is None:
+                version = uuid.uuid4().hex
+                if not await cache.aadd(BLOCKLIST_VERSION_KEY, version, None):
+                    version = await cache.aget(BLOCKLIST_VERSION_KEY, version)
+
+            if version != self.version or self.addresses is None:
+                addresses = BlockedIP.objects.filter(is_active=True).values_list(
+                    "ip_address", flat=True
+                )
+                networks = BlockedNetwork.objects.filter(is_active=True).values_list(
+                    "network", flat=True
+                )
+                if self.networks_only:
+                    addresses = ()
+                elif self.use_bloom:
+                    addresses = await self.aload_bloom(addresses, version)
+                else:
+                    addresses = [ip_address async for ip_address in addresses]
+                self.load(addresses, [network async for network in networks], version)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logger.error("Failed to refresh the blocklist snapshot: %s", e)
+            if self.addresses is None:
+                return
+        finally:
+            self._arefreshing = False
+        self.next_check = time.monotonic() + self.check_interval
+
+    def load_bloom(self, addresses, version):
+        """
+        Fetch the shared Bloom filter for a version from the cache, or build
+        it from the database and share it.
+        """
+        cache_key = f"{BLOOM_FILTER_CACHE_PREFIX}{version}"
+        payload = cache.get(cache_key)
+        if payload is not None:
+            return BloomFilter.from_payload(payload)
+
+        bloom = BloomFilter.for_capacity(addresses.count(), self.bloom_fp_rate)
+        for ip_address in addresses.iterator(chunk_size=10000):
+            bloom.add(ip_address)
+        cache.set(cache_key, bloom.to_payload(), BLOOM_FILTER_CACHE_TIMEOUT)
+        return bloom
+
+    async def aload_bloom(self, addresses, version):
+        """Async version of load_bloom"""
+        cache_key = f"{BLOOM_FILTER_CACHE_PREFIX}{version}"
+        payload = await cache.aget(cache_key)
+        if payload is not None:
+            return BloomFilter.from_payload(payload)
+
+        bloom = BloomFilter.for_capacity(await addresses.acount(), self.bloom_fp_rate)
+        async for ip_address in addresses.aiterator(chunk_size=10000):
+            bloom.add(ip_address)
+        await cache.aset(cache_key, bloom.to_payload(), BLOOM_FILTER_CACHE_TIMEOUT)
+        return bloom
+
+    def load(self, addresses, networks, version):
+        """Swap in a new set of blocked addresses and networks"""
+        self.networks = NetworkBlocklist(networks)
+        self.addresses = addresses if self.use_bloom else frozenset(addresses)
+        self.version = version
+        self.reloads += 1
+        logger.info(
+            "Loaded blocklist snapshot version %s with %s IPs and %s networks",
+            version,
+            len(self.addresses),
+            len(self.networks),
+        )
+
+    def stats(self):
+        """Return the snapshot size and counters"""
+        stats = {
+            "size": len(self.addresses) if self.addresses is not None else 0,
+            "networks": len(self.networks),
+            "version": self.version,
+            "version_checks": self.version_checks,
+            "reloads": self.reloads,
+        }
+        if self.use_bloom and self.addresses is not None:
+            stats["bloom"] = {
+                "bytes": len(self.addresses.bits),
+                "hash_count": self.addresses.hash_count,
+                "configured_fp_rate": self.bloom_fp_rate,
+                "estimated_fp_rate": self.addresses.estimated_fp_rate(),
+                "hits": self.bloom_hits,
+                "false_positives": self.bloom_false_positives,
+            }
+        return stats
+
+
+def pack_ip(ip_address):
+    """Pack an address into 16 bytes, mapping IPv4 into ::ffff:0:0/96"""
+    address = ipaddress.ip_address(ip_address)
+    if address.version == 4:
+        return IPV4_MAPPED_PREFIX + address.packed
+    return address.packed
+
+
+def merge_ranges(ranges):
+    """Merge overlapping or adjacent (start, end) integer ranges"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def write_blocklist_file(path=None):
+    """
+    Write all active blocks to the shared blocklist file.
+
+    The file holds a header, the sorted packed addresses (16 bytes each)
+    and the sorted, merged network ranges (32 bytes each). It is written to
+    a temporary file and renamed into place so readers never see a partial
+    file.
+    """
+    path = str(path or settings.IP_TRACKING_BLOCKLIST_FILE)
+
+    addresses = sorted(
+        {
+            pack_ip(ip_address)
+            for ip_address in BlockedIP.objects.filter(is_active=True)
+            .values_list("ip_address", flat=True)
+            .iterator(chunk_size=10000)
+        }
+    )
+
+    ranges = []
+    for network in BlockedNetwork.objects.filter(is_active=True).values_list(
+        "network", flat=True
+    ):
+        parsed = ipaddress.ip_network(network, strict=False)
+        start = int.from_bytes(pack_ip(parsed.network_address), "big")
+        ranges.append((start, start + parsed.num_addresses - 1))
+    ranges = merge_ranges(ranges)
+
+    generation = time.time_ns()
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".blocklist-")
+    try:
+        with os.fdopen(fd, "wb") as blocklist_file:
+            blocklist_file.write(
+                BLOCKLIST_FILE_HEADER.pack(
+                    BLOCKLIST_FILE_MAGIC, generation, len(addresses), len(ranges)
+                )
+            )
+            blocklist_file.writelines(addresses)
+            for start, end in ranges:
+                blocklist_file.write(
+                    start.to_bytes(16, "big") + end.to_bytes(16, "big")
+                )
+            blocklist_file.flush()
+            os.fsync(blocklist_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    logger.info(
+        "Wrote blocklist file %s generation %s: %s IPs, %s ranges",
+        path,
+        generation,
+        len(addresses),
+        len(ranges),
+    )
+    return generation
+
+
+def publish_blocklist():
+    """
+    Publish blocklist changes to every worker: bump the version used by the
+    in-process snapshots and rewrite the shared file when one is configured.
+    """
+    bump_blocklist_version()
+    if getattr(settings, "IP_TRACKING_BLOCKLIST_FILE", None):
+        write_blocklist_file()
+
+
+def publish_blocklist_on_commit(using=None):
+    """
+    Publish the blocklist once the current transaction commits.
+
+    Every change schedules a callback, and each one remembers how many
+    publishes the connection had run when it was scheduled. Only the first
+    callback run after the commit publishes, so changing many blocks in one
+    transaction rewrites the file once. Callbacks of rolled back
+    transactions and savepoints are discarded by Django and leave no state
+    behind.
+    """
+    connection = transaction.get_connection(using)
+    published = getattr(connection, "ip_tracking_publishes", 0)
+
+    def publish():
+        if getattr(connection, "ip_tracking_publishes", 0) != published:
+            return
+        connection.ip_tracking_publishes = published + 1
+        publish_blocklist()
+
+    transaction.on_commit(publish, using=using)
+
+
+class MappedBlocklist:
+    """
+    Blocklist read from the memory-mapped file written by
+    write_blocklist_file.
+
+    Every gunicorn worker maps the same file, so the page cache holds a
+    single copy however many workers there are. Lookups binary-search the
+    fixed-size records in place without loading them into Python objects.
+    The file is re-mapped when a new generation is renamed into place,
+    checked at most once every check_interval seconds.
+
+    The file is only written by publish_blocklist and the publish_blocklist
+    command. Until it exists, addresses are checked with check_blocked_ip
+    and networks are not checked at all. A file that cannot be read or is
+    truncated is logged and skipped, keeping the previous mapping.
+    """
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = str(path)
+        self.check_interval = check_interval
+        self.next_check = 0.0
+        self.mapping = None
+        self.stat_key = None
+        self.generation = None
+        self.address_count = 0
+        self.range_count = 0
+        self.missing = False
+        self._lock = threading.Lock()
+
+        # Counters
+        self.reloads = 0
+
+    def is_blocked(self, ip_address):
+        """Check an IP address against the mapped addresses and ranges"""
+        if time.monotonic() >= self.next_check:
+            self.refresh()
+        if self.mapping is None:
+            # Not published yet
+            return check_blocked_ip(normalize_ip(ip_address))
+        try:
+            packed = pack_ip(ip_address)
+        except ValueError:
+            return False
+        return self._has_address(packed) or self._in_range(packed)
+
+    async def ais_blocked(self, ip_address):
+        """Async version of is_blocked; the mapped lookup does no I/O"""
+        if time.monotonic() >= self.next_check:
+            self.refresh()
+        if self.mapping is None:
+            return await acheck_blocked_ip(normalize_ip(ip_address))
+        return self.is_blocked(ip_address)
+
+    def is_network_blocked(self, ip_address):
+        """Check an IP address against the mapped ranges only"""
+        if time.monotonic() >= self.next_check:
+            self.refresh()
+        if self.mapping is None:
+            return False
+        try:
+            return self._in_range(pack_ip(ip_address))
+        except ValueError:
+            return False
+
+    async def ais_network_blocked(self, ip_address):
+        """Async version of is_network_blocked"""
+        return self.is_network_blocked(ip_address)
+
+    def _has_address(self, packed):
+        mapping = self.mapping
+        low, high = 0, self.address_count
+        while low < high:
+            middle = (low + high) // 2
+            offset = BLOCKLIST_FILE_HEADER.size + middle * 16
+            record = mapping[offset : offset + 16]
+            if record < packed:
+                low = middle + 1
+            elif record > packed:
+                high = middle
+            else:
+                return True
+        return False
+
+    def _in_range(self, packed):
+        mapping = self.mapping
+        base = BLOCKLIST_FILE_HEADER.size + self.address_count * 16
+        # Find the last range starting at or before the address
+        low, high = 0, self.range_count
+        while low < high:
+            middle = (low + high) // 2
+            offset = base + middle * 32
+            if mapping[offset : offset + 16] <= packed:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return False
+        offset = base + (low - 1) * 32
+        return packed <= mapping[offset + 16 : offset + 32]
+
+    def refresh(self):
+        """Re-map the file if a new generation was written"""
+        with self._lock:
+            if time.monotonic() < self.next_check:
+                return
+            self.next_check = time.monotonic() + self.check_interval
+
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                # Keep the current mapping, if any, until one is published
+                if not self.missing:
+                    logger.warning("Blocklist file %s does not exist", self.path)
+                self.missing = True
+                return
+            except OSError:
+                logger.exception("Cannot stat blocklist file %s", self.path)
+                return
+            self.missing = False
+
+            stat_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if stat_key != self.stat_key:
+                try:
+                    self.load(stat_key)
+                except (OSError, ValueError):
+                    # Not retried until the file changes again
+                    self.stat_key = stat_key
+                    logger.exception(
+                        "Cannot map blocklist file %s, keeping generation %s",
+                        self.path,
+                        self.generation,
+                    )
+
+    def load(self, stat_key):
+        """Map the current file, raising ValueError if it is not valid"""
+        with open(self.path, "rb") as blocklist_file:
+            mapping = mmap.mmap(blocklist_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            if len(mapping) < BLOCKLIST_FILE_HEADER.size:
+                raise ValueError(f"{self.path} is truncated")
+            magic, generation, address_count, range_count = (
+                BLOCKLIST_FILE_HEADER.unpack_from(mapping)
+            )
+            if magic != BLOCKLIST_FILE_MAGIC:
+                raise ValueError(f"{self.path} is not a blocklist file")
+            size = BLOCKLIST_FILE_HEADER.size + address_count * 16 + range_count * 32
+            if len(mapping) != size:
+                raise ValueError(
+                    f"{self.path} is {len(mapping)} bytes, expected {size}"
+                )
+        except ValueError:
+            mapping.close()
+            raise
+
+        # Readers of the old mapping may still hold a reference; let it be
+        # released by garbage collection instead of closing it under them
+        self.mapping = mapping
+        self.address_count = address_count
+        self.range_count = range_count
+        self.generation = generation
+        self.stat_key = stat_key
+        self.reloads += 1
+        logger.info(
+            "Mapped blocklist file %s generation %s: %s IPs, %s ranges",
+            self.path,
+            generation,
+            address_count,
+            range_count,
+        )
+
+    def stats(self):
+        """Return the mapped file generation and size"""
+        return {
+            "file": self.path,
+            "generation": self.generation,
+            "size": self.address_count,
+            "networks": self.range_count,
+            "reloads": self.reloads,
+        }
+
+
+def get_blocklist_snapshot():
+    """
+    Return the process-wide blocklist: the shared memory-mapped file when
+    IP_TRACKING_BLOCKLIST_FILE is set, the in-process snapshot otherwise.
+    """
+    global _snapshot  # pylint: disable=global-statement
+    if _snapshot is None:
+        with _snapshot_lock:
+            if _snapshot is None:
+                path = getattr(settings, "IP_TRACKING_BLOCKLIST_FILE", None)
+                if path:
+                    interval = getattr(
+                        settings, "IP_TRACKING_BLOCKLIST_CHECK_INTERVAL", 1000
+                    )
+                    _snapshot = MappedBlocklist(path, check_interval=interval / 1000)
+                else:
+                    _snapshot = BlocklistSnapshot.from_settings()
+    return _snapshot
+
+
+def get_network_blocklist():
+    """
+    Return the process-wide blocklist for network checks on top of the
+    per-IP check: the shared memory-mapped file when IP_TRACKING_BLOCKLIST_FILE
+    is set, otherwise a snapshot of the blocked networks only, which never
+    loads the blocked addresses.
+    """
+    global _network_blocklist  # pylint: disable=global-statement
+    if getattr(settings, "IP_TRACKING_BLOCKLIST_FILE", None):
+        return get_blocklist_snapshot()
+    if _network_blocklist is None:
+        with _snapshot_lock:
+            if _network_blocklist is None:
+                _network_blocklist = BlocklistSnapshot.from_settings(networks_only=True)
+    return _network_blocklist
@@ -0,0 +1,175 @@
+import logging
+import threading
+import time
+import redis
+from django.conf import settings
+from .redis_utils import get_async_redis, get_redis
+
+logger = logging.getLogger(__name__)
+
+DISTINCT_PATHS_KEY_PREFIX = "ip_tracking:distinct_paths:"
+DISTINCT_PATHS_WINDOW = 3600  # Seconds per HyperLogLog
+DISTINCT_PATHS_THRESHOLD = 200  # Distinct paths that flag an IP
+
+
+def use_distinct_paths():
+    """Whether the middleware counts distinct paths per IP"""
+    return getattr(settings, "IP_TRACKING_DISTINCT_PATHS_ENABLED", False)
+
+
+# pylint: disable=broad-exception-caught
+class DistinctPathTracker:
+    """
+    Approximate distinct paths per IP in Redis HyperLogLogs.
+
+    Every request adds its path to the IP's HyperLogLog of the current
+    window (PFADD) and reads its cardinality (PFCOUNT of a single key is
+    cached by Redis) in one pipeline. Redis keeps small HyperLogLogs in a
+    sparse encoding and never uses more than 12KB per key, with a standard
+    error of 0.81%. Each HyperLogLog expires at the end of its window, so an
+    active IP never holds more than one. IPs above the threshold are added
+    to the window's candidate sorted set with their count, which candidates()
+    reads instead of running COUNT(DISTINCT path) over RequestLog.
+    """
+
+    def __init__(
+        self, window=DISTINCT_PATHS_WINDOW, threshold=DISTINCT_PATHS_THRESHOLD
+    ):
+        self.window = window
+        self.threshold = threshold
+        self._lock = threading.Lock()
+
+        # Counters
+        self.tracked = 0
+        self.candidates_added = 0
+        self.errors = 0
+
+    @classmethod
+    def from_settings(cls):
+        """Build a tracker from the IP_TRACKING_DISTINCT_PATHS_* settings"""
+        return cls(
+            window=getattr(
+                settings, "IP_TRACKING_DISTINCT_PATHS_WINDOW", DISTINCT_PATHS_WINDOW
+            ),
+            threshold=getattr(
+                settings,
+                "IP_TRACKING_DISTINCT_PATHS_THRESHOLD",
+                DISTINCT_PATHS_THRESHOLD,
+            ),
+        )
+
+    def current_window(self):
+        """Index of the window the current time falls in"""
+        return int(time.time() // self.window)
+
+    def sketch_key(self, ip_address, window):
+        """HyperLogLog of the paths of an IP in a window"""
+        return f"{DISTINCT_PATHS_KEY_PREFIX}{ip_address}:{window}"
+
+    def candidates_key(self, window):
+        """Sorted set of the IPs of a window worth counting"""
+        return f"{DISTINCT_PATHS_KEY_PREFIX}candidates:{window}"
+
+    def _queue_add(self, pipeline, ip_address, path, window):
+        key = self.sketch_key(ip_address, window)
+        pipeline.pfadd(key, path)
+        pipeline.expireat(key, (window + 1) * self.window)
+        pipeline.pfcount(key)
+
+    def _queue_candidate(self, pipeline, ip_address, window, count):
+        key = self.candidates_key(window)
+        pipeline.zadd(key, {ip_address: count}, gt=True)
+        # Kept for a window longer, for the first check after the window ends
+        pipeline.expire(key, self.window * 2)
+
+    def track(self, ip_address, path):
+        """Add a request path to the IP's HyperLogLog"""
+        window = self.current_window()
+        client = get_redis()
+        try:
+            pipeline = client.pipeline(transaction=False)
+            self._queue_add(pipeline, ip_address, path, window)
+            added, _, count = pipeline.execute()
+            if added and count > self.threshold:
+                pipeline = client.pipeline(transaction=False)
+                self._queue_candidate(pipeline, ip_address, window, count)
+                pipeline.execute()
+        except redis.RedisError as e:
+            self._track_failed(e)
+            return
+        self._tracked(added and count > self.threshold)
+
+    async def atrack(self, ip_address, path):
+        """Async version of track"""
+        window = self.current_window()
+        client = get_async_redis()
+        try:
+            pipeline = client.pipeline(transaction=False)
+            self._queue_add(pipeline, ip_address, path, window)
+            added, _, count = await pipeline.execute()
+            if added and count > self.threshold:
+                pipeline = client.pipeline(transaction=False)
+                self._queue_candidate(pipeline, ip_address, window, count)
+                await pipeline.execute()
+        except redis.RedisError as e:
+            self._track_failed(e)
+            return
+        self._tracked(added and count > self.threshold)
+
+    def _tracked(self, candidate):
+        with self._lock:
+            self.tracked += 1
+            self.candidates_added += 1 if candidate else 0
+
+    def _track_failed(self, error):
+        with self._lock:
+            self.errors += 1
+        logger.error("Failed to count distinct paths in Redis: %s", error)
+
+    def candidates(self):
+        """
+        IPs above the threshold as (ip_address, distinct paths), most paths
+        first. IPs of the previous window are included with their final
+        count, so crossings just before the window ended are not missed.
+        """
+        current = self.current_window()
+        pipeline = get_redis().pipeline(transaction=False)
+        for window in (current - 1, current):
+            pipeline.zrange(self.candidates_key(window), 0, -1, withscores=True)
+        found = {}
+        for members in pipeline.execute():
+            for ip_address, count in members:
+                found[ip_address] = max(found.get(ip_address, 0), int(count))
+        return sorted(found.items(), key=lambda item: item[1], reverse=True)
+
+    def stats(self):
+        """Return the tracker counters"""
+        with self._lock:
+            return {
+                "threshold": self.threshold,
+                "tracked": self.tracked,
+                "candidates_added": self.candidates_added,
+                "errors": self.errors,
+            }
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_distinct_path_tracker():
+    """Return the process-wide distinct-path tracker"""
+    global _tracker  # pylint: disable=global-statement
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                _tracker = DistinctPathTracker.from_settings()
+    return _tracker
+
+
+def describe_scanner(count, window=DISTINCT_PATHS_WINDOW):
+    """SuspiciousIP.reason of an IP requesting many distinct paths"""
+    return (
+        f"Possible vulnerability scan: about {count} distinct paths "
+        f"in up to {window // 60} minutes"
+    )
@@ -0,0 +1,815 @@
+import asyncio
+import csv
+import ipaddress
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_right
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+from .redis_utils import get_loop_client
+
+try:
+    import maxminddb
+except ImportError:  # pragma: no cover - optional dependency
+    maxminddb = None
+
+logger = logging.getLogger(__name__)
+
+GEOLOCATION_CACHE_PREFIX = "geolocation_"
+GEOLOCATION_CACHE_TIMEOUT = 86400  # 24 hours
+GEOLOCATION_HTTP_TIMEOUT = 2  # seconds
+GEOLOCATION_BATCH_SIZE = 100  # Maximum IPs per batch request
+
+# Geolocation batch API endpoint (no API key required)
+GEOLOCATION_BATCH_API_URL = "http://ip-api.com/batch?fields=status,country,city,query"
+
+DEFAULT_GEOLOCATION_BACKENDS = ["ip_tracking.geolocation.HTTPBackend"]
+
+_backends = None
+_backends_lock = threading.Lock()
+_http_session = None
+
+
+# pylint: disable=broad-exception-caught
+class BaseGeolocationBackend:
+    """
+    Base class for geolocation backends.
+
+    lookup() returns a (country, city) tuple, or None when the backend has
+    no answer for the address so the next configured backend is tried.
+    """
+
+    def lookup(self, ip_address):
+        """Resolve a single IP address"""
+        raise NotImplementedError
+
+    async def alookup(self, ip_address):
+        """Async version of lookup"""
+        return self.lookup(ip_address)
+
+    def lookup_many(self, ip_addresses):
+        """
+        Resolve several IP addresses.
+        Returns a dict of ip_address -> (country, city) for the ones found.
+        """
+        results = {}
+        for ip_address in ip_addresses:
+            result = self.lookup(ip_address)
+            if result is not None:
+                results[ip_address] = result
+        return results
+
+    def stats(self):
+        """Return backend metrics"""
+        return {}
+
+
+class IPRangeTable:
+    """
+    Sorted integer IP ranges for one address family.
+
+    Range starts and ends are kept in parallel arrays so a lookup is a
+    single binary search over the starts.
+    """
+
+    def __init__(self, ranges, typecode):
+        ranges.sort(key=lambda item: item[0])
+        if typecode:
+            self.starts = array(typecode, (item[0] for item in ranges))
+            self.ends = array(typecode, (item[1] for item in ranges))
+        else:
+            # 128-bit IPv6 integers do not fit in an array
+            self.starts = [item[0] for item in ranges]
+            self.ends = [item[1] for item in ranges]
+        self.locations = array("I", (item[2] for item in ranges))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def find(self, value):
+        """Return the location index for an integer IP, or None"""
+        index = bisect_right(self.starts, value) - 1
+        if index >= 0 and value <= self.ends[index]:
+            return self.locations[index]
+        return None
+
+
+class LocalDatabaseBackend(BaseGeolocationBackend):
+    """
+    Resolve IP addresses from a local database file.
+
+    Supports a MaxMind MMDB file (requires the maxminddb package) or a CSV
+    file with start_ip,end_ip,country,city rows, where start_ip and end_ip
+    are IP addresses or their integer values. CSV files are loaded into
+    sorted integer range arrays and answered by binary search.
+    """
+
+    def __init__(self, path=None):
+        self.path = str(
+            path or getattr(settings, "IP_TRACKING_GEOLOCATION_DATABASE", None) or ""
+        )
+        self.reader = None
+        self.tables = {}
+        self.locations = []
+        self.load()
+
+    def load(self):
+        """Load the configured database file"""
+        if not self.path:
+            raise ImproperlyConfigured(
+                "IP_TRACKING_GEOLOCATION_DATABASE must be set to use "
+                "LocalDatabaseBackend"
+            )
+
+        try:
+            if self.path.endswith(".mmdb"):
+                self.load_mmdb()
+            else:
+                self.load_csv()
+        except OSError as e:
+            logger.warning(
+                "Geolocation database %s could not be loaded: %s", self.path, e
+            )
+
+    def load_mmdb(self):
+        """Open a MaxMind MMDB file"""
+        if maxminddb is None:
+            raise ImproperlyConfigured(
+                "The maxminddb package is required to read MMDB files"
+            )
+        self.reader = maxminddb.open_database(self.path)
+        logger.info("Loaded geolocation database %s", self.path)
+
+    def load_csv(self):
+        """Load a CSV file of IP ranges into sorted range tables"""
+        ranges = {4: [], 6: []}
+        location_index = {}
+
+        with open(self.path, newline="", encoding="utf-8") as csv_file:
+            for row in csv.reader(csv_file):
+                if len(row) < 3 or row[0].startswith("#"):
+                    continue
+                try:
+                    start = self.parse_address(row[0])
+                    end = self.parse_address(row[1])
+                except ValueError:
+                    # Header or malformed row
+                    continue
+
+                country = row[2] or None
+                city = (row[3] if len(row) > 3 else "") or None
+                location = (country, city)
+                if location not in location_index:
+                    location_index[location] = len(self.locations)
+                    self.locations.append(location)
+
+                ranges[start.version].append(
+                    (int(start), int(end), location_index[location])
+                )
+
+        self.tables = {
+            4: IPRangeTable(ranges[4], "L"),
+            6: IPRangeTable(ranges[6], None),
+        }
+        logger.info(
+            "Loaded geolocation database %s: %s IPv4 and %s IPv6 ranges",
+            self.path,
+            len(self.tables[4]),
+            len(self.tables[6]),
+        )
+
+    @staticmethod
+    def parse_address(value):
+        """Parse an IP address given as text or as an integer"""
+        value = value.strip()
+        if value.isdigit():
+            number = int(value)
+            if number <= 0xFFFFFFFF:
+                return ipaddress.IPv4Address(number)
+            return ipaddress.IPv6Address(number)
+        return ipaddress.ip_address(value)
+
+    def lookup(self, ip_address):
+        try:
+            address = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return None
+
+        if self.reader is not None:
+            return self.lookup_mmdb(address)
+
+        table = self.tables.get(address.version)
+        if table is None:
+            return None
+        index = table.find(int(address))
+        if index is None:
+            return None
+        return self.locations[index]
+
+    def lookup_many(self, ip_addresses):
+        """
+        Like lookup for several addresses, but once the database is loaded
+        addresses it does not cover map to (None, None), its final answer.
+        """
+        if self.reader is None and not self.tables:
+            return {}
+        results = {}
+        for ip_address in ip_addresses:
+            results[ip_address] = self.lookup(ip_address) or (None, None)
+        return results
+
+    def lookup_mmdb(self, address):
+        """Look an address up in the MMDB file"""
+        record = self.reader.get(address)
+        if not record:
+            return None
+        country = record.get("country", {}).get("names", {}).get("en")
+        city = record.get("city", {}).get("names", {}).get("en")
+        return country, city
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent cache misses for the same key.
+
+    Within a process, only one thread per key does the work while the
+    others wait on an event. Across processes, the work is guarded by a
+    short lock taken with cache.add (SET NX on Redis). Callers that lose
+    the race wait briefly for the winner to fill the cache and give up
+    with None if it does not.
+    """
+
+    LOCK_PREFIX = "singleflight_"
+
+    def __init__(self, lock_timeout=5, wait_timeout=0.5, poll_interval=0.05):
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+        # Counters
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    def do(self, cache_key, fetch):
+        """
+        Return fetch() if this caller wins the key, otherwise the value the
+        winner stored under cache_key, or None if it did not arrive in time.
+        """
+        with self._lock:
+            event = self._inflight.get(cache_key)
+            is_leader = event is None
+            if is_leader:
+                event = self._inflight[cache_key] = threading.Event()
+
+        if not is_leader:
+            # Another thread in this process is already fetching
+            event.wait(self.wait_timeout)
+            return self._result(cache.get(cache_key))
+
+        try:
+            lock_key = f"{self.LOCK_PREFIX}{cache_key}"
+            if cache.add(lock_key, 1, self.lock_timeout):
+                self.leaders += 1
+                try:
+                    return fetch()
+                finally:
+                    cache.delete(lock_key)
+            return self._wait_for(cache_key)
+        finally:
+            with self._lock:
+                self._inflight.pop(cache_key, None)
+            event.set()
+
+    async def ado(self, cache_key, fetch):
+        """Async version of do; fetch must be a coroutine function"""
+        lock_key = f"{self.LOCK_PREFIX}{cache_key}"
+        if await cache.aadd(lock_key, 1, self.lock_timeout):
+            self.leaders += 1
+            try:
+                return await fetch()
+            finally:
+                await cache.adelete(lock_key)
+
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            result = await cache.aget(cache_key)
+            if result is not None:
+                return self._result(result)
+        return self._result(None)
+
+    def _wait_for(self, cache_key):
+        """Poll the cache until another process stores the result"""
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            result = cache.get(cache_key)
+            if result is not None:
+                return self._result(result)
+        return self._result(None)
+
+    def _result(self, result):
+        """Count a follower outcome"""
+        if result is None:
+            self.timeouts += 1
+        else:
+            self.coalesced += 1
+        return result
+
+    def stats(self):
+        """Return the coalescing counters"""
+        return {
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "timeouts": self.timeouts,
+        }
+
+
+class CircuitBreaker:
+    """
+    In-process circuit breaker for a remote dependency.
+
+    After failure_threshold consecutive failures the breaker opens and
+    allow() returns False without doing any I/O until reset_timeout has
+    passed. A single trial call is then let through (half-open): success
+    closes the breaker, failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_until = 0.0
+        self._lock = threading.Lock()
+
+        # Counters
+        self.trips = 0
+        self.short_circuited = 0
+
+    def allow(self):
+        """Whether a call may go through"""
+        if self.state == self.CLOSED:
+            return True
+        if time.monotonic() < self.opened_until:
+            self.short_circuited += 1
+            return False
+
+        with self._lock:
+            now = time.monotonic()
+            if now < self.opened_until:
+                self.short_circuited += 1
+                return False
+            # Let one trial call through, keep everyone else out meanwhile
+            self.state = self.HALF_OPEN
+            self.opened_until = now + self.reset_timeout
+            return True
+
+    def record_success(self):
+        """Close the breaker after a successful call"""
+        if self.state != self.CLOSED or self.failures:
+            with self._lock:
+                self.state = self.CLOSED
+                self.failures = 0
+
+    def record_failure(self):
+        """Count a failed call and open the breaker if needed"""
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                    logger.warning(
+                        "Geolocation circuit breaker opened for %ss after %s failures",
+                        self.reset_timeout,
+                        self.failures,
+                    )
+                self.state = self.OPEN
+                self.opened_until = time.monotonic() + self.reset_timeout
+
+    def stats(self):
+        """Return the breaker state and counters"""
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "trips": self.trips,
+            "short_circuited": self.short_circuited,
+        }
+
+
+class RateBudget:
+    """
+    Cluster-wide request budget shared through the cache (Redis).
+
+    Every process increments the same per-window counter, so the limit holds
+    across all workers. Once the window's budget is used up, acquire()
+    returns False until the next window starts.
+    """
+
+    KEY_PREFIX = "geolocation_budget_"
+
+    def __init__(self, limit, period=60):
+        self.limit = limit
+        self.period = period
+        self.denied = 0
+
+    def window_key(self):
+        """Cache key of the current window"""
+        return f"{self.KEY_PREFIX}{int(time.time() // self.period)}"
+
+    def acquire(self):
+        """Take one request from the budget"""
+        key = self.window_key()
+        cache.add(key, 0, self.period * 2)
+        try:
+            used = cache.incr(key)
+        except ValueError:
+            # The window expired between add and incr
+            cache.set(key, 1, self.period * 2)
+            used = 1
+        return self._check(used)
+
+    async def aacquire(self):
+        """Async version of acquire"""
+        key = self.window_key()
+        await cache.aadd(key, 0, self.period * 2)
+        try:
+            used = await cache.aincr(key)
+        except ValueError:
+            await cache.aset(key, 1, self.period * 2)
+            used = 1
+        return self._check(used)
+
+    def exhaust(self):
+        """Mark the current window as used up, e.g. after the API says so"""
+        cache.set(self.window_key(), self.limit, self.period * 2)
+
+    def _check(self, used):
+        if used > self.limit:
+            self.denied += 1
+            return False
+        return True
+
+    def stats(self):
+        """Return the budget usage for the current window"""
+        return {
+            "limit": self.limit,
+            "period": self.period,
+            "used": min(cache.get(self.window_key(), 0), self.limit),
+            "denied": self.denied,
+        }
+
+
+class HTTPBackend(BaseGeolocationBackend):
+    """
+    Resolve IP addresses through the ip-api.com HTTP API.
+
+    Results are cached so each address is only requested once per cache
+    period. Concurrent misses for the same address are coalesced so only
+    one request reaches the API; callers that do not get the result in time
+    fall back to (None, None).
+
+    Requests are governed by a cluster-wide RateBudget and a CircuitBreaker
+    that opens on timeouts and errors. When either refuses a call the lookup
+    returns (None, None) right away and nothing is cached, so the address is
+    retried once the API is usable again.
+    """
+
+    def __init__(self):
+        self.singleflight = SingleFlight()
+        self.breaker = CircuitBreaker()
+        self.budget = RateBudget(
+            getattr(settings, "IP_TRACKING_GEOLOCATION_RATE_LIMIT", 15)
+        )
+
+    def lookup(self, ip_address):
+        cache_key = f"{GEOLOCATION_CACHE_PREFIX}{ip_address}"
+
+        # Check cache first
+        cached_data = cache.get(cache_key)
+        if cached_data is not None:
+            return cached_data
+
+        # fetch() asks the breaker and the budget, once per request
+        result = self.singleflight.do(cache_key, lambda: self.fetch(ip_address))
+        return result if result is not None else (None, None)
+
+    async def alookup(self, ip_address):
+        cache_key = f"{GEOLOCATION_CACHE_PREFIX}{ip_address}"
+
+        cached_data = await cache.aget(cache_key)
+        if cached_data is not None:
+            return cached_data
+
+        result = await self.singleflight.ado(cache_key, lambda: self.afetch(ip_address))
+        return result if result is not None else (None, None)
+
+    def lookup_many(self, ip_addresses):
+        """
+        Resolve several IP addresses with one cache read and one batch
+        request per GEOLOCATION_BATCH_SIZE cache misses.
+        """
+        cache_keys = {
+            f"{GEOLOCATION_CACHE_PREFIX}{ip_address}": ip_address
+            for ip_address in ip_addresses
+        }
+        cached = cache.get_many(list(cache_keys))
+        results = {cache_keys[key]: value for key, value in cached.items()}
+
+        missing = [
+            ip_address for ip_address in ip_addresses if ip_address not in results
+        ]
+        for start in range(0, len(missing), GEOLOCATION_BATCH_SIZE):
+            results.update(
+                self.fetch_many(missing[start : start + GEOLOCATION_BATCH_SIZE])
+            )
+        return results
+
+    def fetch(self, ip_address):
+        """Fetch geolocation data for one IP address from the API"""
+        return self.fetch_many([ip_address]).get(ip_address)
+
+    def fetch_many(self, ip_addresses):
+        """
+        Fetch geolocation data for up to GEOLOCATION_BATCH_SIZE IP addresses
+        in a single request and cache every result.
+        Returns an empty dict when the breaker or the budget refuses the call
+        or the request fails.
+        """
+        if not self.breaker.allow() or not self.budget.acquire():
+            return {}
+
+        try:
+            response = get_http_session().post(
+                get_batch_api_url(),
+                json=ip_addresses,
+                timeout=GEOLOCATION_HTTP_TIMEOUT,
+            )
+            results = self.handle_response(
+                ip_addresses, response.status_code, response.headers, response.json
+            )
+        except requests.exceptions.Timeout:
+            logger.warning("Geolocation API timeout for %s IPs", len(ip_addresses))
+            self.breaker.record_failure()
+            return {}
+        except Exception as e:
+            logger.error(
+                "Failed to get geolocation for %s IPs: %s", len(ip_addresses), e
+            )
+            self.breaker.record_failure()
+            return {}
+
+        cache.set_many(
+            {
+                f"{GEOLOCATION_CACHE_PREFIX}{ip_address}": result
+                for ip_address, result in results.items()
+            },
+            GEOLOCATION_CACHE_TIMEOUT,
+        )
+        return results
+
+    async def afetch(self, ip_address):
+        """Async version of fetch"""
+        if not self.breaker.allow() or not await self.budget.aacquire():
+            return None
+
+        try:
+            response = await get_async_http_client().post(
+                get_batch_api_url(), json=[ip_address]
+            )
+            results = self.handle_response(
+                [ip_address], response.status_code, response.headers, response.json
+            )
+        except httpx.TimeoutException:
+            logger.warning("Geolocation API timeout for IP %s", ip_address)
+            self.breaker.record_failure()
+            return None
+        except Exception as e:
+            logger.error("Failed to get geolocation for IP %s: %s", ip_address, e)
+            self.breaker.record_failure()
+            return None
+
+        if ip_address not in results:
+            return None
+        result = results[ip_address]
+        await cache.aset(
+            f"{GEOLOCATION_CACHE_PREFIX}{ip_address}", result, GEOLOCATION_CACHE_TIMEOUT
+        )
+        return result
+
+    def handle_response(self, ip_addresses, status_code, headers, get_json):
+        """
+        Update the breaker and budget from an API response and parse it.
+        Returns an empty dict for unsuccessful responses.
+        """
+        # ip-api.com reports the requests left in the window in X-Rl
+        if headers.get("X-Rl") == "0" or status_code == 429:
+            self.budget.exhaust()
+
+        if status_code != 200:
+            logger.warning(
+                "Geolocation API returned status %s for %s IPs",
+                status_code,
+                len(ip_addresses),
+            )
+            self.breaker.record_failure()
+            return {}
+
+        results = parse_geolocation_batch(ip_addresses, get_json())
+        self.breaker.record_success()
+        return results
+
+    def stats(self):
+        return {
+            "circuit_breaker": self.breaker.stats(),
+            "rate_budget": self.budget.stats(),
+            "singleflight": self.singleflight.stats(),
+        }
+
+
+def get_geolocation_backends():
+    """
+    Return the backends listed in IP_TRACKING_GEOLOCATION_BACKENDS.
+    Backends are instantiated once per process.
+    """
+    global _backends  # pylint: disable=global-statement
+    if _backends is None:
+        with _backends_lock:
+            if _backends is None:
+                paths = getattr(
+                    settings,
+                    "IP_TRACKING_GEOLOCATION_BACKENDS",
+                    DEFAULT_GEOLOCATION_BACKENDS,
+                )
+                _backends = [import_string(path)() for path in paths]
+    return _backends
+
+
+def get_geolocation_stats():
+    """Return the metrics of every configured backend"""
+    return {
+        type(backend).__name__: backend.stats()
+        for backend in get_geolocation_backends()
+    }
+
+
+def get_geolocation(ip_address):
+    """
+    Get geolocation data (country and city) for an IP address.
+    Backends are tried in order until one of them knows the address.
+    """
+    # Skip geolocation for local/private IPs
+    if is_private_ip(ip_address):
+        return None, None
+
+    for backend in get_geolocation_backends():
+        result = backend.lookup(ip_address)
+        if result is not None and result != (None, None):
+            return result
+    return None, None
+
+
+async def aget_geolocation(ip_address):
+    """Async version of get_geolocation"""
+    if is_private_ip(ip_address):
+        return None, None
+
+    for backend in get_geolocation_backends():
+        result = await backend.alookup(ip_address)
+        if result is not None and result != (None, None):
+            return result
+    return None, None
+
+
+def get_geolocation_many(ip_addresses):
+    """
+    Batch version of get_geolocation.
+    Returns a dict of ip_address -> (country, city) for the addresses a
+    backend resolved; (None, None) means every backend answered that it
+    cannot resolve the address. Addresses a backend gave no answer for
+    (e.g. the HTTP backend's breaker is open or its budget is used up) are
+    left out so callers can retry them.
+    """
+    results = {}
+    pending = []
+    for ip_address in ip_addresses:
+        if is_private_ip(ip_address):
+            results[ip_address] = (None, None)
+        else:
+            pending.append(ip_address)
+
+    unresolved = set(pending)
+    for backend in get_geolocation_backends():
+        if not pending:
+            break
+        found = backend.lookup_many(pending)
+        for ip_address, result in found.items():
+            if result != (None, None):
+                results[ip_address] = result
+        unresolved.intersection_update(found)
+        pending = [ip_address for ip_address in pending if ip_address not in results]
+
+    for ip_address in pending:
+        if ip_address in unresolved:
+            results[ip_address] = (None, None)
+    return results
+
+
+def parse_geolocation_batch(ip_addresses, data):
+    """
+    Turn a batch geolocation API response into (country, city) tuples.
+    Returns a dict of ip_address -> result; addresses the API could not
+    resolve map to (None, None).
+    """
+    results = dict.fromkeys(ip_addresses, (None, None))
+    for ip_address, item in zip(ip_addresses, data):
+        # Each item echoes the address it answers in "query"
+        ip_address = item.get("query", ip_address)
+        if item.get("status") == "success":
+            results[ip_address] = (item.get("country"), item.get("city"))
+    return results
+
+
+def get_batch_api_url():
+    """Return the batch API URL, overridable for a local stub server"""
+    return getattr(
+        settings, "IP_TRACKING_GEOLOCATION_BATCH_API_URL", GEOLOCATION_BATCH_API_URL
+    )
+
+
+def get_http_session():
+    """
+    Return the shared HTTP session.
+    Connections are pooled and kept alive across lookups and batches.
+    """
+    global _http_session  # pylint: disable=global-statement
+    if _http_session is None:
+        with _backends_lock:
+            if _http_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _http_session = session
+    return _http_session
+
+
+def get_async_http_client():
+    """
+    Return the async HTTP client of the running event loop.
+    Connections are pooled and reused across requests in that loop.
+    """
+    return get_loop_client(
+        "geolocation_http",
+        lambda: httpx.AsyncClient(
+            timeout=GEOLOCATION_HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=100),
+        ),
+    )
+
+
+def is_private_ip(ip_address):
+    """
+    Check if an IP address is private/local.
+    """
+    if not ip_address:
+        return True
+
+    # Check for localhost
+    if ip_address in ["127.0.0.1", "::1", "localhost"]:
+        return True
+
+    # Check for private IPv4 ranges
+    parts = ip_address.split(".")
+    if len(parts) == 4:
+        try:
+            first_octet = int(parts[0])
+            second_octet = int(parts[1])
+
+            # 10.0.0.0/8
+            if first_octet == 10:
+                return True
+            # 172.16.0.0/12
+            if first_octet == 172 and 16 <= second_octet <= 31:
+                return True
+            # 192.168.0.0/16
+            if first_octet == 192 and second_octet == 168:
+                return True
+        except ValueError:
+            pass
+
+    return False
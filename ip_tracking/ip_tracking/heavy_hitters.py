@@ -0,0 +1,323 @@
+import atexit
+import hashlib
+import heapq
+import logging
+import threading
+import time
+import redis
+from django.conf import settings
+from .redis_utils import get_redis
+
+logger = logging.getLogger(__name__)
+
+HEAVY_HITTERS_KEY_PREFIX = "ip_tracking:heavy_hitters:"
+HEAVY_HITTERS_WINDOW = 3600  # Seconds per sketch, matching detect_anomalies
+HEAVY_HITTERS_MERGE_INTERVAL = 5.0  # Seconds between merges into Redis
+SKETCH_WIDTH = 2048
+SKETCH_DEPTH = 4
+TOP_K = 100
+
+
+def use_heavy_hitters():
+    """Whether the middleware feeds the heavy-hitter tracker"""
+    return getattr(settings, "IP_TRACKING_HEAVY_HITTERS_ENABLED", False)
+
+
+class CountMinSketch:
+    """
+    Approximate item counts in a fixed depth x width counter table.
+
+    Every item increments one counter per row and its estimate is the
+    smallest of those counters, so estimates never undercount and overcount
+    by at most about total / width with high probability. Column positions
+    come from one blake2b digest by double hashing, like BloomFilter, so
+    they are the same in every process and sketches can be added together.
+    """
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.rows = [[0] * width for _ in range(depth)]
+        self.total = 0
+
+    def positions(self, item):
+        """Column of the item in each row"""
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.width for i in range(self.depth)]
+
+    def add(self, item, count=1):
+        """Count an item, returns its new estimate"""
+        estimate = None
+        for row, position in zip(self.rows, self.positions(item)):
+            row[position] += count
+            if estimate is None or row[position] < estimate:
+                estimate = row[position]
+        self.total += count
+        return estimate
+
+    def estimate(self, item):
+        """Estimated count of an item"""
+        return min(row[p] for row, p in zip(self.rows, self.positions(item)))
+
+    def cells(self):
+        """Non-zero counters as (row, column, count)"""
+        for index, row in enumerate(self.rows):
+            for position, count in enumerate(row):
+                if count:
+                    yield index, position, count
+
+
+class TopK:
+    """
+    The k items with the largest estimates seen so far.
+
+    Estimates live in a dict and a min-heap; heap entries made stale by
+    later updates are skipped when the smallest item is evicted and
+    dropped when the heap is rebuilt, so updates are O(log k).
+    """
+
+    def __init__(self, k=TOP_K):
+        self.k = k
+        self.items = {}
+        self.heap = []
+
+    def offer(self, item, estimate):
+        """Record the latest estimate of an item"""
+        if item not in self.items and len(self.items) >= self.k:
+            self._discard_stale()
+            if estimate <= self.heap[0][0]:
+                return
+            _, evicted = heapq.heappop(self.heap)
+            del self.items[evicted]
+
+        self.items[item] = estimate
+        heapq.heappush(self.heap, (estimate, item))
+        if len(self.heap) > 4 * self.k:
+            self.heap = [(value, key) for key, value in self.items.items()]
+            heapq.heapify(self.heap)
+
+    def _discard_stale(self):
+        heap, items = self.heap, self.items
+        while heap and items.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def most_common(self):
+        """Items and estimates, largest first"""
+        return sorted(self.items.items(), key=lambda item: item[1], reverse=True)
+
+
+# pylint: disable=broad-exception-caught
+class HeavyHitterTracker:
+    """
+    Approximate per-IP request counts with bounded memory.
+
+    Each process counts requests in a local Count-Min Sketch and keeps a
+    local top-K, without any I/O on the request path. A background thread
+    adds the sketch to the window's shared sketch (a Redis hash of
+    "<row>:<column>" counters) every merge_interval seconds, and once more
+    when the process exits, and writes the local top talkers to the
+    window's sorted set with their cluster-wide estimates, which HINCRBY
+    returns in the same pipeline.
+    """
+
+    def __init__(
+        self,
+        width=SKETCH_WIDTH,
+        depth=SKETCH_DEPTH,
+        k=TOP_K,
+        window=HEAVY_HITTERS_WINDOW,
+        merge_interval=HEAVY_HITTERS_MERGE_INTERVAL,
+    ):
+        self.width = width
+        self.depth = depth
+        self.k = k
+        self.window = window
+        self.merge_interval = merge_interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._reset()
+
+        # Counters
+        self.tracked = 0
+        self.merges = 0
+        self.errors = 0
+
+    @classmethod
+    def from_settings(cls):
+        """Build a tracker from the IP_TRACKING_HEAVY_HITTERS_* settings"""
+        return cls(
+            width=getattr(settings, "IP_TRACKING_HEAVY_HITTERS_WIDTH", SKETCH_WIDTH),
+            depth=getattr(settings, "IP_TRACKING_HEAVY_HITTERS_DEPTH", SKETCH_DEPTH),
+            k=getattr(settings, "IP_TRACKING_HEAVY_HITTERS_TOP_K", TOP_K),
+            window=getattr(
+                settings, "IP_TRACKING_HEAVY_HITTERS_WINDOW", HEAVY_HITTERS_WINDOW
+            ),
+            merge_interval=getattr(
+                settings,
+                "IP_TRACKING_HEAVY_HITTERS_MERGE_INTERVAL",
+                HEAVY_HITTERS_MERGE_INTERVAL,
+            ),
+        )
+
+    def _reset(self):
+        self.sketch = CountMinSketch(self.width, self.depth)
+        self.top = TopK(self.k)
+
+    def keys(self, window):
+        """Redis hash and sorted set of a window"""
+        return (
+            f"{HEAVY_HITTERS_KEY_PREFIX}sketch:{window}",
+            f"{HEAVY_HITTERS_KEY_PREFIX}top:{window}",
+        )
+
+    def current_window(self):
+        """Index of the window the current time falls in"""
+        return int(time.time() // self.window)
+
+    def add(self, ip_address):
+        """Count one request in the local sketch"""
+        with self._lock:
+            self.top.offer(ip_address, self.sketch.add(ip_address))
+            self.tracked += 1
+
+    def track(self, ip_address):
+        """Count one request; the background thread merges it into Redis"""
+        self.add(ip_address)
+        self._ensure_merger()
+
+    async def atrack(self, ip_address):
+        """Async version of track, which does no I/O either"""
+        self.track(ip_address)
+
+    def _take(self):
+        """Swap out the local sketch and top-K for a merge"""
+        with self._lock:
+            sketch, top = self.sketch, self.top
+            self._reset()
+        return sketch, top
+
+    def _ensure_merger(self):
+        """Start the background merge thread on first use"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="heavy-hitter-merger", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        """Merge the local counts every merge_interval seconds"""
+        while True:
+            time.sleep(self.merge_interval)
+            self.merge()
+
+    def _queue_merge(self, pipeline, sketch):
+        sketch_key, _ = self.keys(self.current_window())
+        fields = []
+        for row, position, count in sketch.cells():
+            field = f"{row}:{position}"
+            pipeline.hincrby(sketch_key, field, count)
+            fields.append(field)
+        pipeline.expire(sketch_key, self.window * 2)
+        return fields
+
+    def _queue_top(self, pipeline, sketch, top, fields, results):
+        """Write the local top talkers with their cluster-wide estimates"""
+        _, top_key = self.keys(self.current_window())
+        merged = dict(zip(fields, results))
+        scores = {
+            ip_address: min(
+                merged[f"{row}:{position}"]
+                for row, position in enumerate(sketch.positions(ip_address))
+            )
+            for ip_address, _ in top.most_common()
+        }
+        if scores:
+            pipeline.zadd(top_key, scores, gt=True)
+            pipeline.zremrangebyrank(top_key, 0, -self.k - 1)
+            pipeline.expire(top_key, self.window * 2)
+
+    def merge(self):
+        """Add the local counts to the shared sketch and top-K"""
+        sketch, top = self._take()
+        if not sketch.total:
+            return
+        client = get_redis()
+        try:
+            pipeline = client.pipeline(transaction=False)
+            fields = self._queue_merge(pipeline, sketch)
+            results = pipeline.execute()
+            pipeline = client.pipeline(transaction=False)
+            self._queue_top(pipeline, sketch, top, fields, results)
+            pipeline.execute()
+        except redis.RedisError as e:
+            self._merge_failed(e)
+            return
+        with self._lock:
+            self.merges += 1
+
+    def _merge_failed(self, error):
+        # The counts of the failed merge are lost, estimates stay approximate
+        with self._lock:
+            self.errors += 1
+        logger.error("Failed to merge heavy hitters into Redis: %s", error)
+
+    def top_talkers(self, limit=None, windows=1):
+        """
+        Cluster-wide top talkers as (ip_address, estimate), largest first.
+        With windows=2 the previous window's counts are added, covering at
+        least the last full window.
+        """
+        current = self.current_window()
+        pipeline = get_redis().pipeline(transaction=False)
+        for window in range(current - windows + 1, current + 1):
+            pipeline.zrange(self.keys(window)[1], 0, -1, withscores=True)
+        totals = {}
+        for entries in pipeline.execute():
+            for ip_address, score in entries:
+                totals[ip_address] = totals.get(ip_address, 0) + int(score)
+        talkers = sorted(totals.items(), key=lambda item: item[1], reverse=True)
+        return talkers[:limit] if limit else talkers
+
+    def candidates(self, min_count):
+        """
+        IP addresses that may have made more than min_count requests within
+        the last window. Sketch estimates never undercount, so only IPs
+        that never made it into any worker's top-K can be missed.
+        """
+        return [
+            ip_address
+            for ip_address, estimate in self.top_talkers(windows=2)
+            if estimate > min_count
+        ]
+
+    def stats(self):
+        """Return the tracker counters"""
+        with self._lock:
+            return {
+                "tracked": self.tracked,
+                "merges": self.merges,
+                "errors": self.errors,
+                "local_total": self.sketch.total,
+                "local_top": len(self.top.items),
+            }
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_heavy_hitter_tracker():
+    """Return the process-wide heavy-hitter tracker"""
+    global _tracker  # pylint: disable=global-statement
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                _tracker = HeavyHitterTracker.from_settings()
+                atexit.register(_tracker.merge)
+    return _tracker
@@ -0,0 +1,243 @@
+import logging
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Max, Min, Q, Value, Window
+from django.db.models.functions import Lag, TruncMinute
+from django.utils import timezone
+from .models import DetectionCounter, DetectionState, RequestLog
+from .rules import get_detection_plan, window_start
+
+logger = logging.getLogger(__name__)
+
+DETECTION_STATE_NAME = "anomaly_detection"
+DETECTION_BATCH_SIZE = 100000  # New request logs read per run at most
+COUNTER_BATCH_SIZE = 1000
+GAP_TIMEOUT = 600  # Seconds an unused id is waited for
+MAX_GAPS = 1000  # Id ranges waited for at most
+
+
+def use_incremental_detection():
+    """Whether detection runs incrementally instead of hourly"""
+    return getattr(settings, "IP_TRACKING_INCREMENTAL_DETECTION", False)
+
+
+# pylint: disable=no-member
+class IncrementalDetector:
+    """
+    Anomaly detection that only reads request logs it has not seen yet.
+
+    Each run aggregates the RequestLog rows above the stored watermark into
+    per-IP, per-rule minute counters (DetectionCounter), moves the watermark
+    and drops counters older than the longest rule window. Only IPs with
+    new rows can newly exceed a threshold, so the run then sums the
+    counters of those IPs alone. The cost of a run follows the number of
+    new rows, not the size of the window.
+
+    The watermark is a RequestLog id rather than a timestamp, so rows saved
+    late (buffered or streamed sinks) are still counted in their minute.
+    Ids are not committed in order, though: a transaction can still hold an
+    id below the watermark when a run moves past it. Every run therefore
+    records the unused ids below the new watermark as gaps, and later runs
+    count the rows that appear in them. Rows are only ever counted once,
+    either as new rows or as gap fillers. Gaps are given up after
+    gap_timeout seconds, by which time their transactions have rolled back.
+    """
+
+    def __init__(
+        self, plan=None, name=DETECTION_STATE_NAME, batch_size=None, gap_timeout=None
+    ):
+        self.plan = plan or get_detection_plan()
+        self.name = name
+        self.batch_size = batch_size or getattr(
+            settings,
+            "IP_TRACKING_INCREMENTAL_DETECTION_BATCH_SIZE",
+            DETECTION_BATCH_SIZE,
+        )
+        self.gap_timeout = gap_timeout or getattr(
+            settings, "IP_TRACKING_INCREMENTAL_DETECTION_GAP_TIMEOUT", GAP_TIMEOUT
+        )
+
+    def run(self, now=None):
+        """
+        Process new request logs and the rows committed into earlier gaps.
+        Returns get_anomaly_counts-style rows for the IPs seen in them.
+        """
+        now = now or timezone.now()
+        with transaction.atomic():
+            state = self.get_state(now)
+            last_log_id = state.last_log_id
+            upper = self.next_watermark(last_log_id)
+
+            # Ids are read before the rows are counted, so a row committed
+            # in between is either a gap filler now or left in its gap
+            gaps = self.expire_gaps(state.gaps, now)
+            filled_ids = self.filled_ids(gaps)
+            new_gaps = []
+            condition = Q(id__in=filled_ids)
+            if upper is not None:
+                new_gaps = self.find_gaps(last_log_id, upper, now)
+                condition |= Q(id__gt=last_log_id, id__lte=upper) & ~gap_filter(
+                    new_gaps
+                )
+
+            logs = RequestLog.objects.filter(condition)
+            if upper is not None or filled_ids:
+                self.store_counters(logs, now)
+                state.last_log_id = upper or last_log_id
+                state.gaps = (split_gaps(gaps, filled_ids) + new_gaps)[-MAX_GAPS:]
+                state.save(update_fields=["last_log_id", "gaps", "updated_at"])
+            elif len(gaps) != len(state.gaps):
+                state.gaps = gaps
+                state.save(update_fields=["gaps", "updated_at"])
+            self.prune(now)
+
+        if upper is None and not filled_ids:
+            return []
+        logger.info(
+            "Incremental detection read request logs %s to %s and %s gap fillers",
+            last_log_id + 1,
+            upper or last_log_id,
+            len(filled_ids),
+        )
+        return self.plan.counter_aggregate(now, logs.values("ip_address").distinct())
+
+    def get_state(self, now):
+        """
+        Lock the watermark row for this run. A new watermark starts just
+        before the first request log within the longest rule window.
+        """
+        state, created = DetectionState.objects.get_or_create(name=self.name)
+        if created:
+            logs = RequestLog.objects.aggregate(
+                first_recent=Min(
+                    "id",
+                    filter=Q(timestamp__gte=window_start(now, self.plan.max_window)),
+                ),
+                last=Max("id"),
+            )
+            if logs["first_recent"] is not None:
+                state.last_log_id = logs["first_recent"] - 1
+            else:
+                state.last_log_id = logs["last"] or 0
+            state.save(update_fields=["last_log_id"])
+        return DetectionState.objects.select_for_update().get(pk=state.pk)
+
+    def next_watermark(self, last_log_id):
+        """Id of the last request log of this run, None if there are none"""
+        new_ids = RequestLog.objects.filter(id__gt=last_log_id).order_by("id")
+        batch_end = list(
+            new_ids.values_list("id", flat=True)[self.batch_size - 1 : self.batch_size]
+        )
+        if batch_end:
+            return batch_end[0]
+        return new_ids.aggregate(last=Max("id"))["last"]
+
+    def find_gaps(self, last_log_id, upper, now):
+        """
+        Unused id ranges in (last_log_id, upper], from the ids next to each
+        other that differ by more than one. upper itself is a row's id.
+        """
+        previous = Window(Lag("id", default=Value(last_log_id)), order_by=F("id").asc())
+        rows = (
+            RequestLog.objects.filter(id__gt=last_log_id, id__lte=upper)
+            .annotate(previous_id=previous)
+            .filter(id__gt=F("previous_id") + 1)
+            .values_list("previous_id", "id")
+        )
+        seen = now.timestamp()
+        return [[previous_id + 1, log_id - 1, seen] for previous_id, log_id in rows]
+
+    def expire_gaps(self, gaps, now):
+        """Gaps still worth waiting for"""
+        cutoff = now.timestamp() - self.gap_timeout
+        kept = [gap for gap in gaps if gap[2] >= cutoff]
+        if len(kept) != len(gaps):
+            logger.debug("Gave up on %s request log id gaps", len(gaps) - len(kept))
+        return kept
+
+    def filled_ids(self, gaps):
+        """Ids of the request logs committed into gaps since they were seen"""
+        if not gaps:
+            return []
+        return list(
+            RequestLog.objects.filter(gap_filter(gaps)).values_list("id", flat=True)
+        )
+
+    def store_counters(self, new_logs, now):
+        """
+        Add new request logs to the minute counters, one GROUP BY over the
+        new rows and one bulk statement each for new and existing counters.
+        """
+        rows = (
+            new_logs.filter(timestamp__gte=window_start(now, self.plan.max_window))
+            .annotate(bucket=TruncMinute("timestamp"))
+            .values("ip_address", "bucket")
+            .annotate(
+                **{
+                    rule.name: Count("id", filter=rule.path_filter() or None)
+                    for rule in self.plan.rules
+                }
+            )
+            .order_by()
+        )
+        increments = {}
+        for row in rows:
+            for rule in self.plan.rules:
+                if row[rule.name]:
+                    key = (row["ip_address"], rule.name, row["bucket"])
+                    increments[key] = row[rule.name]
+        if not increments:
+            return
+
+        buckets = {bucket for _, _, bucket in increments}
+        existing = {
+            (counter.ip_address, counter.rule, counter.bucket): counter
+            for counter in DetectionCounter.objects.filter(
+                bucket__in=buckets, ip_address__in=new_logs.values("ip_address")
+            )
+        }
+        created, updated = [], []
+        for (ip_address, rule, bucket), count in increments.items():
+            counter = existing.get((ip_address, rule, bucket))
+            if counter is None:
+                created.append(
+                    DetectionCounter(
+                        ip_address=ip_address, rule=rule, bucket=bucket, count=count
+                    )
+                )
+            else:
+                counter.count = F("count") + count
+                updated.append(counter)
+        DetectionCounter.objects.bulk_create(created, batch_size=COUNTER_BATCH_SIZE)
+        DetectionCounter.objects.bulk_update(
+            updated, ["count"], batch_size=COUNTER_BATCH_SIZE
+        )
+
+    def prune(self, now):
+        """Drop counters that no rule window reaches anymore"""
+        DetectionCounter.objects.filter(
+            bucket__lt=window_start(now, self.plan.max_window)
+        ).delete()
+
+
+def gap_filter(gaps):
+    """Q matching the ids of [first id, last id, first seen] gaps"""
+    condition = Q()
+    for first, last, _ in gaps:
+        condition |= Q(id__range=(first, last))
+    return condition
+
+
+def split_gaps(gaps, filled_ids):
+    """Remove the filled ids from gaps, splitting the ranges around them"""
+    filled_ids = sorted(filled_ids)
+    remaining = []
+    for first, last, seen in gaps:
+        for log_id in filled_ids:
+            if first <= log_id <= last:
+                if log_id > first:
+                    remaining.append([first, log_id - 1, seen])
+                first = log_id + 1
+        if first <= last:
+            remaining.append([first, last, seen])
+    return remaining
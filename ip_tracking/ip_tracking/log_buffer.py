@@ -0,0 +1,226 @@
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+from django.conf import settings
+from django.db import (
+    InterfaceError,
+    OperationalError,
+    close_old_connections,
+    transaction,
+)
+from .models import RequestLog
+
+logger = logging.getLogger(__name__)
+
+# Errors that fail every row, e.g. a lost connection, rather than one row
+UNAVAILABLE_ERRORS = (InterfaceError, OperationalError)
+
+
+# pylint: disable=broad-exception-caught
+# pylint: disable=no-member
+def save_request_logs(entries, batch_size):
+    """
+    Write unsaved RequestLog rows with bulk_create. If the database rejects
+    the batch, the rows are saved one at a time and the rejected ones are
+    logged and skipped, so a single bad row cannot hold back the others.
+    Stops at the first error that means the database is unavailable.
+    Returns (rows written, rows rejected, entries not yet written).
+    """
+    try:
+        with transaction.atomic():
+            RequestLog.objects.bulk_create(entries, batch_size=batch_size)
+        return len(entries), 0, []
+    except UNAVAILABLE_ERRORS as e:
+        logger.error("Failed to write %s request logs: %s", len(entries), e)
+        return 0, 0, entries
+    except Exception as e:
+        logger.warning("Request log batch rejected, saving rows one at a time: %s", e)
+
+    written = rejected = 0
+    for index, log_entry in enumerate(entries):
+        log_entry.pk = None  # Set by the rolled back bulk_create
+        try:
+            with transaction.atomic():
+                log_entry.save(force_insert=True)
+        except UNAVAILABLE_ERRORS as e:
+            logger.error("Failed to write %s request logs: %s", len(entries) - index, e)
+            return written, rejected, entries[index:]
+        except Exception as e:
+            rejected += 1
+            logger.error(
+                "Dropped request log of %s for %r: %s",
+                log_entry.ip_address,
+                log_entry.path,
+                e,
+            )
+        else:
+            written += 1
+    return written, rejected, []
+
+
+class RequestLogBuffer:
+    """
+    Bounded per-process buffer of RequestLog rows.
+
+    Requests only append to an in-memory queue. A background thread writes
+    the queued rows with a single bulk_create once the batch size or the
+    maximum age is reached, and once more when the process exits. Rows the
+    database rejects are dropped (see save_request_logs); the rest of a
+    failed flush is re-queued.
+    """
+
+    def __init__(self, batch_size=500, max_age=2.0, max_pending=10000):
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.max_pending = max_pending
+
+        self._entries = deque()
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+        # Counters
+        self.buffered = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.failed = 0
+        self.flushes = 0
+
+    @classmethod
+    def from_settings(cls):
+        """Build a buffer from the IP_TRACKING_LOG_BUFFER_* settings"""
+        return cls(
+            batch_size=getattr(settings, "IP_TRACKING_LOG_BUFFER_BATCH_SIZE", 500),
+            max_age=getattr(settings, "IP_TRACKING_LOG_BUFFER_MAX_AGE", 2.0),
+            max_pending=getattr(settings, "IP_TRACKING_LOG_BUFFER_MAX_PENDING", 10000),
+        )
+
+    def add(self, log_entry):
+        """
+        Queue an unsaved RequestLog instance.
+        Returns False if the buffer is full and the entry was dropped.
+        """
+        with self._lock:
+            if len(self._entries) >= self.max_pending:
+                self.dropped += 1
+                return False
+
+            if not self._entries:
+                self._oldest = time.monotonic()
+            self._entries.append(log_entry)
+            self.buffered += 1
+            pending = len(self._entries)
+
+        self._ensure_flusher()
+        if pending >= self.batch_size:
+            self._wake.set()
+        return True
+
+    def drain(self):
+        """Remove and return all queued entries"""
+        with self._lock:
+            entries = list(self._entries)
+            self._entries.clear()
+            self._oldest = None
+        return entries
+
+    def requeue(self, entries):
+        """
+        Put entries from a failed flush back in front of the queue, as far
+        as max_pending allows. The rest are counted as dropped.
+        Returns the number of entries re-queued.
+        """
+        with self._lock:
+            room = max(self.max_pending - len(self._entries), 0)
+            kept = entries[:room]
+            self._entries.extendleft(reversed(kept))
+            self.dropped += len(entries) - len(kept)
+            if kept and self._oldest is None:
+                # Retried once the entries are max_age old again
+                self._oldest = time.monotonic()
+        return len(kept)
+
+    def flush(self):
+        """
+        Write all queued entries to the database in one bulk_create.
+        Rows the database rejects are dropped. If the database is
+        unavailable, the unwritten entries are re-queued for the next flush.
+        Returns the number of rows written.
+        """
+        entries = self.drain()
+        if not entries:
+            return 0
+
+        written, rejected, unsaved = save_request_logs(entries, self.batch_size)
+        requeued = self.requeue(unsaved) if unsaved else 0
+        with self._lock:
+            self.flushed += written
+            self.rejected += rejected
+            self.failed += len(unsaved)
+            self.flushes += 1 if not unsaved else 0
+        if unsaved:
+            logger.error("Re-queued %s request logs", requeued)
+        else:
+            logger.debug("Flushed %s request logs", written)
+        return written
+
+    def stats(self):
+        """Return the buffer counters"""
+        with self._lock:
+            return {
+                "pending": len(self._entries),
+                "buffered": self.buffered,
+                "flushed": self.flushed,
+                "dropped": self.dropped,
+                "rejected": self.rejected,
+                "failed": self.failed,
+                "flushes": self.flushes,
+            }
+
+    def _ensure_flusher(self):
+        """Start the background flush thread on first use"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="request-log-flusher", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        """Flush whenever the batch is full or the oldest entry is too old"""
+        while True:
+            self._wake.wait(timeout=self.max_age)
+            self._wake.clear()
+
+            with self._lock:
+                pending = len(self._entries)
+                oldest = self._oldest
+            if not pending:
+                continue
+
+            age = time.monotonic() - oldest
+            if pending >= self.batch_size or age >= self.max_age:
+                close_old_connections()
+                self.flush()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_request_log_buffer():
+    """Return the process-wide request log buffer"""
+    global _buffer  # pylint: disable=global-statement
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = RequestLogBuffer.from_settings()
+                atexit.register(_buffer.flush)
+    return _buffer
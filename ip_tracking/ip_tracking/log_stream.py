@@ -0,0 +1,274 @@
+import logging
+import os
+import socket
+import threading
+from datetime import datetime
+import redis
+from django.conf import settings
+from .log_buffer import save_request_logs
+from .models import RequestLog
+from .redis_utils import get_async_redis, get_redis
+
+logger = logging.getLogger(__name__)
+
+LOG_STREAM_KEY = "ip_tracking:request_logs"
+LOG_STREAM_GROUP = "request-log-writers"
+LOG_STREAM_FIELDS = ("ip_address", "path", "country", "city")
+
+
+# pylint: disable=broad-exception-caught
+# pylint: disable=no-member
+class RequestLogStream:
+    """
+    Redis Stream of RequestLog rows.
+
+    Requests append one entry each with XADD and never touch the database.
+    Consumers in a consumer group read the stream in large batches, write
+    each batch with a single bulk_create and acknowledge it afterwards, so
+    a crashed consumer's entries stay pending and are claimed again. Rows
+    the database rejects are logged and acknowledged, so they cannot stall
+    the group.
+
+    The stream is capped at roughly maxlen entries. Entries trimmed before
+    a consumer reads them are lost, which the group lag shows early.
+    """
+
+    def __init__(
+        self,
+        stream=LOG_STREAM_KEY,
+        group=LOG_STREAM_GROUP,
+        maxlen=1000000,
+        batch_size=1000,
+        claim_idle_time=60000,
+    ):
+        self.stream = stream
+        self.group = group
+        self.maxlen = maxlen
+        self.batch_size = batch_size
+        self.claim_idle_time = claim_idle_time
+        self._group_ready = False
+        self._lock = threading.Lock()
+
+        # Counters
+        self.added = 0
+        self.failed = 0
+        self.consumed = 0
+        self.rejected = 0
+        self.write_errors = 0
+
+    @classmethod
+    def from_settings(cls):
+        """Build a stream from the IP_TRACKING_LOG_STREAM_* settings"""
+        return cls(
+            stream=getattr(settings, "IP_TRACKING_LOG_STREAM_KEY", LOG_STREAM_KEY),
+            group=getattr(settings, "IP_TRACKING_LOG_STREAM_GROUP", LOG_STREAM_GROUP),
+            maxlen=getattr(settings, "IP_TRACKING_LOG_STREAM_MAXLEN", 1000000),
+            batch_size=getattr(settings, "IP_TRACKING_LOG_STREAM_BATCH_SIZE", 1000),
+        )
+
+    def entry_fields(self, log_entry):
+        """Serialize an unsaved RequestLog instance to stream fields"""
+        fields = {"timestamp": log_entry.timestamp.isoformat()}
+        for name in LOG_STREAM_FIELDS:
+            value = getattr(log_entry, name)
+            if value is not None:
+                fields[name] = value
+        return fields
+
+    def add(self, log_entry):
+        """
+        Append an unsaved RequestLog instance to the stream.
+        Returns False if the entry could not be added.
+        """
+        try:
+            get_redis().xadd(
+                self.stream,
+                self.entry_fields(log_entry),
+                maxlen=self.maxlen,
+                approximate=True,
+            )
+        except redis.RedisError as e:
+            return self._add_failed(e)
+        with self._lock:
+            self.added += 1
+        return True
+
+    async def aadd(self, log_entry):
+        """Async version of add"""
+        try:
+            await get_async_redis().xadd(
+                self.stream,
+                self.entry_fields(log_entry),
+                maxlen=self.maxlen,
+                approximate=True,
+            )
+        except redis.RedisError as e:
+            return self._add_failed(e)
+        with self._lock:
+            self.added += 1
+        return True
+
+    def _add_failed(self, error):
+        with self._lock:
+            self.failed += 1
+        logger.error("Failed to add request log to stream: %s", error)
+        return False
+
+    def ensure_group(self):
+        """Create the consumer group (and the stream) if they do not exist"""
+        if self._group_ready:
+            return
+        try:
+            get_redis().xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._group_ready = True
+
+    def read(self, consumer, block=None):
+        """
+        Read up to batch_size new entries for consumer.
+        Blocks for up to block milliseconds when the stream is empty.
+        """
+        self.ensure_group()
+        response = get_redis().xreadgroup(
+            self.group, consumer, {self.stream: ">"}, count=self.batch_size, block=block
+        )
+        return response[0][1] if response else []
+
+    def claim(self, consumer):
+        """
+        Take over entries another consumer read but never acknowledged
+        within claim_idle_time milliseconds, e.g. because it crashed.
+        """
+        self.ensure_group()
+        response = get_redis().xautoclaim(
+            self.stream,
+            self.group,
+            consumer,
+            self.claim_idle_time,
+            start_id="0-0",
+            count=self.batch_size,
+        )
+        return response[1]
+
+    def write(self, entries):
+        """
+        Write a batch of stream entries with one bulk_create and acknowledge
+        them. Entries that cannot be parsed or that the database rejects are
+        logged and acknowledged so they do not block the stream.
+        Returns the number of rows written, or None if the database was
+        unavailable. Only the entries written so far are acknowledged then.
+        """
+        if not entries:
+            return 0
+
+        logs = []
+        log_entry_ids = []
+        for entry_id, fields in entries:
+            if not fields:
+                # Trimmed from the stream while pending
+                continue
+            try:
+                logs.append(
+                    RequestLog(
+                        timestamp=datetime.fromisoformat(fields["timestamp"]),
+                        ip_address=fields["ip_address"],
+                        path=fields.get("path", ""),
+                        country=fields.get("country"),
+                        city=fields.get("city"),
+                    )
+                )
+            except (KeyError, ValueError) as e:
+                logger.warning("Skipping malformed stream entry %s: %s", entry_id, e)
+            else:
+                log_entry_ids.append(entry_id)
+
+        written, rejected, unsaved = save_request_logs(logs, self.batch_size)
+        # The unwritten entries are always the last ones of the batch
+        pending = set(log_entry_ids[len(logs) - len(unsaved) :])
+        entry_ids = [
+            entry_id
+            for entry_id, _ in entries
+            if entry_id is not None and entry_id not in pending
+        ]
+        if entry_ids:
+            get_redis().xack(self.stream, self.group, *entry_ids)
+        with self._lock:
+            self.consumed += written
+            self.rejected += rejected
+            self.write_errors += 1 if unsaved else 0
+        return None if unsaved else written
+
+    def consume(self, consumer=None, max_batches=None, block=None):
+        """
+        Move entries from the stream to the database until it is drained,
+        max_batches batches were written or a write fails.
+        Returns the number of rows written.
+        """
+        consumer = consumer or get_consumer_name()
+        written = 0
+        batches = 0
+        entries = self.claim(consumer)
+        while max_batches is None or batches < max_batches:
+            if not entries:
+                entries = self.read(consumer, block=block)
+                if not entries:
+                    break
+            count = self.write(entries)
+            if count is None:
+                break
+            written += count
+            batches += 1
+            entries = None
+        return written
+
+    def lag(self):
+        """
+        Return the stream length and the consumer group's pending entries
+        and lag (entries not yet delivered to any consumer).
+        """
+        self.ensure_group()
+        client = get_redis()
+        info = {"length": client.xlen(self.stream), "pending": 0, "lag": None}
+        for group in client.xinfo_groups(self.stream):
+            if group["name"] == self.group:
+                info["pending"] = group["pending"]
+                info["lag"] = group.get("lag")
+                info["consumers"] = group["consumers"]
+        return info
+
+    def stats(self):
+        """Return the stream counters and the consumer lag"""
+        with self._lock:
+            data = {
+                "added": self.added,
+                "failed": self.failed,
+                "consumed": self.consumed,
+                "rejected": self.rejected,
+                "write_errors": self.write_errors,
+            }
+        try:
+            data.update(self.lag())
+        except redis.RedisError as e:
+            data["error"] = str(e)
+        return data
+
+
+def get_consumer_name():
+    """Consumer name unique to this host and process"""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+_stream = None
+_stream_lock = threading.Lock()
+
+
+def get_request_log_stream():
+    """Return the process-wide request log stream"""
+    global _stream  # pylint: disable=global-statement
+    if _stream is None:
+        with _stream_lock:
+            if _stream is None:
+                _stream = RequestLogStream.from_settings()
+    return _stream
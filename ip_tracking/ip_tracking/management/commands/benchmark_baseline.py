@@ -0,0 +1,81 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from ip_tracking.baseline import (
+    HISTORY_SLOTS,
+    TOTAL_FEATURE,
+    StatisticalBaseline,
+    TrafficMatrix,
+    np,
+)
+
+
+class Command(BaseCommand):
+    """Statistical baseline benchmark"""
+
+    help = (
+        "Score synthetic hourly traffic of many IPs with the vectorized "
+        "statistical baseline and report the time taken"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--ips",
+            type=int,
+            default=1000000,
+            help="Number of distinct client IP addresses",
+        )
+        parser.add_argument(
+            "--paths",
+            type=int,
+            default=2,
+            help="Number of path features besides the request totals",
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            help="Random seed of the synthetic traffic",
+        )
+
+    def handle(self, *args, **options):
+        if np is None:
+            raise CommandError("The numpy package is required for baselines")
+
+        traffic = self.synthetic_traffic(
+            options["ips"], options["paths"], options["seed"]
+        )
+        baseline = StatisticalBaseline()
+
+        start = time.perf_counter()
+        outliers = baseline.outliers(traffic)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f"{options['ips']:,} IPs x {HISTORY_SLOTS + 1} hours x "
+            f"{len(traffic.features)} features: {elapsed:.2f}s, "
+            f"{len(outliers)} outliers"
+        )
+
+    def synthetic_traffic(self, ips, paths, seed):
+        """Poisson traffic with a few injected spikes and slow attackers"""
+        rng = np.random.default_rng(seed)
+        slots = HISTORY_SLOTS + 1
+        rates = rng.pareto(1.5, size=(ips, 1)).astype(np.float32) * 5
+        features = {
+            TOTAL_FEATURE: rng.poisson(rates, size=(ips, slots)).astype(np.float32)
+        }
+        for number in range(paths):
+            features[f"/path{number}"] = rng.poisson(
+                rates / 20, size=(ips, slots)
+            ).astype(np.float32)
+
+        # Every 10,000th IP bursts in the last hour or slowly probes a path
+        features[TOTAL_FEATURE][::10000, -1] += 500
+        if paths:
+            features["/path0"][5::10000] += 3
+
+        rows = np.arange(ips)
+        return TrafficMatrix(
+            [f"ip{i}" for i in range(ips)],
+            {name: (rows, matrix) for name, matrix in features.items()},
+            end=None,
+        )
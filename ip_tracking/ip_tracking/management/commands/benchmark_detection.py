@@ -0,0 +1,133 @@
+import random
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count
+from django.utils import timezone
+from ip_tracking.models import RequestLog
+from ip_tracking.rules import get_detection_plan
+from ip_tracking.tasks import get_shard_ranges
+
+BENCHMARK_PATHS = ["/", "/static/app.js", "/dashboard/", "/api/items", "/admin/"]
+BENCHMARK_PATHS += ["/login", "/login/", "/register/", "/products/42"]
+
+
+# pylint: disable=no-member
+class Command(BaseCommand):
+    """Anomaly detection query benchmark"""
+
+    help = (
+        "Load synthetic request logs and time the single-pass detection "
+        "aggregate against one GROUP BY query per rule. The rows are rolled "
+        "back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rows",
+            type=int,
+            default=1000000,
+            help="Number of synthetic request logs to load",
+        )
+        parser.add_argument(
+            "--ips",
+            type=int,
+            default=20000,
+            help="Number of distinct client IP addresses",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=3,
+            help="Runs per query strategy, the best time is reported",
+        )
+        parser.add_argument(
+            "--shards",
+            type=int,
+            default=0,
+            help="Also time the aggregate per IP range shard; the slowest "
+            "shard is the wall time with one worker per shard",
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.load(options["rows"], options["ips"])
+            now = timezone.now()
+            plan = get_detection_plan()
+
+            single = self.best_of(options["repeat"], plan.aggregate, now)
+            multi = self.best_of(
+                options["repeat"], lambda now: self.per_rule_counts(plan, now), now
+            )
+            self.stdout.write(
+                f"{options['rows']:,} rows, {len(plan.rules)} rules on "
+                f"{connection.vendor}: "
+                f"single pass {single:.2f}s, per-rule queries {multi:.2f}s"
+            )
+            if options["shards"] > 1:
+                self.benchmark_shards(plan, now, options["shards"], options["repeat"])
+            transaction.set_rollback(True)
+
+    def benchmark_shards(self, plan, now, shards, repeat):
+        """Time the aggregate of every shard of get_shard_ranges"""
+        ranges = get_shard_ranges(shards, now - timedelta(hours=1))
+        timings = [
+            self.best_of(
+                repeat,
+                lambda now, ip_range=ip_range: plan.aggregate(now, None, ip_range),
+                now,
+            )
+            for ip_range in ranges
+        ]
+        self.stdout.write(
+            f"{len(ranges)} shards: slowest {max(timings):.2f}s, "
+            f"total {sum(timings):.2f}s"
+        )
+
+    def load(self, rows, ips):
+        """Bulk create rows request logs, most of them within the last hour"""
+        now = timezone.now()
+        addresses = [
+            f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}" for i in range(ips)
+        ]
+        start = time.perf_counter()
+        batch = []
+        for i in range(rows):
+            age = random.random() * (3600 if i % 5 else 7200)
+            batch.append(
+                RequestLog(
+                    ip_address=addresses[int(random.paretovariate(1.2)) % ips],
+                    path=random.choice(BENCHMARK_PATHS),
+                    timestamp=now - timedelta(seconds=age),
+                )
+            )
+            if len(batch) == 10000:
+                RequestLog.objects.bulk_create(batch)
+                batch = []
+        RequestLog.objects.bulk_create(batch)
+        self.stdout.write(f"Loaded {rows:,} rows in {time.perf_counter() - start:.1f}s")
+
+    def best_of(self, repeat, func, now):
+        """Best wall time of repeat calls of func(now)"""
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            list(func(now))
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    def per_rule_counts(self, plan, now):
+        """The previous detection queries: one GROUP BY per rule"""
+        results = []
+        for rule in plan.rules:
+            results.extend(
+                RequestLog.objects.filter(
+                    rule.path_filter(),
+                    timestamp__gte=now - timedelta(seconds=rule.window),
+                )
+                .values("ip_address")
+                .annotate(request_count=Count("id"))
+                .filter(request_count__gt=rule.threshold)
+            )
+        return results
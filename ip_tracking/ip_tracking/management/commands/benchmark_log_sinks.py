@@ -0,0 +1,74 @@
+import os
+import tempfile
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+from ip_tracking.log_buffer import get_request_log_buffer
+from ip_tracking.models import RequestLog
+
+BENCHMARK_PATH = "/__sink_benchmark__"
+DEFAULT_SINKS = ["ORMSink", "BufferedORMSink", "FileSink", "NullSink"]
+
+
+# pylint: disable=no-member
+class Command(BaseCommand):
+    """Request log sink benchmark"""
+
+    help = "Emit synthetic request logs through each log sink and compare them"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--count",
+            type=int,
+            default=5000,
+            help="Number of request logs emitted per sink",
+        )
+        parser.add_argument(
+            "--sinks",
+            nargs="+",
+            default=DEFAULT_SINKS,
+            help="Sink class names from ip_tracking.sinks, or dotted paths "
+            "(RedisStreamSink needs a running Redis server)",
+        )
+
+    def handle(self, *args, **options):
+        count = options["count"]
+        for name in options["sinks"]:
+            path = name if "." in name else f"ip_tracking.sinks.{name}"
+            try:
+                sink_class = import_string(path)
+            except ImportError as e:
+                raise CommandError(f"Unknown sink {name}") from e
+            self.benchmark(sink_class, count)
+
+        # Remove the rows written by the database sinks
+        deleted, _ = RequestLog.objects.filter(path=BENCHMARK_PATH).delete()
+        self.stdout.write(f"Removed {deleted} benchmark rows")
+
+    def benchmark(self, sink_class, count):
+        """Emit count logs through a fresh sink and report its stats"""
+        with tempfile.TemporaryDirectory() as directory:
+            if sink_class.__name__ == "FileSink":
+                sink = sink_class(os.path.join(directory, "request_logs.jsonl"))
+            else:
+                sink = sink_class()
+
+            start = time.perf_counter()
+            for i in range(count):
+                sink.emit(
+                    RequestLog(
+                        ip_address=f"192.0.2.{i % 256}",
+                        path=BENCHMARK_PATH,
+                    )
+                )
+            # Buffered rows only count once they reach the database
+            if sink_class.__name__ == "BufferedORMSink":
+                get_request_log_buffer().flush()
+            elapsed = time.perf_counter() - start
+
+        stats = sink.stats()
+        self.stdout.write(
+            f"{sink}: {count / elapsed:,.0f} logs/s, "
+            f"{stats['avg_emit_us']} us per emit, "
+            f"{stats['rejected']} rejected, {stats['errors']} errors"
+        )
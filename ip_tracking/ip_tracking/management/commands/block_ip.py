@@ -1,18 +1,20 @@
+import ipaddress
 from django.core.management.base import BaseCommand, CommandError
 from django.core.cache import cache
-from ip_tracking.models import BlockedIP
+from ip_tracking.models import BlockedIP, BlockedNetwork
+from ip_tracking.blocklist import BLOCKED_IP_CACHE_PREFIX
 
 
 # pylint: disable=no-member
 class Command(BaseCommand):
     """Custom IP commands"""
-    help = "Add or remove IP addresses from the blocklist"
+    help = "Add or remove IP addresses or CIDR networks from the blocklist"
 
     def add_arguments(self, parser):
         parser.add_argument(
             "ip_address",
             type=str,
-            help="IP address to block or unblock",
+            help="IP address or CIDR network (e.g. 203.0.113.0/24) to block or unblock",
         )
         parser.add_argument(
             "--reason",
@@ -41,7 +43,12 @@ class Command(BaseCommand):
         reason = options["reason"]
         unblock = options["unblock"]
 
-        if unblock:
+        if "/" in ip_address:
+            if unblock:
+                self.unblock_network(ip_address)
+            else:
+                self.block_network(ip_address, reason)
+        elif unblock:
             self.unblock_ip(ip_address)
         else:
             self.block_ip(ip_address, reason)
@@ -104,13 +111,66 @@ class Command(BaseCommand):
         except Exception as e:
             raise CommandError(f"Error unblocking IP {ip_address}: {str(e)}") from e
 
+    def block_network(self, network, reason):
+        """
+        Add a CIDR network to the blocklist.
+        """
+        try:
+            network = str(ipaddress.ip_network(network, strict=False))
+            blocked_network, created = BlockedNetwork.objects.get_or_create(
+                network=network, defaults={"reason": reason, "is_active": True}
+            )
+
+            if created:
+                self.stdout.write(
+                    self.style.SUCCESS(f"Successfully blocked network: {network}")
+                )
+            elif not blocked_network.is_active:
+                blocked_network.is_active = True
+                blocked_network.reason = reason if reason else blocked_network.reason
+                blocked_network.save()
+                self.stdout.write(
+                    self.style.SUCCESS(f"Reactivated block for network: {network}")
+                )
+            else:
+                self.stdout.write(
+                    self.style.WARNING(f"Network {network} is already blocked")
+                )
+
+        except Exception as e:
+            raise CommandError(f"Error blocking network {network}: {str(e)}") from e
+
+    def unblock_network(self, network):
+        """
+        Remove a CIDR network from the blocklist.
+        """
+        try:
+            network = str(ipaddress.ip_network(network, strict=False))
+            blocked_network = BlockedNetwork.objects.get(network=network)
+            blocked_network.is_active = False
+            blocked_network.save()
+
+            self.stdout.write(
+                self.style.SUCCESS(f"Successfully unblocked network: {network}")
+            )
+
+        except BlockedNetwork.DoesNotExist:
+            self.stdout.write(
+                self.style.WARNING(f"Network {network} is not in the blocklist")
+            )
+        except Exception as e:
+            raise CommandError(f"Error unblocking network {network}: {str(e)}") from e
+
     def list_blocked_ips(self):
         """
         List all blocked IP addresses.
         """
         blocked_ips = BlockedIP.objects.filter(is_active=True).order_by("-created_at")
+        blocked_networks = BlockedNetwork.objects.filter(is_active=True).order_by(
+            "-created_at"
+        )
 
-        if not blocked_ips.exists():
+        if not blocked_ips.exists() and not blocked_networks.exists():
             self.stdout.write(
                 self.style.WARNING("No IP addresses are currently blocked")
             )
@@ -127,9 +187,17 @@ class Command(BaseCommand):
                 f"  Reason: {reason}\n"
             )
 
+        for blocked_network in blocked_networks:
+            reason = blocked_network.reason or "No reason provided"
+            self.stdout.write(
+                f"Network: {blocked_network.network}\n"
+                f'  Blocked: {blocked_network.created_at.strftime("%Y-%m-%d %H:%M:%S")}\n'
+                f"  Reason: {reason}\n"
+            )
+
     def clear_ip_cache(self, ip_address):
         """
         Clear the cache for a specific IP address.
         """
-        cache_key = f"blocked_ip_{ip_address}"
+        cache_key = f"{BLOCKED_IP_CACHE_PREFIX}{ip_address}"
         cache.delete(cache_key)
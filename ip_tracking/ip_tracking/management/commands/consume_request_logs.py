@@ -0,0 +1,80 @@
+import time
+import redis
+from django.core.management.base import BaseCommand
+from ip_tracking.log_stream import get_consumer_name, get_request_log_stream
+
+
+class Command(BaseCommand):
+    """Request log stream consumer"""
+
+    help = "Write request logs from the Redis Stream to the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--consumer",
+            type=str,
+            default=None,
+            help="Consumer name within the group (defaults to host-pid)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=None,
+            help="Maximum number of entries written per bulk_create",
+        )
+        parser.add_argument(
+            "--block",
+            type=int,
+            default=5000,
+            help="Milliseconds to wait for new entries when the stream is empty",
+        )
+        parser.add_argument(
+            "--max-backoff",
+            type=float,
+            default=30.0,
+            help="Longest wait in seconds between retries after Redis or "
+            "database errors",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once the stream is drained instead of waiting for more",
+        )
+
+    def handle(self, *args, **options):
+        stream = get_request_log_stream()
+        if options["batch_size"]:
+            stream.batch_size = options["batch_size"]
+        consumer = options["consumer"] or get_consumer_name()
+
+        if options["once"]:
+            written = stream.consume(consumer)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {written} request logs"))
+            return
+
+        self.stdout.write(f"Consuming {stream.stream} as {consumer}")
+        delay = 0
+        try:
+            while True:
+                write_errors = stream.write_errors
+                try:
+                    written = stream.consume(consumer, block=options["block"])
+                except redis.RedisError as e:
+                    self.stderr.write(self.style.ERROR(f"Redis error: {e}"))
+                    written = None
+                if written:
+                    self.stdout.write(f"Wrote {written} request logs")
+
+                if written is None or stream.write_errors != write_errors:
+                    # Back off exponentially while Redis or the database fails
+                    delay = self.next_delay(delay, options["max_backoff"])
+                    self.stderr.write(f"Retrying in {delay:g}s")
+                    time.sleep(delay)
+                else:
+                    delay = 0
+        except KeyboardInterrupt:
+            self.stdout.write("Stopped")
+
+    def next_delay(self, delay, max_backoff):
+        """Seconds to wait after another failure, doubling up to max_backoff"""
+        return min(delay * 2 or 0.5, max_backoff)
@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from ip_tracking.blocklist import publish_blocklist
+
+
+class Command(BaseCommand):
+    """Publish the blocklist"""
+
+    help = (
+        "Publish the current blocklist to every worker and write the shared "
+        "blocklist file when IP_TRACKING_BLOCKLIST_FILE is set. Run it on "
+        "deploy, before workers start reading the file."
+    )
+
+    def handle(self, *args, **options):
+        publish_blocklist()
+        path = getattr(settings, "IP_TRACKING_BLOCKLIST_FILE", None)
+        if path:
+            self.stdout.write(self.style.SUCCESS(f"Wrote blocklist file {path}"))
+        else:
+            self.stdout.write(self.style.SUCCESS("Published blocklist version"))
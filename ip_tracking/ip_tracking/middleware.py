@@ -1,9 +1,22 @@
 import logging
-import requests
+from django.conf import settings
 from django.utils.deprecation import MiddlewareMixin
 from django.http import HttpResponseForbidden
-from django.core.cache import cache
-from .models import RequestLog, BlockedIP
+from .blocklist import (
+    BLOCKED_IP_CACHE_PREFIX,
+    acheck_blocked_ip,
+    check_blocked_ip,
+    get_blocklist_snapshot,
+    get_network_blocklist,
+)
+from .distinct_paths import get_distinct_path_tracker, use_distinct_paths
+from .heavy_hitters import get_heavy_hitter_tracker, use_heavy_hitters
+from .models import RequestLog
+from .realtime import get_realtime_detector, use_realtime_detection
+from .request_cache import RequestCacheLookup
+from .rollups import get_rollup_tracker, use_rollups
+from .sinks import get_log_sink
+from . import geolocation
 
 logger = logging.getLogger(__name__)
 
@@ -16,22 +29,18 @@ class IPTrackingMiddleware(MiddlewareMixin):
     Also blocks requests from blacklisted IP addresses.
     """
 
-    BLOCKED_IP_CACHE_PREFIX = "blocked_ip_"
-    GEOLOCATION_CACHE_PREFIX = "geolocation_"
-    BLOCKED_IP_CACHE_TIMEOUT = 300  # 5 minutes
-    GEOLOCATION_CACHE_TIMEOUT = 86400  # 24 hours
-
-    # Geolocation API endpoint (no API key required)
-    GEOLOCATION_API_URL = "http://ip-api.com/json/{ip}?fields=status,country,city"
-
     def process_request(self, request):
         """Process each incoming request and log its details"""
 
         # Get the client's IP address
         ip_address = self.get_client_ip(request)
 
+        # Fetch everything this request needs from the cache in one go
+        lookup = self.prefetch_request(ip_address)
+
         # Check if IP is blocked
-        if self.is_ip_blocked(ip_address):
+        if self.is_ip_blocked(ip_address, lookup):
+            self.write_back(lookup)
             logger.warning(
                 "Blocked request from IP=%s, Path=%s", ip_address, request.path
             )
@@ -42,17 +51,22 @@ class IPTrackingMiddleware(MiddlewareMixin):
         # Get the request path
         path = request.path
 
-        # Get geolocation data
-        country, city = self.get_geolocation(ip_address)
+        # Get geolocation data, unless it is filled in later by a Celery task
+        if self.defer_geolocation():
+            country, city = None, None
+        else:
+            country, city = self.get_geolocation(ip_address, lookup)
+        self.write_back(lookup)
 
         try:
-            # Save request log to database
-            RequestLog.objects.create(
+            log_entry = RequestLog(
                 ip_address=ip_address,
                 path=path,
                 country=country,
                 city=city,
             )
+            self.save_request_log(log_entry)
+            self.track_request(log_entry)
             location_info = f"{city}, {country}" if city and country else "Unknown"
             logger.info(
                 "Request logged: IP=%s, Location=%s, Path=%s",
@@ -65,111 +79,116 @@ class IPTrackingMiddleware(MiddlewareMixin):
 
         return None
 
-    def get_geolocation(self, ip_address):
+    def save_request_log(self, log_entry):
         """
-        Get geolocation data (country and city) for an IP address.
-        Uses caching to store results for 24 hours.
-        Uses ip-api.com free API (45 requests per minute limit).
+        Persist a request log through the configured sink.
+        See ip_tracking.sinks for the available IP_TRACKING_LOG_SINK backends.
         """
-        # Skip geolocation for local/private IPs
-        if self.is_private_ip(ip_address):
-            return None, None
-
-        cache_key = f"{self.GEOLOCATION_CACHE_PREFIX}{ip_address}"
+        get_log_sink().emit(log_entry)
 
-        # Check cache first
-        cached_data = cache.get(cache_key)
-        if cached_data is not None:
-            return cached_data
-
-        # Fetch geolocation data from API
-        try:
-            url = self.GEOLOCATION_API_URL.format(ip=ip_address)
-            response = requests.get(url, timeout=2)
-
-            if response.status_code == 200:
-                data = response.json()
-
-                if data.get("status") == "success":
-                    country = data.get("country")
-                    city = data.get("city")
-                    result = (country, city)
+    def track_request(self, log_entry):
+        """
+        Update the per-minute request rollups when IP_TRACKING_ROLLUPS_ENABLED
+        is set, the sliding-window counters that flag IPs as soon as they
+        cross a threshold when IP_TRACKING_REALTIME_DETECTION is set, the
+        heavy-hitter sketch when IP_TRACKING_HEAVY_HITTERS_ENABLED is set and
+        the distinct-path HyperLogLogs when IP_TRACKING_DISTINCT_PATHS_ENABLED
+        is set.
+        """
+        if use_rollups():
+            get_rollup_tracker().track(
+                log_entry.ip_address, log_entry.path, log_entry.timestamp
+            )
+        if use_realtime_detection():
+            get_realtime_detector().track(log_entry.ip_address, log_entry.path)
+        if use_heavy_hitters():
+            get_heavy_hitter_tracker().track(log_entry.ip_address)
+        if use_distinct_paths():
+            get_distinct_path_tracker().track(log_entry.ip_address, log_entry.path)
+
+    def defer_geolocation(self):
+        """
+        Whether geolocation is left to the enrich_request_log_geolocation task.
+        """
+        return getattr(settings, "IP_TRACKING_DEFER_GEOLOCATION", False)
 
-                    # Cache the result for 24 hours
-                    cache.set(cache_key, result, self.GEOLOCATION_CACHE_TIMEOUT)
+    def use_request_lookup(self):
+        """
+        Whether the request's cache entries are fetched in one round trip
+        by prefetch_request.
+        """
+        return getattr(settings, "IP_TRACKING_REQUEST_LOOKUP", False)
 
-                    return result
+    def prefetch_request(self, ip_address):
+        """
+        Fetch the cached blocklist flag and geolocation entry of a request
+        together.
+        Returns the RequestCacheLookup, or None when the lookup stage is
+        disabled.
+        """
+        lookup = self.build_request_lookup(ip_address)
+        if lookup is not None:
+            lookup.fetch()
+        return lookup
 
-            # If API call failed, cache empty result
-            logger.warning(
-                "Geolocation API returned status %s for IP %s",
-                response.status_code,
-                ip_address,
+    def build_request_lookup(self, ip_address):
+        """
+        Register the cache keys the request needs with a RequestCacheLookup,
+        or return None when the lookup stage is disabled.
+        """
+        if not self.use_request_lookup():
+            return None
+
+        lookup = RequestCacheLookup()
+        if not self.use_blocklist_snapshot():
+            lookup.want(f"{BLOCKED_IP_CACHE_PREFIX}{ip_address}")
+        if not self.defer_geolocation() and not self.is_private_ip(ip_address):
+            lookup.want(f"{geolocation.GEOLOCATION_CACHE_PREFIX}{ip_address}")
+        return lookup
+
+    def write_back(self, lookup):
+        """Write the cache misses resolved during the request in one go"""
+        if lookup is not None:
+            lookup.write_back()
+
+    def get_geolocation(self, ip_address, lookup=None):
+        """
+        Get geolocation data (country and city) for an IP address.
+        See ip_tracking.geolocation.get_geolocation.
+        """
+        if lookup is not None:
+            cached_data = lookup.get(
+                f"{geolocation.GEOLOCATION_CACHE_PREFIX}{ip_address}"
             )
-            cache.set(cache_key, (None, None), self.GEOLOCATION_CACHE_TIMEOUT)
-            return None, None
-        except requests.exceptions.Timeout:
-            logger.warning("Geolocation API timeout for IP %s", ip_address)
-            cache.set(cache_key, (None, None), 3600)  # Cache for 1 hour on timeout
-            return None, None
-        except Exception as e:
-            logger.error("Failed to get geolocation for IP %s: %s", ip_address, e)
-            cache.set(cache_key, (None, None), 3600)  # Cache for 1 hour on error
-            return None, None
+            if cached_data is not None:
+                return cached_data
+        return geolocation.get_geolocation(ip_address)
 
     def is_private_ip(self, ip_address):
         """
         Check if an IP address is private/local.
         """
-        if not ip_address:
-            return True
+        return geolocation.is_private_ip(ip_address)
 
-        # Check for localhost
-        if ip_address in ["127.0.0.1", "::1", "localhost"]:
-            return True
+    def use_blocklist_snapshot(self):
+        """
+        Whether blocks are checked against the in-process blocklist snapshot
+        instead of the per-IP cache.
+        """
+        return getattr(settings, "IP_TRACKING_BLOCKLIST_SNAPSHOT", False)
 
-        # Check for private IPv4 ranges
-        parts = ip_address.split(".")
-        if len(parts) == 4:
-            try:
-                first_octet = int(parts[0])
-                second_octet = int(parts[1])
-
-                # 10.0.0.0/8
-                if first_octet == 10:
-                    return True
-                # 172.16.0.0/12
-                if first_octet == 172 and 16 <= second_octet <= 31:
-                    return True
-                # 192.168.0.0/16
-                if first_octet == 192 and second_octet == 168:
-                    return True
-            except ValueError:
-                pass
-
-        return False
-
-    def is_ip_blocked(self, ip_address):
+    def is_ip_blocked(self, ip_address, lookup=None):
         """
         Check if an IP address is in the blocklist.
         Uses caching to minimize database queries.
         """
-        cache_key = f"{self.BLOCKED_IP_CACHE_PREFIX}{ip_address}"
+        if self.use_blocklist_snapshot():
+            return get_blocklist_snapshot().is_blocked(ip_address)
 
-        # Check cache first
-        cached_result = cache.get(cache_key)
-        if cached_result is not None:
-            return cached_result
-
-        # Query database
-        is_blocked = BlockedIP.objects.filter(
-            ip_address=ip_address, is_active=True
-        ).exists()
-
-        # Cache the result
-        cache.set(cache_key, is_blocked, self.BLOCKED_IP_CACHE_TIMEOUT)
-
-        return is_blocked
+        # Exact address first, then the compiled network blocklist
+        if check_blocked_ip(ip_address, lookup):
+            return True
+        return get_network_blocklist().is_network_blocked(ip_address)
 
     def get_client_ip(self, request):
         """
@@ -183,3 +202,116 @@ class IPTrackingMiddleware(MiddlewareMixin):
         else:
             ip = request.META.get("REMOTE_ADDR")
         return ip
+
+
+class AsyncIPTrackingMiddleware(IPTrackingMiddleware):
+    """
+    Sync- and async-capable variant of IPTrackingMiddleware.
+
+    Under WSGI it behaves exactly like IPTrackingMiddleware. Under ASGI the
+    middleware itself runs on the event loop, so the request is not handed
+    to a thread as a whole. Geolocation uses a non-blocking HTTP client and
+    the request lookup, rollups and other Redis counters use the asyncio
+    Redis client. Django's async cache API and async ORM still run their
+    queries through sync_to_async, so blocklist cache misses, database
+    checks and ORM sinks each take a trip through the thread pool.
+    """
+
+    async def __acall__(self, request):
+        """Async request handler used when the middleware chain is async"""
+        response = await self.aprocess_request(request)
+        return response or await self.get_response(request)
+
+    async def aprocess_request(self, request):
+        """Async version of process_request"""
+        ip_address = self.get_client_ip(request)
+
+        lookup = await self.aprefetch_request(ip_address)
+
+        if await self.ais_ip_blocked(ip_address, lookup):
+            await self.awrite_back(lookup)
+            logger.warning(
+                "Blocked request from IP=%s, Path=%s", ip_address, request.path
+            )
+            return HttpResponseForbidden(
+                "<h1>403 Forbidden</h1><p>Your IP address has been blocked.</p>"
+            )
+
+        path = request.path
+
+        if self.defer_geolocation():
+            country, city = None, None
+        else:
+            country, city = await self.aget_geolocation(ip_address, lookup)
+        await self.awrite_back(lookup)
+
+        try:
+            log_entry = RequestLog(
+                ip_address=ip_address,
+                path=path,
+                country=country,
+                city=city,
+            )
+            await self.asave_request_log(log_entry)
+            await self.atrack_request(log_entry)
+            location_info = f"{city}, {country}" if city and country else "Unknown"
+            logger.info(
+                "Request logged: IP=%s, Location=%s, Path=%s",
+                ip_address,
+                location_info,
+                path,
+            )
+        except Exception as e:
+            logger.error("Failed to log request: %s", e)
+
+        return None
+
+    async def asave_request_log(self, log_entry):
+        """Async version of save_request_log"""
+        await get_log_sink().aemit(log_entry)
+
+    async def atrack_request(self, log_entry):
+        """Async version of track_request"""
+        if use_rollups():
+            await get_rollup_tracker().atrack(
+                log_entry.ip_address, log_entry.path, log_entry.timestamp
+            )
+        if use_realtime_detection():
+            await get_realtime_detector().atrack(log_entry.ip_address, log_entry.path)
+        if use_heavy_hitters():
+            await get_heavy_hitter_tracker().atrack(log_entry.ip_address)
+        if use_distinct_paths():
+            await get_distinct_path_tracker().atrack(
+                log_entry.ip_address, log_entry.path
+            )
+
+    async def aprefetch_request(self, ip_address):
+        """Async version of prefetch_request"""
+        lookup = self.build_request_lookup(ip_address)
+        if lookup is not None:
+            await lookup.afetch()
+        return lookup
+
+    async def awrite_back(self, lookup):
+        """Async version of write_back"""
+        if lookup is not None:
+            await lookup.awrite_back()
+
+    async def aget_geolocation(self, ip_address, lookup=None):
+        """Async version of get_geolocation"""
+        if lookup is not None:
+            cached_data = lookup.get(
+                f"{geolocation.GEOLOCATION_CACHE_PREFIX}{ip_address}"
+            )
+            if cached_data is not None:
+                return cached_data
+        return await geolocation.aget_geolocation(ip_address)
+
+    async def ais_ip_blocked(self, ip_address, lookup=None):
+        """Async version of is_ip_blocked"""
+        if self.use_blocklist_snapshot():
+            return await get_blocklist_snapshot().ais_blocked(ip_address)
+
+        if await acheck_blocked_ip(ip_address, lookup):
+            return True
+        return await get_network_blocklist().ais_network_blocked(ip_address)
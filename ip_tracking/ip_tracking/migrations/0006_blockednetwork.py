@@ -0,0 +1,66 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ip_tracking", "0005_requestlog_timestamp_default"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BlockedNetwork",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "network",
+                    models.CharField(
+                        help_text="Network to block in CIDR notation, e.g. 203.0.113.0/24",
+                        max_length=49,
+                        unique=True,
+                    ),
+                ),
+                (
+                    "reason",
+                    models.TextField(
+                        blank=True,
+                        help_text="Reason for blocking this network",
+                        null=True,
+                    ),
+                ),
+                (
+                    "created_at",
+                    models.DateTimeField(
+                        auto_now_add=True, help_text="When this network was blocked"
+                    ),
+                ),
+                (
+                    "is_active",
+                    models.BooleanField(
+                        default=True, help_text="Whether this block is currently active"
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Blocked Network",
+                "verbose_name_plural": "Blocked Networks",
+                "ordering": ["-created_at"],
+                "indexes": [
+                    models.Index(
+                        fields=["network", "is_active"],
+                        name="ip_tracking_network_3eb966_idx",
+                    )
+                ],
+            },
+        ),
+    ]
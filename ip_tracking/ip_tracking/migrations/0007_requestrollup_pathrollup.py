@@ -0,0 +1,114 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ip_tracking", "0006_blockednetwork"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PathRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "ip_address",
+                    models.GenericIPAddressField(help_text="IP address of the client"),
+                ),
+                (
+                    "path_prefix",
+                    models.CharField(
+                        help_text="Tracked path prefix the requests matched",
+                        max_length=255,
+                    ),
+                ),
+                (
+                    "bucket",
+                    models.DateTimeField(
+                        help_text="Start of the minute the requests were made in"
+                    ),
+                ),
+                (
+                    "count",
+                    models.PositiveIntegerField(
+                        default=0,
+                        help_text="Number of matching requests in this minute",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Path Rollup",
+                "verbose_name_plural": "Path Rollups",
+                "ordering": ["-bucket"],
+                "indexes": [
+                    models.Index(
+                        fields=["path_prefix", "bucket", "ip_address"],
+                        name="ip_tracking_path_pr_d18e6f_idx",
+                    )
+                ],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("ip_address", "path_prefix", "bucket"),
+                        name="unique_path_rollup",
+                    )
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="RequestRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "ip_address",
+                    models.GenericIPAddressField(help_text="IP address of the client"),
+                ),
+                (
+                    "bucket",
+                    models.DateTimeField(
+                        help_text="Start of the minute the requests were made in"
+                    ),
+                ),
+                (
+                    "count",
+                    models.PositiveIntegerField(
+                        default=0, help_text="Number of requests in this minute"
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Request Rollup",
+                "verbose_name_plural": "Request Rollups",
+                "ordering": ["-bucket"],
+                "indexes": [
+                    models.Index(
+                        fields=["bucket", "ip_address"],
+                        name="ip_tracking_bucket_51dbce_idx",
+                    )
+                ],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("ip_address", "bucket"), name="unique_request_rollup"
+                    )
+                ],
+            },
+        ),
+    ]
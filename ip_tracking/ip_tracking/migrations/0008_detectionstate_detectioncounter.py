@@ -0,0 +1,106 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ip_tracking", "0007_requestrollup_pathrollup"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DetectionState",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "name",
+                    models.CharField(
+                        help_text="Name of the detection run",
+                        max_length=64,
+                        unique=True,
+                    ),
+                ),
+                (
+                    "last_log_id",
+                    models.PositiveBigIntegerField(
+                        default=0, help_text="Highest RequestLog id processed so far"
+                    ),
+                ),
+                (
+                    "updated_at",
+                    models.DateTimeField(
+                        auto_now=True, help_text="When the watermark last moved"
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Detection State",
+                "verbose_name_plural": "Detection States",
+            },
+        ),
+        migrations.CreateModel(
+            name="DetectionCounter",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "ip_address",
+                    models.GenericIPAddressField(help_text="IP address of the client"),
+                ),
+                (
+                    "rule",
+                    models.CharField(
+                        help_text="Name of the anomaly rule the requests matched",
+                        max_length=64,
+                    ),
+                ),
+                (
+                    "bucket",
+                    models.DateTimeField(
+                        help_text="Start of the minute the requests were made in"
+                    ),
+                ),
+                (
+                    "count",
+                    models.PositiveIntegerField(
+                        default=0,
+                        help_text="Number of matching requests in this minute",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Detection Counter",
+                "verbose_name_plural": "Detection Counters",
+                "ordering": ["-bucket"],
+                "indexes": [
+                    models.Index(
+                        fields=["bucket", "ip_address"],
+                        name="ip_tracking_bucket_c3b7ee_idx",
+                    )
+                ],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("ip_address", "rule", "bucket"),
+                        name="unique_detection_counter",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ip_tracking", "0008_detectionstate_detectioncounter"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="suspiciousip",
+            name="prefix_length",
+            field=models.PositiveSmallIntegerField(
+                blank=True,
+                help_text="Prefix length of a flagged subnet whose network address is ip_address; empty for a single IP",
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-19 02:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ip_tracking", "0009_suspiciousip_prefix_length"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="detectionstate",
+            name="gaps",
+            field=models.JSONField(
+                blank=True,
+                default=list,
+                help_text="Unused ids below last_log_id that may still be committed, as [first id, last id, first seen] ranges",
+            ),
+        ),
+    ]
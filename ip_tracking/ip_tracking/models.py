@@ -1,4 +1,7 @@
+import ipaddress
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.utils import timezone
 
 
 # pylint: disable=no-member
@@ -11,7 +14,8 @@ class RequestLog(models.Model):
         help_text="IP address of the client making the request",
     )
     timestamp = models.DateTimeField(
-        auto_now_add=True,
+        default=timezone.now,
+        editable=False,
         help_text="Time when request was made",
     )
     path = models.CharField(
@@ -87,6 +91,54 @@ class BlockedIP(models.Model):
         return f"{self.ip_address} ({status})"
 
 
+class BlockedNetwork(models.Model):
+    """
+    Model to store blocked IP networks (CIDR ranges) for IPv4 and IPv6.
+    """
+
+    network = models.CharField(
+        max_length=49,
+        unique=True,
+        help_text="Network to block in CIDR notation, e.g. 203.0.113.0/24",
+    )
+    reason = models.TextField(
+        blank=True,
+        null=True,
+        help_text="Reason for blocking this network",
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        help_text="When this network was blocked",
+    )
+    is_active = models.BooleanField(
+        default=True,
+        help_text="Whether this block is currently active",
+    )
+
+    class Meta:
+        verbose_name = "Blocked Network"
+        verbose_name_plural = "Blocked Networks"
+        ordering = ["-created_at"]
+        indexes = [
+            models.Index(fields=["network", "is_active"]),
+        ]
+
+    def __str__(self):
+        status = "Active" if self.is_active else "Inactive"
+        return f"{self.network} ({status})"
+
+    def clean(self):
+        try:
+            self.network = str(ipaddress.ip_network(self.network, strict=False))
+        except ValueError as e:
+            raise ValidationError({"network": str(e)}) from e
+
+    def save(self, *args, **kwargs):
+        # Store networks in canonical form so lookups and uniqueness agree
+        self.network = str(ipaddress.ip_network(self.network, strict=False))
+        super().save(*args, **kwargs)
+
+
 class SuspiciousIP(models.Model):
     """
     Model to store suspicious IP addresses flagged by anomaly detection.
@@ -95,6 +147,12 @@ class SuspiciousIP(models.Model):
     ip_address = models.GenericIPAddressField(
         help_text="Suspicious IP address",
     )
+    prefix_length = models.PositiveSmallIntegerField(
+        blank=True,
+        null=True,
+        help_text="Prefix length of a flagged subnet whose network address is "
+        "ip_address; empty for a single IP",
+    )
     reason = models.TextField(
         help_text="Reason why this IP was flagged as suspicious",
     )
@@ -131,6 +189,160 @@ class SuspiciousIP(models.Model):
             models.Index(fields=["-flagged_at"]),
         ]
 
+    @property
+    def network(self):
+        """CIDR notation of a flagged subnet, the IP address otherwise"""
+        if self.prefix_length is None:
+            return self.ip_address
+        return f"{self.ip_address}/{self.prefix_length}"
+
     def __str__(self):
         status = "Resolved" if self.is_resolved else "Unresolved"
-        return f"{self.ip_address} - {status} ({self.flagged_at.strftime('%Y-%m-%d %H:%M')})"
+        flagged_at = self.flagged_at.strftime("%Y-%m-%d %H:%M")
+        return f"{self.network} - {status} ({flagged_at})"
+
+
+class RequestRollup(models.Model):
+    """
+    Number of requests per IP address and minute, maintained incrementally
+    from the Redis counters by the flush_request_rollups task.
+    """
+
+    ip_address = models.GenericIPAddressField(
+        help_text="IP address of the client",
+    )
+    bucket = models.DateTimeField(
+        help_text="Start of the minute the requests were made in",
+    )
+    count = models.PositiveIntegerField(
+        default=0,
+        help_text="Number of requests in this minute",
+    )
+
+    class Meta:
+        verbose_name = "Request Rollup"
+        verbose_name_plural = "Request Rollups"
+        ordering = ["-bucket"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["ip_address", "bucket"], name="unique_request_rollup"
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["bucket", "ip_address"]),
+        ]
+
+    def __str__(self):
+        return f"{self.ip_address}: {self.count} requests at {self.bucket}"
+
+
+class PathRollup(models.Model):
+    """
+    Number of requests per IP address, tracked path prefix and minute.
+    Exact path matches are stored with a trailing "$", e.g. "/login$".
+    """
+
+    ip_address = models.GenericIPAddressField(
+        help_text="IP address of the client",
+    )
+    path_prefix = models.CharField(
+        max_length=255,
+        help_text="Tracked path prefix the requests matched",
+    )
+    bucket = models.DateTimeField(
+        help_text="Start of the minute the requests were made in",
+    )
+    count = models.PositiveIntegerField(
+        default=0,
+        help_text="Number of matching requests in this minute",
+    )
+
+    class Meta:
+        verbose_name = "Path Rollup"
+        verbose_name_plural = "Path Rollups"
+        ordering = ["-bucket"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["ip_address", "path_prefix", "bucket"],
+                name="unique_path_rollup",
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["path_prefix", "bucket", "ip_address"]),
+        ]
+
+    def __str__(self):
+        return f"{self.ip_address} {self.path_prefix}: {self.count} at {self.bucket}"
+
+
+class DetectionState(models.Model):
+    """
+    Watermark of the incremental anomaly detection: the last RequestLog id
+    whose rows have been added to the DetectionCounter table.
+    """
+
+    name = models.CharField(
+        max_length=64,
+        unique=True,
+        help_text="Name of the detection run",
+    )
+    last_log_id = models.PositiveBigIntegerField(
+        default=0,
+        help_text="Highest RequestLog id processed so far",
+    )
+    gaps = models.JSONField(
+        default=list,
+        blank=True,
+        help_text="Unused ids below last_log_id that may still be committed, "
+        "as [first id, last id, first seen] ranges",
+    )
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        help_text="When the watermark last moved",
+    )
+
+    class Meta:
+        verbose_name = "Detection State"
+        verbose_name_plural = "Detection States"
+
+    def __str__(self):
+        return f"{self.name}: up to request log {self.last_log_id}"
+
+
+class DetectionCounter(models.Model):
+    """
+    Number of requests per IP address, anomaly rule and minute, maintained
+    from new RequestLog rows by the incremental detection.
+    """
+
+    ip_address = models.GenericIPAddressField(
+        help_text="IP address of the client",
+    )
+    rule = models.CharField(
+        max_length=64,
+        help_text="Name of the anomaly rule the requests matched",
+    )
+    bucket = models.DateTimeField(
+        help_text="Start of the minute the requests were made in",
+    )
+    count = models.PositiveIntegerField(
+        default=0,
+        help_text="Number of matching requests in this minute",
+    )
+
+    class Meta:
+        verbose_name = "Detection Counter"
+        verbose_name_plural = "Detection Counters"
+        ordering = ["-bucket"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["ip_address", "rule", "bucket"],
+                name="unique_detection_counter",
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["bucket", "ip_address"]),
+        ]
+
+    def __str__(self):
+        return f"{self.ip_address} {self.rule}: {self.count} at {self.bucket}"
@@ -0,0 +1,238 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+import redis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+from .models import BlockedIP, SuspiciousIP
+from .redis_utils import get_async_redis, get_redis
+from .rules import get_detection_plan
+
+logger = logging.getLogger(__name__)
+
+WINDOW_KEY_PREFIX = "ip_tracking:window:"
+WINDOW_FLAGGED_PREFIX = "ip_tracking:window:flagged:"
+
+
+def use_realtime_detection():
+    """Whether the middleware updates the sliding-window counters"""
+    return getattr(settings, "IP_TRACKING_REALTIME_DETECTION", False)
+
+
+# pylint: disable=broad-exception-caught
+# pylint: disable=no-member
+class SlidingWindowDetector:
+    """
+    Per-IP sliding-window counters kept in Redis.
+
+    Every request increments the current fixed window of each anomaly rule
+    it matches (see ip_tracking.rules) and reads the previous window in the
+    same pipeline. The sliding count is the current window plus the
+    previous one weighted by how much of it still overlaps the rule's
+    window, so each request costs a constant number of Redis commands. Once
+    a count exceeds its threshold a SET NX key makes sure only one request
+    per rule window hands the IP to the flag_realtime_ip task. The task
+    creates the SuspiciousIP row (and the BlockedIP row for rules with the
+    "block" action or with IP_TRACKING_REALTIME_AUTO_BLOCK) off the request
+    path.
+    """
+
+    def __init__(self, plan=None, auto_block=False):
+        self.plan = plan or get_detection_plan()
+        self.auto_block = auto_block
+        self._lock = threading.Lock()
+
+        # Counters
+        self.checked = 0
+        self.flagged = 0
+        self.blocked = 0
+        self.errors = 0
+
+    @classmethod
+    def from_settings(cls):
+        """Build a detector from the anomaly rules and realtime settings"""
+        return cls(
+            auto_block=getattr(settings, "IP_TRACKING_REALTIME_AUTO_BLOCK", False),
+        )
+
+    def queue_counters(self, pipeline, ip_address, rules, now):
+        """
+        Add the counter updates for one request to a Redis pipeline.
+        Returns the weight of each rule's previous window.
+        """
+        weights = []
+        for rule in rules:
+            window = int(now // rule.window)
+            key = f"{WINDOW_KEY_PREFIX}{rule.name}:{ip_address}"
+            pipeline.incr(f"{key}:{window}")
+            pipeline.expire(f"{key}:{window}", rule.window * 2)
+            pipeline.get(f"{key}:{window - 1}")
+            weights.append(1 - (now % rule.window) / rule.window)
+        return weights
+
+    def exceeded(self, rules, results, weights):
+        """Rules whose sliding count is above the threshold, with the count"""
+        exceeded = []
+        for index, (rule, weight) in enumerate(zip(rules, weights)):
+            current, _, previous = results[index * 3 : index * 3 + 3]
+            count = int(current + int(previous or 0) * weight)
+            if count > rule.threshold:
+                exceeded.append((rule, count))
+        return exceeded
+
+    def track(self, ip_address, path, now=None):
+        """
+        Count one request and hand the IP to flag_realtime_ip if a threshold
+        was crossed.
+        Returns the (rule, sliding count) pairs handed off.
+        """
+        rules = self.plan.matching_rules(path)
+        client = get_redis()
+        pipeline = client.pipeline(transaction=False)
+        weights = self.queue_counters(pipeline, ip_address, rules, now or time.time())
+        try:
+            results = pipeline.execute()
+            exceeded = self.exceeded(rules, results, weights)
+            claimed = [
+                (rule, count)
+                for rule, count in exceeded
+                if client.set(
+                    self.flag_key(ip_address, rule), 1, nx=True, ex=rule.window
+                )
+            ]
+        except redis.RedisError as e:
+            return self._track_failed(e)
+        with self._lock:
+            self.checked += 1
+        if claimed:
+            self.flag_later(ip_address, claimed)
+        return claimed
+
+    async def atrack(self, ip_address, path, now=None):
+        """Async version of track"""
+        rules = self.plan.matching_rules(path)
+        client = get_async_redis()
+        pipeline = client.pipeline(transaction=False)
+        weights = self.queue_counters(pipeline, ip_address, rules, now or time.time())
+        try:
+            results = await pipeline.execute()
+            claimed = []
+            for rule, count in self.exceeded(rules, results, weights):
+                key = self.flag_key(ip_address, rule)
+                if await client.set(key, 1, nx=True, ex=rule.window):
+                    claimed.append((rule, count))
+        except redis.RedisError as e:
+            return self._track_failed(e)
+        with self._lock:
+            self.checked += 1
+        if claimed:
+            # Sending the task talks to the broker
+            await sync_to_async(self.flag_later, thread_sensitive=False)(
+                ip_address, claimed
+            )
+        return claimed
+
+    def flag_key(self, ip_address, rule):
+        """
+        SET NX key claimed by the first request crossing a rule. It expires
+        with the rule window, so an IP crossing the rule again after its flag
+        was resolved is flagged again. Rules sharing a dedupe_reason share
+        the key, every other rule has its own.
+        """
+        if rule.dedupe_reason:
+            return f"{WINDOW_FLAGGED_PREFIX}{ip_address}:reason:{rule.dedupe_reason}"
+        return f"{WINDOW_FLAGGED_PREFIX}{ip_address}:rule:{rule.name}"
+
+    def flag_later(self, ip_address, claimed):
+        """Queue flag() for the claimed (rule, count) pairs in a Celery task"""
+        # pylint: disable=import-outside-toplevel
+        from .tasks import flag_realtime_ip
+
+        flag_realtime_ip.delay(
+            ip_address, [[rule.name, count] for rule, count in claimed]
+        )
+
+    def flag(self, ip_address, claimed):
+        """
+        Create the SuspiciousIP rows of the claimed rules, skipping IPs that
+        already have an open flag from detect_anomalies or an earlier
+        crossing, and block the IP if configured.
+        Only the first request to cross a threshold in a rule window gets
+        here, through the flag_realtime_ip task.
+        """
+        if BlockedIP.objects.filter(ip_address=ip_address, is_active=True).exists():
+            return []
+
+        recent_flags = SuspiciousIP.objects.filter(
+            ip_address=ip_address,
+            prefix_length__isnull=True,
+            flagged_at__gte=timezone.now() - timedelta(hours=24),
+            is_resolved=False,
+        )
+        reasons, block = [], False
+        for rule, count in claimed:
+            dedupe = rule.dedupe_reason
+            if reasons and not dedupe:
+                continue  # Like detect_anomalies, one flag per IP and run
+            flags = (
+                recent_flags.filter(reason__contains=dedupe) if dedupe else recent_flags
+            )
+            if flags.exists():
+                continue
+            reason = rule.format_reason(count)
+            SuspiciousIP.objects.create(
+                ip_address=ip_address, reason=reason, request_count=count
+            )
+            reasons.append(reason)
+            block = block or rule.action == "block" or self.auto_block
+            logger.warning("Flagged IP %s in real time: %s", ip_address, reason)
+
+        if block:
+            # post_save publishes the blocklist to every worker
+            BlockedIP.objects.update_or_create(
+                ip_address=ip_address,
+                defaults={
+                    "reason": f"Automatically blocked: {reasons[0]}",
+                    "is_active": True,
+                },
+            )
+            logger.warning("Auto-blocked IP %s in real time", ip_address)
+
+        with self._lock:
+            self.flagged += len(reasons)
+            self.blocked += 1 if block else 0
+        return reasons
+
+    def _track_failed(self, error):
+        with self._lock:
+            self.errors += 1
+        logger.error("Failed to update sliding-window counters: %s", error)
+        return []
+
+    def stats(self):
+        """Return the detector counters"""
+        with self._lock:
+            return {
+                "rules": len(self.plan.rules),
+                "auto_block": self.auto_block,
+                "checked": self.checked,
+                "flagged": self.flagged,
+                "blocked": self.blocked,
+                "errors": self.errors,
+            }
+
+
+_detector = None
+_detector_lock = threading.Lock()
+
+
+def get_realtime_detector():
+    """Return the process-wide sliding-window detector"""
+    global _detector  # pylint: disable=global-statement
+    if _detector is None:
+        with _detector_lock:
+            if _detector is None:
+                _detector = SlidingWindowDetector.from_settings()
+    return _detector
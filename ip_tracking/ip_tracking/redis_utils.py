@@ -0,0 +1,73 @@
+import asyncio
+import threading
+import weakref
+import redis
+import redis.asyncio
+from django.conf import settings
+
+_clients = {}
+_clients_lock = threading.Lock()
+# asyncio clients belong to the event loop they were created in
+_loop_clients = weakref.WeakKeyDictionary()
+
+
+def get_loop_client(key, factory):
+    """
+    Return the asyncio client stored under key for the running event loop,
+    creating it with factory on first use in that loop. Clients of a loop
+    are dropped with the loop, so async_to_sync and servers running several
+    loops never share a connection pool across loops.
+    """
+    loop = asyncio.get_running_loop()
+    clients = _loop_clients.get(loop)
+    if clients is None:
+        with _clients_lock:
+            clients = _loop_clients.setdefault(loop, {})
+    client = clients.get(key)
+    if client is None:
+        client = clients.setdefault(key, factory())
+    return client
+
+
+def get_redis_url():
+    """
+    Redis server used for streams and counters.
+    Defaults to the location of the default cache.
+    """
+    url = getattr(settings, "IP_TRACKING_REDIS_URL", None)
+    if url:
+        return url
+    location = settings.CACHES["default"].get("LOCATION", "redis://127.0.0.1:6379/1")
+    if isinstance(location, (list, tuple)):
+        location = location[0]
+    return location
+
+
+def get_redis():
+    """Return the process-wide Redis client, decoding responses to str"""
+    client = _clients.get("sync")
+    if client is None:
+        with _clients_lock:
+            client = _clients.get("sync")
+            if client is None:
+                client = redis.Redis.from_url(get_redis_url(), decode_responses=True)
+                _clients["sync"] = client
+    return client
+
+
+def get_async_redis():
+    """Return the asyncio Redis client of the running event loop"""
+    return get_loop_client(
+        "async",
+        lambda: redis.asyncio.Redis.from_url(get_redis_url(), decode_responses=True),
+    )
+
+
+def get_async_cache_redis(cache):
+    """
+    Return the running event loop's asyncio Redis client for the primary
+    server of a Django RedisCache. Responses stay bytes, as the cache
+    serializer expects.
+    """
+    url = cache._cache._servers[0]  # pylint: disable=protected-access
+    return get_loop_client(("cache", url), lambda: redis.asyncio.Redis.from_url(url))
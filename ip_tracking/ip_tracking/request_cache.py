@@ -0,0 +1,108 @@
+from collections import defaultdict
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.core.cache.backends.redis import RedisCache
+from .redis_utils import get_async_cache_redis
+
+
+# pylint: disable=protected-access
+class RequestCacheLookup:
+    """
+    Batched cache access for a single request.
+
+    Keys to read are registered first and then fetched together: on the
+    Redis cache backend this is a single MGET. Values computed for cache
+    misses are queued with set() and written back with one pipeline by
+    write_back(). afetch() and awrite_back() send the same commands through
+    an asyncio Redis client, so they do not block the event loop.
+
+    Other cache backends fall back to get_many() and set_many(), which keeps
+    the same semantics for tests and development.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else caches["default"]
+        self.keys = []
+        self.values = {}
+        self.writes = {}
+
+    def want(self, key):
+        """Register a key to read in fetch()"""
+        if key not in self.keys:
+            self.keys.append(key)
+
+    def get(self, key, default=None):
+        """Return a fetched value, or default on a cache miss"""
+        return self.values.get(key, default)
+
+    def set(self, key, value, timeout):
+        """Queue a value to be written by write_back()"""
+        self.values[key] = value
+        self.writes[key] = (value, timeout)
+
+    def fetch(self):
+        """Read every registered key"""
+        if not self.keys:
+            return
+        if isinstance(self.cache, RedisCache):
+            client = self.cache._cache.get_client()
+            self._store_fetched(client.mget(self._raw_keys()))
+            return
+        self.values.update(self.cache.get_many(self.keys))
+
+    def write_back(self):
+        """Write all queued values, then clear the queue"""
+        if not self.writes:
+            return
+        if isinstance(self.cache, RedisCache):
+            client = self.cache._cache.get_client(write=True)
+            pipeline = client.pipeline(transaction=False)
+            self._queue_writes(pipeline)
+            pipeline.execute()
+        else:
+            by_timeout = defaultdict(dict)
+            for key, (value, timeout) in self.writes.items():
+                by_timeout[timeout][key] = value
+            for timeout, values in by_timeout.items():
+                self.cache.set_many(values, timeout)
+        self.writes = {}
+
+    async def afetch(self):
+        """Async version of fetch()"""
+        if not self.keys:
+            return
+        if isinstance(self.cache, RedisCache):
+            client = get_async_cache_redis(self.cache)
+            self._store_fetched(await client.mget(self._raw_keys()))
+            return
+        await sync_to_async(self.fetch)()
+
+    async def awrite_back(self):
+        """Async version of write_back()"""
+        if not self.writes:
+            return
+        if isinstance(self.cache, RedisCache):
+            pipeline = get_async_cache_redis(self.cache).pipeline(transaction=False)
+            self._queue_writes(pipeline)
+            await pipeline.execute()
+            self.writes = {}
+            return
+        await sync_to_async(self.write_back)()
+
+    def _raw_keys(self):
+        return [self.cache.make_and_validate_key(key) for key in self.keys]
+
+    def _store_fetched(self, results):
+        serializer = self.cache._cache._serializer
+        for key, value in zip(self.keys, results):
+            if value is not None:
+                self.values[key] = serializer.loads(value)
+
+    def _queue_writes(self, pipeline):
+        serializer = self.cache._cache._serializer
+        for key, (value, timeout) in self.writes.items():
+            pipeline.set(
+                self.cache.make_and_validate_key(key),
+                serializer.dumps(value),
+                ex=timeout,
+            )
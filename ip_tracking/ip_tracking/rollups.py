@@ -0,0 +1,287 @@
+import logging
+import threading
+from datetime import datetime, timezone as dt_timezone
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Sum
+from .models import PathRollup, RequestRollup
+from .redis_utils import get_async_redis, get_redis
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_BUCKET_SECONDS = 60
+ROLLUP_KEY_PREFIX = "ip_tracking:rollup:"
+ROLLUP_BUCKETS_KEY = "ip_tracking:rollup:buckets"
+ROLLUP_KEY_TIMEOUT = 6 * 3600  # Unflushed buckets expire after 6 hours
+ROLLUP_BATCH_SIZE = 1000
+
+# Paths counted per IP; exact paths are stored with a trailing "$"
+ROLLUP_PATH_PREFIXES = ["/admin", "/login", "/register", "/api"]
+ROLLUP_EXACT_PATHS = ["/login"]
+
+
+def use_rollups():
+    """Whether request counts are read from the rollup tables"""
+    return getattr(settings, "IP_TRACKING_ROLLUPS_ENABLED", False)
+
+
+def get_bucket(timestamp):
+    """Epoch second at which the minute bucket of a datetime starts"""
+    epoch = int(timestamp.timestamp())
+    return epoch - epoch % ROLLUP_BUCKET_SECONDS
+
+
+def bucket_start(bucket):
+    """Aware datetime of an epoch bucket"""
+    return datetime.fromtimestamp(bucket, tz=dt_timezone.utc)
+
+
+def exact_path_key(path):
+    """PathRollup.path_prefix value of an exact path match"""
+    return f"{path}$"
+
+
+# pylint: disable=broad-exception-caught
+# pylint: disable=no-member
+class RollupTracker:
+    """
+    Per-minute request counters kept in Redis hashes.
+
+    Every request increments its IP in the minute's request hash and every
+    tracked path prefix it matches in the minute's path hash, all in one
+    pipeline. flush() moves closed minutes into the RequestRollup and
+    PathRollup tables, adding to rows that already exist, so detection
+    reads at most one row per IP and minute instead of every request.
+    """
+
+    def __init__(self, path_prefixes=None, exact_paths=None):
+        self.path_prefixes = list(
+            ROLLUP_PATH_PREFIXES if path_prefixes is None else path_prefixes
+        )
+        self.exact_paths = set(
+            ROLLUP_EXACT_PATHS if exact_paths is None else exact_paths
+        )
+        self._lock = threading.Lock()
+
+        # Counters
+        self.tracked = 0
+        self.errors = 0
+        self.flushed_buckets = 0
+
+    @classmethod
+    def from_settings(cls):
+        """Build a tracker from the IP_TRACKING_ROLLUP_* settings"""
+        return cls(
+            path_prefixes=getattr(
+                settings, "IP_TRACKING_ROLLUP_PATH_PREFIXES", ROLLUP_PATH_PREFIXES
+            ),
+            exact_paths=getattr(
+                settings, "IP_TRACKING_ROLLUP_EXACT_PATHS", ROLLUP_EXACT_PATHS
+            ),
+        )
+
+    def path_keys(self, path):
+        """Tracked path prefixes and exact paths a request path matches"""
+        keys = [prefix for prefix in self.path_prefixes if path.startswith(prefix)]
+        if path in self.exact_paths:
+            keys.append(exact_path_key(path))
+        return keys
+
+    def queue_increments(self, pipeline, ip_address, path, timestamp):
+        """Add the counter updates for one request to a Redis pipeline"""
+        bucket = get_bucket(timestamp)
+        requests_key = f"{ROLLUP_KEY_PREFIX}requests:{bucket}"
+        paths_key = f"{ROLLUP_KEY_PREFIX}paths:{bucket}"
+
+        pipeline.hincrby(requests_key, ip_address, 1)
+        pipeline.expire(requests_key, ROLLUP_KEY_TIMEOUT)
+        path_keys = self.path_keys(path)
+        for key in path_keys:
+            # IP addresses never contain spaces
+            pipeline.hincrby(paths_key, f"{ip_address} {key}", 1)
+        if path_keys:
+            pipeline.expire(paths_key, ROLLUP_KEY_TIMEOUT)
+        pipeline.zadd(ROLLUP_BUCKETS_KEY, {bucket: bucket})
+
+    def track(self, ip_address, path, timestamp):
+        """Count one request"""
+        pipeline = get_redis().pipeline(transaction=False)
+        self.queue_increments(pipeline, ip_address, path, timestamp)
+        try:
+            pipeline.execute()
+        except redis.RedisError as e:
+            return self._track_failed(e)
+        with self._lock:
+            self.tracked += 1
+        return True
+
+    async def atrack(self, ip_address, path, timestamp):
+        """Async version of track"""
+        pipeline = get_async_redis().pipeline(transaction=False)
+        self.queue_increments(pipeline, ip_address, path, timestamp)
+        try:
+            await pipeline.execute()
+        except redis.RedisError as e:
+            return self._track_failed(e)
+        with self._lock:
+            self.tracked += 1
+        return True
+
+    def _track_failed(self, error):
+        with self._lock:
+            self.errors += 1
+        logger.error("Failed to update request rollups: %s", error)
+        return False
+
+    def flush(self, now=None):
+        """
+        Store every closed minute bucket in the database.
+        Returns the number of buckets flushed.
+        """
+        client = get_redis()
+        current = get_bucket(now or datetime.now(dt_timezone.utc))
+        buckets = client.zrangebyscore(ROLLUP_BUCKETS_KEY, "-inf", f"({current}")
+
+        flushed = 0
+        for bucket in buckets:
+            requests_key = f"{ROLLUP_KEY_PREFIX}requests:{bucket}"
+            paths_key = f"{ROLLUP_KEY_PREFIX}paths:{bucket}"
+
+            # Take the counters and reset them atomically
+            pipeline = client.pipeline(transaction=True)
+            pipeline.hgetall(requests_key)
+            pipeline.hgetall(paths_key)
+            pipeline.delete(requests_key, paths_key)
+            pipeline.zrem(ROLLUP_BUCKETS_KEY, bucket)
+            request_counts, path_counts, _, _ = pipeline.execute()
+
+            try:
+                store_rollups(int(bucket), request_counts, path_counts)
+            except Exception as e:
+                logger.error("Failed to store request rollups for %s: %s", bucket, e)
+                self.restore(int(bucket), request_counts, path_counts)
+                break
+            flushed += 1
+
+        with self._lock:
+            self.flushed_buckets += flushed
+        return flushed
+
+    def restore(self, bucket, request_counts, path_counts):
+        """Put counters taken by a failed flush back into Redis"""
+        pipeline = get_redis().pipeline(transaction=False)
+        for ip_address, count in request_counts.items():
+            pipeline.hincrby(f"{ROLLUP_KEY_PREFIX}requests:{bucket}", ip_address, count)
+        for field, count in path_counts.items():
+            pipeline.hincrby(f"{ROLLUP_KEY_PREFIX}paths:{bucket}", field, count)
+        pipeline.zadd(ROLLUP_BUCKETS_KEY, {bucket: bucket})
+        pipeline.execute()
+
+    def stats(self):
+        """Return the tracker counters and the number of unflushed buckets"""
+        with self._lock:
+            data = {
+                "tracked": self.tracked,
+                "errors": self.errors,
+                "flushed_buckets": self.flushed_buckets,
+            }
+        try:
+            data["pending_buckets"] = get_redis().zcard(ROLLUP_BUCKETS_KEY)
+        except redis.RedisError as e:
+            data["error"] = str(e)
+        return data
+
+
+def store_rollups(bucket, request_counts, path_counts):
+    """
+    Add the counters of one minute bucket to the rollup tables.
+
+    request_counts maps IP addresses and path_counts "<ip> <path key>"
+    fields to counts. Existing rows are incremented in place with F()
+    expressions and missing rows created, using one bulk statement each.
+    """
+    bucket = bucket_start(bucket)
+
+    with transaction.atomic():
+        existing = {
+            rollup.ip_address: rollup
+            for rollup in RequestRollup.objects.filter(bucket=bucket)
+        }
+        created, updated = [], []
+        for ip_address, count in request_counts.items():
+            rollup = existing.get(ip_address)
+            if rollup is None:
+                created.append(
+                    RequestRollup(
+                        ip_address=ip_address, bucket=bucket, count=int(count)
+                    )
+                )
+            else:
+                rollup.count = F("count") + int(count)
+                updated.append(rollup)
+        RequestRollup.objects.bulk_create(created, batch_size=ROLLUP_BATCH_SIZE)
+        RequestRollup.objects.bulk_update(
+            updated, ["count"], batch_size=ROLLUP_BATCH_SIZE
+        )
+
+        existing = {
+            (rollup.ip_address, rollup.path_prefix): rollup
+            for rollup in PathRollup.objects.filter(bucket=bucket)
+        }
+        created, updated = [], []
+        for field, count in path_counts.items():
+            ip_address, path_prefix = field.split(" ", 1)
+            rollup = existing.get((ip_address, path_prefix))
+            if rollup is None:
+                created.append(
+                    PathRollup(
+                        ip_address=ip_address,
+                        path_prefix=path_prefix,
+                        bucket=bucket,
+                        count=int(count),
+                    )
+                )
+            else:
+                rollup.count = F("count") + int(count)
+                updated.append(rollup)
+        PathRollup.objects.bulk_create(created, batch_size=ROLLUP_BATCH_SIZE)
+        PathRollup.objects.bulk_update(updated, ["count"], batch_size=ROLLUP_BATCH_SIZE)
+
+
+def get_request_counts(since):
+    """
+    Requests per IP address from the start of the minute containing since.
+    Returns a values queryset of ip_address and request_count, like a
+    GROUP BY over RequestLog.
+    """
+    return (
+        RequestRollup.objects.filter(bucket__gte=bucket_start(get_bucket(since)))
+        .values("ip_address")
+        .annotate(request_count=Sum("count"))
+    )
+
+
+def get_path_counts(since, path_key):
+    """Like get_request_counts, for requests matching one tracked path key"""
+    return (
+        PathRollup.objects.filter(
+            bucket__gte=bucket_start(get_bucket(since)), path_prefix=path_key
+        )
+        .values("ip_address")
+        .annotate(request_count=Sum("count"))
+    )
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_rollup_tracker():
+    """Return the process-wide rollup tracker"""
+    global _tracker  # pylint: disable=global-statement
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                _tracker = RollupTracker.from_settings()
+    return _tracker
@@ -0,0 +1,365 @@
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+from .models import DetectionCounter, PathRollup, RequestLog, RequestRollup
+from .rollups import (
+    ROLLUP_EXACT_PATHS,
+    ROLLUP_PATH_PREFIXES,
+    bucket_start,
+    exact_path_key,
+    get_bucket,
+)
+
+logger = logging.getLogger(__name__)
+
+# Built-in rules, used unless IP_TRACKING_ANOMALY_RULES is set
+SENSITIVE_PATHS = ["/admin", "/login", "/register", "/api"]
+LOGIN_PATH = "/login"
+HIGH_VOLUME_THRESHOLD = 100  # Requests per hour
+SENSITIVE_PATH_THRESHOLD = 20  # Requests per hour to one sensitive prefix
+LOGIN_THRESHOLD = 10  # Login attempts per hour
+
+DEFAULT_ANOMALY_RULES = [
+    {
+        "name": "high_volume",
+        "threshold": HIGH_VOLUME_THRESHOLD,
+        "reason": "High request volume: {count} requests in the last hour",
+    },
+    *(
+        {
+            "name": f"sensitive_{prefix.strip('/')}",
+            "path_prefix": prefix,
+            "threshold": SENSITIVE_PATH_THRESHOLD,
+            "reason": f"Excessive access to sensitive path '{prefix}': "
+            "{count} requests in the last hour",
+        }
+        for prefix in SENSITIVE_PATHS
+    ),
+    {
+        "name": "brute_force",
+        "path": LOGIN_PATH,
+        "threshold": LOGIN_THRESHOLD,
+        "reason": "Possible brute force attack: {count} login attempts in the last hour",
+        "dedupe_reason": "login",
+    },
+]
+
+RULE_ACTIONS = ("flag", "block")
+# Rule names become aggregate aliases and must not shadow model fields
+RESERVED_RULE_NAMES = {"id", "ip_address", "path", "timestamp", "country", "city"}
+RESERVED_RULE_NAMES |= {"bucket", "count", "path_prefix"}
+
+
+class AnomalyRule:
+    """
+    One detection rule: more than threshold requests from an IP within
+    window seconds, counting all requests or only those to an exact path or
+    below a path prefix. The action is "flag" (create a SuspiciousIP) or
+    "block" (also block the IP). A flag is skipped if the IP was flagged
+    within the last 24 hours, only by flags whose reason contains
+    dedupe_reason when it is set.
+    """
+
+    def __init__(
+        self,
+        name,
+        threshold,
+        window=3600,
+        path=None,
+        path_prefix=None,
+        action="flag",
+        reason=None,
+        dedupe_reason=None,
+    ):
+        if not str(name).isidentifier() or name in RESERVED_RULE_NAMES:
+            raise ImproperlyConfigured(f"Invalid anomaly rule name: {name!r}")
+        if path and path_prefix:
+            raise ImproperlyConfigured(
+                f"Anomaly rule {name} sets both path and path_prefix"
+            )
+        if action not in RULE_ACTIONS:
+            raise ImproperlyConfigured(
+                f"Unknown action {action!r} for anomaly rule {name}"
+            )
+        self.name = name
+        self.threshold = int(threshold)
+        self.window = int(window)
+        self.path = path
+        self.path_prefix = path_prefix
+        self.action = action
+        self.reason = reason or (
+            f"Anomaly rule '{name}': {{count}} requests in {self.window} seconds"
+        )
+        self.dedupe_reason = dedupe_reason
+
+    def matches(self, path):
+        """Whether a request path counts towards the rule"""
+        if self.path:
+            return path == self.path
+        if self.path_prefix:
+            return path.startswith(self.path_prefix)
+        return True
+
+    def path_filter(self):
+        """RequestLog filter of the rule's path matcher"""
+        if self.path:
+            return Q(path=self.path)
+        if self.path_prefix:
+            return Q(path__startswith=self.path_prefix)
+        return Q()
+
+    @property
+    def rollup_key(self):
+        """PathRollup.path_prefix counted by the rule, None for all requests"""
+        if self.path:
+            return exact_path_key(self.path)
+        return self.path_prefix
+
+    def format_reason(self, count):
+        """SuspiciousIP.reason of a flag with count requests"""
+        return self.reason.format(count=count, name=self.name, window=self.window)
+
+    def __repr__(self):
+        return f"<AnomalyRule {self.name} > {self.threshold}/{self.window}s>"
+
+
+# pylint: disable=no-member
+class DetectionPlan:
+    """
+    Anomaly rules compiled into one evaluation plan.
+
+    aggregate() counts every rule per IP address in a single GROUP BY over
+    RequestLog, with one filtered COUNT per rule and a HAVING clause that
+    keeps IPs exceeding any threshold, so adding a rule adds a column but no
+    table scan. With rollups enabled, the plan reads RequestRollup and
+    PathRollup instead. The realtime detector evaluates the same rules over
+    its streaming counters. evaluate() applies the rules in order.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        if not self.rules:
+            raise ImproperlyConfigured("At least one anomaly rule is required")
+        names = [rule.name for rule in self.rules]
+        if len(set(names)) != len(names):
+            raise ImproperlyConfigured("Anomaly rule names must be unique")
+
+        self.max_window = max(rule.window for rule in self.rules)
+        self.min_threshold = min(rule.threshold for rule in self.rules)
+
+    @classmethod
+    def from_settings(cls):
+        """Compile IP_TRACKING_ANOMALY_RULES, or the built-in rules"""
+        rules = getattr(settings, "IP_TRACKING_ANOMALY_RULES", None)
+        return cls(AnomalyRule(**rule) for rule in rules or DEFAULT_ANOMALY_RULES)
+
+    def matching_rules(self, path):
+        """Rules a request path counts towards"""
+        return [rule for rule in self.rules if rule.matches(path)]
+
+    def exceeds(self):
+        """HAVING condition: any rule above its threshold"""
+        condition = Q()
+        for rule in self.rules:
+            condition |= Q(**{f"{rule.name}__gt": rule.threshold})
+        return condition
+
+    def aggregate(self, now=None, ip_addresses=None, ip_range=None):
+        """
+        Count every rule per IP address.
+        Returns a list of dicts with ip_address and one count per rule name,
+        for the IPs exceeding at least one threshold. ip_addresses
+        restricts the pass to the given IPs and ip_range to a shard (see
+        ip_range_filter).
+        """
+        now = now or timezone.now()
+        if getattr(settings, "IP_TRACKING_ROLLUPS_ENABLED", False):
+            if self.rollup_compatible():
+                return self.rollup_aggregate(now, ip_addresses, ip_range)
+            logger.warning(
+                "Anomaly rules use paths the rollups do not track, "
+                "counting RequestLog instead"
+            )
+
+        counters = {}
+        for rule in self.rules:
+            condition = rule.path_filter()
+            if rule.window < self.max_window:
+                condition &= Q(timestamp__gte=now - timedelta(seconds=rule.window))
+            counters[rule.name] = Count("id", filter=condition or None)
+
+        logs = RequestLog.objects.filter(
+            ip_range_filter(ip_range),
+            timestamp__gte=now - timedelta(seconds=self.max_window),
+        )
+        if ip_addresses is not None:
+            logs = logs.filter(ip_address__in=ip_addresses)
+        return list(
+            logs.values("ip_address")
+            .annotate(**counters)
+            .filter(self.exceeds())
+            .order_by()
+        )
+
+    def rollup_compatible(self):
+        """Whether every rule's path matcher is counted by the rollups"""
+        tracked = set(
+            getattr(settings, "IP_TRACKING_ROLLUP_PATH_PREFIXES", ROLLUP_PATH_PREFIXES)
+        )
+        tracked.update(
+            exact_path_key(path)
+            for path in getattr(
+                settings, "IP_TRACKING_ROLLUP_EXACT_PATHS", ROLLUP_EXACT_PATHS
+            )
+        )
+        return all(
+            rule.rollup_key is None or rule.rollup_key in tracked for rule in self.rules
+        )
+
+    def rollup_aggregate(self, now, ip_addresses=None, ip_range=None):
+        """
+        Rollup version of aggregate: one aggregate pass over RequestRollup
+        for the rules counting all requests and one over PathRollup for the
+        path rules, plus one lookup each for the IPs only the other pass
+        found. Windows start at the beginning of their first minute bucket.
+        """
+
+        def since(rule):
+            return window_start(now, rule.window)
+
+        total_rules = [rule for rule in self.rules if rule.rollup_key is None]
+        path_rules = [rule for rule in self.rules if rule.rollup_key is not None]
+        queries = []
+        for rules, model, counters in (
+            (
+                total_rules,
+                RequestRollup,
+                {
+                    rule.name: Sum("count", filter=Q(bucket__gte=since(rule)))
+                    for rule in total_rules
+                },
+            ),
+            (
+                path_rules,
+                PathRollup,
+                {
+                    rule.name: Sum(
+                        "count",
+                        filter=Q(bucket__gte=since(rule), path_prefix=rule.rollup_key),
+                    )
+                    for rule in path_rules
+                },
+            ),
+        ):
+            if not rules:
+                continue
+            rollups = model.objects.filter(
+                ip_range_filter(ip_range),
+                bucket__gte=window_start(now, self.max_window),
+            )
+            if ip_addresses is not None:
+                rollups = rollups.filter(ip_address__in=ip_addresses)
+            exceeds = Q()
+            for rule in rules:
+                exceeds |= Q(**{f"{rule.name}__gt": rule.threshold})
+            queries.append(
+                (
+                    rollups.values("ip_address").annotate(**counters).order_by(),
+                    exceeds,
+                )
+            )
+
+        results = [
+            {item.pop("ip_address"): item for item in queryset.filter(exceeds)}
+            for queryset, exceeds in queries
+        ]
+        if len(results) == 2:
+            # Fill in the other pass's counters of IPs only one pass found
+            for index, (queryset, _) in enumerate(queries):
+                found, other = results[index], results[1 - index]
+                missing = [
+                    ip_address for ip_address in other if ip_address not in found
+                ]
+                if missing:
+                    for item in queryset.filter(ip_address__in=missing):
+                        found[item.pop("ip_address")] = item
+
+        counts = []
+        ip_addresses = dict.fromkeys(ip for result in results for ip in result)
+        for ip_address in ip_addresses:
+            item = {"ip_address": ip_address}
+            for rule in self.rules:
+                item[rule.name] = 0
+            for result in results:
+                for name, count in result.get(ip_address, {}).items():
+                    item[name] = count or 0
+            counts.append(item)
+        return counts
+
+    def counter_aggregate(self, now=None, ip_addresses=None):
+        """
+        Like aggregate, from the per-rule minute counters maintained by the
+        incremental detection (see ip_tracking.incremental).
+        """
+        now = now or timezone.now()
+        counters = {
+            rule.name: Sum(
+                "count",
+                filter=Q(rule=rule.name, bucket__gte=window_start(now, rule.window)),
+            )
+            for rule in self.rules
+        }
+        rows = DetectionCounter.objects.filter(
+            bucket__gte=window_start(now, self.max_window)
+        )
+        if ip_addresses is not None:
+            rows = rows.filter(ip_address__in=ip_addresses)
+
+        counts = list(
+            rows.values("ip_address")
+            .annotate(**counters)
+            .filter(self.exceeds())
+            .order_by()
+        )
+        for item in counts:
+            for rule in self.rules:
+                item[rule.name] = item[rule.name] or 0
+        return counts
+
+    def evaluate(self, counts):
+        """
+        Yield (rule, ip_address, count) for every rule exceeded, rule by
+        rule in plan order.
+        """
+        for rule in self.rules:
+            for item in counts:
+                count = item[rule.name]
+                if count > rule.threshold:
+                    yield rule, item["ip_address"], count
+
+
+def ip_range_filter(ip_range):
+    """
+    Filter of the IP addresses in a (lower, upper) shard range, lower
+    inclusive and upper exclusive in database order; None is an open end.
+    """
+    condition = Q()
+    lower, upper = ip_range or (None, None)
+    if lower is not None:
+        condition &= Q(ip_address__gte=lower)
+    if upper is not None:
+        condition &= Q(ip_address__lt=upper)
+    return condition
+
+
+def window_start(now, window):
+    """Start of the minute bucket a window of seconds ending at now begins in"""
+    return bucket_start(get_bucket(now - timedelta(seconds=window)))
+
+
+def get_detection_plan():
+    """Compile the configured anomaly rules"""
+    return DetectionPlan.from_settings()
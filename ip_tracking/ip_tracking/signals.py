@@ -0,0 +1,17 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .blocklist import publish_blocklist_on_commit
+from .models import BlockedIP, BlockedNetwork
+
+
+# pylint: disable=unused-argument
+@receiver(post_save, sender=BlockedIP)
+@receiver(post_delete, sender=BlockedIP)
+@receiver(post_save, sender=BlockedNetwork)
+@receiver(post_delete, sender=BlockedNetwork)
+def invalidate_blocklist(sender, **kwargs):
+    """
+    Publish the blocklist to every worker once the change is committed,
+    once per transaction however many blocks it changes.
+    """
+    publish_blocklist_on_commit()
@@ -0,0 +1,206 @@
+import json
+import logging
+import threading
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .log_buffer import get_request_log_buffer
+from .log_stream import get_request_log_stream
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOG_SINK = "ip_tracking.sinks.ORMSink"
+
+
+# pylint: disable=broad-exception-caught
+class BaseSink:
+    """
+    Destination for the RequestLog rows created by IPTrackingMiddleware.
+
+    Subclasses implement write() (and awrite() when they have a native async
+    path) and return False when an entry is rejected, e.g. a full buffer.
+    emit() and aemit() time every call and count emitted, rejected and
+    failed entries, so sinks can be compared through stats().
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+        # Counters
+        self.emitted = 0
+        self.rejected = 0
+        self.errors = 0
+        self.emit_time = 0.0
+
+    def write(self, log_entry):
+        """Store an unsaved RequestLog instance"""
+        raise NotImplementedError
+
+    async def awrite(self, log_entry):
+        """
+        Async version of write, by default calls write directly.
+        Sinks whose write() blocks on I/O must override it.
+        """
+        return self.write(log_entry)
+
+    def emit(self, log_entry):
+        """
+        Hand a request log to the sink.
+        Returns False if the entry was rejected or could not be stored.
+        """
+        start = time.perf_counter()
+        try:
+            result = self.write(log_entry)
+        except Exception as e:
+            result = e
+        return self._record(log_entry, result, time.perf_counter() - start)
+
+    async def aemit(self, log_entry):
+        """Async version of emit"""
+        start = time.perf_counter()
+        try:
+            result = await self.awrite(log_entry)
+        except Exception as e:
+            result = e
+        return self._record(log_entry, result, time.perf_counter() - start)
+
+    def _record(self, log_entry, result, elapsed):
+        with self._lock:
+            self.emit_time += elapsed
+            if isinstance(result, Exception):
+                self.errors += 1
+            elif result is False:
+                self.rejected += 1
+            else:
+                self.emitted += 1
+
+        if isinstance(result, Exception):
+            logger.error("Failed to log request: %s", result)
+            return False
+        if result is False:
+            logger.warning("%s dropped log for IP=%s", self, log_entry.ip_address)
+            return False
+        return True
+
+    def stats(self):
+        """Return throughput and error counters"""
+        with self._lock:
+            calls = self.emitted + self.rejected + self.errors
+            return {
+                "sink": str(self),
+                "emitted": self.emitted,
+                "rejected": self.rejected,
+                "errors": self.errors,
+                "emitted_per_second": round(
+                    self.emitted / max(time.monotonic() - self.started, 1e-9), 2
+                ),
+                "avg_emit_us": round(self.emit_time / calls * 1e6, 2) if calls else 0,
+            }
+
+    def __str__(self):
+        return type(self).__name__
+
+
+class ORMSink(BaseSink):
+    """Save every row on the request path"""
+
+    def write(self, log_entry):
+        log_entry.save()
+
+    async def awrite(self, log_entry):
+        await log_entry.asave()
+
+
+class BufferedORMSink(BaseSink):
+    """Queue rows in the process-wide RequestLogBuffer for bulk_create"""
+
+    def write(self, log_entry):
+        return get_request_log_buffer().add(log_entry)
+
+    def stats(self):
+        data = super().stats()
+        data["buffer"] = get_request_log_buffer().stats()
+        return data
+
+
+class RedisStreamSink(BaseSink):
+    """Append rows to the request log Redis Stream"""
+
+    def write(self, log_entry):
+        return get_request_log_stream().add(log_entry)
+
+    async def awrite(self, log_entry):
+        return await get_request_log_stream().aadd(log_entry)
+
+    def stats(self):
+        data = super().stats()
+        data["stream"] = get_request_log_stream().stats()
+        return data
+
+
+class FileSink(BaseSink):
+    """
+    Append rows as JSON lines to a local file.
+    The file is opened once per process and only appended to, so it can be
+    shipped or loaded into the database by other tools.
+    """
+
+    def __init__(self, path=None):
+        super().__init__()
+        self.path = path or getattr(
+            settings, "IP_TRACKING_LOG_FILE", "request_logs.jsonl"
+        )
+        self._file = None
+        self._file_lock = threading.Lock()
+
+    async def awrite(self, log_entry):
+        # File writes block, so they run in a worker thread. It is not the
+        # thread shared with sync views and the ORM, which they would hold up
+        return await sync_to_async(self.write, thread_sensitive=False)(log_entry)
+
+    def write(self, log_entry):
+        line = json.dumps(
+            {
+                "timestamp": log_entry.timestamp.isoformat(),
+                "ip_address": log_entry.ip_address,
+                "path": log_entry.path,
+                "country": log_entry.country,
+                "city": log_entry.city,
+            }
+        )
+        with self._file_lock:
+            if self._file is None:
+                # pylint: disable=consider-using-with
+                self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+            self._file.write(line + "\n")
+
+
+class NullSink(BaseSink):
+    """Discard every row, for benchmarks and deployments without logging"""
+
+    def write(self, log_entry):
+        return None
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_log_sink_path():
+    """Dotted path of the sink configured by IP_TRACKING_LOG_SINK"""
+    return getattr(settings, "IP_TRACKING_LOG_SINK", None) or DEFAULT_LOG_SINK
+
+
+def get_log_sink():
+    """
+    Return the process-wide request log sink.
+    The sink is instantiated once per process.
+    """
+    global _sink  # pylint: disable=global-statement
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                _sink = import_string(get_log_sink_path())()
+    return _sink
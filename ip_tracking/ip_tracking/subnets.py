@@ -0,0 +1,225 @@
+import ipaddress
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import CharField, Count, Sum, Value
+from django.db.models.functions import Cast, Left, Length, Reverse, StrIndex
+from django.utils import timezone
+from .models import RequestLog, RequestRollup
+from .rollups import use_rollups
+from .rules import window_start
+
+logger = logging.getLogger(__name__)
+
+SUBNET_IPV4_PREFIX = 24
+SUBNET_IPV6_PREFIX = 64
+SUBNET_WINDOW = 3600  # Seconds, matching detect_anomalies
+SUBNET_THRESHOLD = 500  # Requests per hour from one subnet
+SUBNET_MIN_IPS = 5  # Busy single IPs are left to the per-IP rules
+SUBNET_CHUNK_SIZE = 10000
+SUBNET_MAX_ROWS = 100000  # Busiest IPs masked in Python, see per_ip_counts
+
+ADDRESS_BITS = {4: 32, 6: 128}
+ADDRESS_TYPES = {4: ipaddress.IPv4Address, 6: ipaddress.IPv6Address}
+
+
+def use_subnet_detection():
+    """Whether detect_subnet_anomalies runs"""
+    return getattr(settings, "IP_TRACKING_SUBNET_DETECTION", False)
+
+
+def octet_prefix(field, octets):
+    """
+    SQL expression of the first octets of the IPv4 addresses in field,
+    e.g. "203.0.113" for 203.0.113.7 and three octets. Cuts the text at
+    its last "." once per dropped octet; the cast turns a PostgreSQL inet
+    into text ("203.0.113.7/32"), whose suffix is cut along with the octet.
+    """
+    expression = Cast(field, CharField())
+    for _ in range(4 - octets):
+        expression = Left(
+            expression, Length(expression) - StrIndex(Reverse(expression), Value("."))
+        )
+    return expression
+
+
+def prefix_mask(version, prefix_length):
+    """Integer netmask of a prefix length"""
+    bits = ADDRESS_BITS[version]
+    if not 0 < prefix_length <= bits:
+        raise ImproperlyConfigured(
+            f"Invalid IPv{version} subnet prefix length: {prefix_length}"
+        )
+    return ((1 << prefix_length) - 1) << (bits - prefix_length)
+
+
+# pylint: disable=no-member
+class SubnetAggregator:
+    """
+    Per-subnet request counts for distributed sources.
+
+    Scrapers that rotate through a /24 (or an IPv6 /64) stay below every
+    per-IP threshold, so a subnet is flagged once its IPs together exceed
+    the threshold. IPv4 prefixes on an octet boundary (/8, /16, /24) are
+    masked inside the aggregate query (over RequestRollup with rollups
+    enabled): it groups by the leading octets of the address text and only
+    returns the subnets above the thresholds.
+
+    IPv6 addresses are stored compressed ("2001:db8::1"), so their text has
+    no fixed prefix to group by, and other IPv4 prefixes do not line up with
+    the text either. For those, the per-IP counts of the window are masked
+    as integers in Python, limited to the max_rows busiest IPs.
+    """
+
+    def __init__(
+        self,
+        ipv4_prefix=SUBNET_IPV4_PREFIX,
+        ipv6_prefix=SUBNET_IPV6_PREFIX,
+        threshold=SUBNET_THRESHOLD,
+        min_ips=SUBNET_MIN_IPS,
+        window=SUBNET_WINDOW,
+        max_rows=SUBNET_MAX_ROWS,
+    ):
+        self.prefix_lengths = {4: ipv4_prefix, 6: ipv6_prefix}
+        self.masks = {
+            version: prefix_mask(version, prefix_length)
+            for version, prefix_length in self.prefix_lengths.items()
+        }
+        self.threshold = threshold
+        self.min_ips = min_ips
+        self.window = window
+        self.max_rows = max_rows
+
+    @classmethod
+    def from_settings(cls):
+        """Build an aggregator from the IP_TRACKING_SUBNET_* settings"""
+        return cls(
+            ipv4_prefix=getattr(
+                settings, "IP_TRACKING_SUBNET_IPV4_PREFIX", SUBNET_IPV4_PREFIX
+            ),
+            ipv6_prefix=getattr(
+                settings, "IP_TRACKING_SUBNET_IPV6_PREFIX", SUBNET_IPV6_PREFIX
+            ),
+            threshold=getattr(
+                settings, "IP_TRACKING_SUBNET_THRESHOLD", SUBNET_THRESHOLD
+            ),
+            min_ips=getattr(settings, "IP_TRACKING_SUBNET_MIN_IPS", SUBNET_MIN_IPS),
+            max_rows=getattr(settings, "IP_TRACKING_SUBNET_MAX_ROWS", SUBNET_MAX_ROWS),
+        )
+
+    def subnet_of(self, ip_address):
+        """(version, integer network address) of the subnet of an IP"""
+        address = ipaddress.ip_address(ip_address)
+        return address.version, int(address) & self.masks[address.version]
+
+    def recent(self, now):
+        """Rows of the window and the expression counting their requests"""
+        if use_rollups():
+            rows = RequestRollup.objects.filter(
+                bucket__gte=window_start(now, self.window)
+            )
+            return rows, Sum("count")
+        rows = RequestLog.objects.filter(
+            timestamp__gte=now - timedelta(seconds=self.window)
+        )
+        return rows, Count("id")
+
+    def masked_in_sql(self):
+        """Whether the IPv4 prefix can be masked inside the aggregate query"""
+        return self.prefix_lengths[4] in (8, 16, 24)
+
+    def ipv4_subnet_counts(self, now):
+        """
+        (network address, request count, IP count) of the IPv4 subnets
+        exceeding the thresholds, from one GROUP BY over the subnet prefix.
+        """
+        octets = self.prefix_lengths[4] // 8
+        rows, total = self.recent(now)
+        rows = (
+            rows.exclude(ip_address__contains=":")
+            .annotate(subnet=octet_prefix("ip_address", octets))
+            .values_list("subnet")
+            .annotate(request_count=total, ip_count=Count("ip_address", distinct=True))
+            .filter(request_count__gt=self.threshold, ip_count__gte=self.min_ips)
+            .order_by()
+        )
+        padding = ".0" * (4 - octets)
+        for subnet, request_count, ip_count in rows:
+            yield f"{subnet}{padding}", request_count, ip_count
+
+    def per_ip_counts(self, now):
+        """
+        (ip_address, request count) of the IPs active within the window
+        whose subnets are masked in Python, busiest first and at most
+        max_rows of them.
+        """
+        rows, total = self.recent(now)
+        if self.masked_in_sql():
+            rows = rows.filter(ip_address__contains=":")
+        rows = (
+            rows.values_list("ip_address")
+            .annotate(total=total)
+            .order_by("-total")[: self.max_rows]
+        )
+        return rows.iterator(chunk_size=SUBNET_CHUNK_SIZE)
+
+    def aggregate(self, now=None):
+        """
+        Count requests per subnet.
+        Returns a list of dicts with ip_address (the network address),
+        prefix_length, network, request_count and ip_count for the subnets
+        exceeding the threshold with at least min_ips active IPs, busiest
+        first.
+        """
+        now = now or timezone.now()
+        subnets = {}
+        rows = 0
+        for ip_address, count in self.per_ip_counts(now):
+            rows += 1
+            try:
+                key = self.subnet_of(ip_address)
+            except ValueError:
+                continue
+            totals = subnets.setdefault(key, [0, 0])
+            totals[0] += count
+            totals[1] += 1
+        if rows >= self.max_rows:
+            logger.warning(
+                "Subnet detection only masked the %s busiest IPs", self.max_rows
+            )
+
+        counts = [
+            (str(ADDRESS_TYPES[version](network)), version, request_count, ip_count)
+            for (version, network), (request_count, ip_count) in subnets.items()
+            if request_count > self.threshold and ip_count >= self.min_ips
+        ]
+        if self.masked_in_sql():
+            counts.extend(
+                (address, 4, request_count, ip_count)
+                for address, request_count, ip_count in self.ipv4_subnet_counts(now)
+            )
+
+        found = []
+        for address, version, request_count, ip_count in counts:
+            prefix_length = self.prefix_lengths[version]
+            found.append(
+                {
+                    "ip_address": address,
+                    "prefix_length": prefix_length,
+                    "network": f"{address}/{prefix_length}",
+                    "request_count": request_count,
+                    "ip_count": ip_count,
+                }
+            )
+        found.sort(key=lambda subnet: subnet["request_count"], reverse=True)
+        return found
+
+
+def describe_subnet(subnet):
+    """SuspiciousIP.reason of a flagged subnet"""
+    return (
+        f"Distributed activity from subnet {subnet['network']}: "
+        f"{subnet['request_count']} requests from {subnet['ip_count']} IPs "
+        "in the last hour"
+    )
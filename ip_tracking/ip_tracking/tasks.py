@@ -1,154 +1,555 @@
-from datetime import timedelta
+from collections import defaultdict
+from datetime import datetime, timedelta
 import logging
-from celery import shared_task
+import redis
+from celery import chord, shared_task
+from django.conf import settings
 from django.utils import timezone
-from django.db.models import Count
-from .models import RequestLog, SuspiciousIP, BlockedIP
+from django.db import transaction
+from django.db.models import Count, Q
+from .models import (
+    BlockedIP,
+    BlockedNetwork,
+    PathRollup,
+    RequestLog,
+    RequestRollup,
+    SuspiciousIP,
+)
+from .baseline import (
+    StatisticalBaseline,
+    TrafficMatrix,
+    describe_outlier,
+    use_baseline,
+)
+from .blocklist import NetworkBlocklist, publish_blocklist_on_commit
+from .distinct_paths import (
+    describe_scanner,
+    get_distinct_path_tracker,
+    use_distinct_paths,
+)
+from .geolocation import get_geolocation_many
+from .heavy_hitters import get_heavy_hitter_tracker, use_heavy_hitters
+from .incremental import IncrementalDetector, use_incremental_detection
+from .log_stream import get_request_log_stream
+from .realtime import get_realtime_detector
+from .rollups import get_rollup_tracker, use_rollups
+from .rules import (  # pylint: disable=unused-import
+    HIGH_VOLUME_THRESHOLD,
+    LOGIN_PATH,
+    LOGIN_THRESHOLD,
+    SENSITIVE_PATH_THRESHOLD,
+    SENSITIVE_PATHS,
+    get_detection_plan,
+)
+from .subnets import SubnetAggregator, describe_subnet, use_subnet_detection
 
 logger = logging.getLogger(__name__)
 
+SHARD_SAMPLE_SIZE = 10000  # Recent requests sampled to pick shard boundaries
+IN_CHUNK_SIZE = 500  # Values per IN (...) lookup, below SQLite's parameter limit
+
+
+def chunked(items, size=IN_CHUNK_SIZE):
+    """Split a list into lists of at most size items"""
+    return [items[start : start + size] for start in range(0, len(items), size)]
+
 
 # pylint: disable=no-member
+def get_anomaly_counts(now=None, ip_addresses=None, plan=None):
+    """
+    Count every anomaly rule per IP address in a single aggregate pass.
+
+    Returns a list of dicts with ip_address and one count per rule name,
+    for the IPs exceeding at least one threshold (see DetectionPlan).
+    """
+    plan = plan or get_detection_plan()
+    return plan.aggregate(now, ip_addresses)
+
+
+def get_prefilter_candidates(plan):
+    """
+    IPs that may exceed a detection threshold according to the heavy-hitter
+    sketch, with IP_TRACKING_HEAVY_HITTERS_PREFILTER set. Returns None (no
+    prefilter) otherwise, when a rule's window is longer than the sketch's
+    or when Redis is unavailable.
+    """
+    if not (
+        use_heavy_hitters()
+        and getattr(settings, "IP_TRACKING_HEAVY_HITTERS_PREFILTER", False)
+    ):
+        return None
+    tracker = get_heavy_hitter_tracker()
+    if plan.max_window > tracker.window:
+        return None
+    # No rule can fire for an IP with at most the lowest threshold's requests
+    try:
+        candidates = tracker.candidates(plan.min_threshold)
+    except redis.RedisError as e:
+        logger.error("Heavy-hitter prefilter unavailable: %s", e)
+        return None
+    logger.info("Heavy-hitter prefilter kept %s IPs", len(candidates))
+    return candidates
+
+
+class SuspiciousIPBatch:
+    """
+    New SuspiciousIP flags of one detection run.
+
+    The flags of the last 24 hours and the blocks of the candidate IPs are
+    loaded up front, IN_CHUNK_SIZE IPs per query, and new flags are written
+    with a single bulk_create, so the number of queries does not grow with
+    the number of flags or blocks. Subnet flags (with a prefix_length) are
+    tracked by network, with ip_addresses holding the network addresses;
+    the blocked networks are loaded once when the first subnet is added.
+    """
+
+    def __init__(self, ip_addresses):
+        since = timezone.now() - timedelta(hours=24)
+        self.recent_reasons = defaultdict(list)
+        self.blocked = set()
+        for chunk in chunked(sorted(set(ip_addresses))):
+            for ip_address, prefix_length, reason in SuspiciousIP.objects.filter(
+                ip_address__in=chunk, flagged_at__gte=since, is_resolved=False
+            ).values_list("ip_address", "prefix_length", "reason"):
+                key = SuspiciousIP(ip_address=ip_address, prefix_length=prefix_length)
+                self.recent_reasons[key.network].append(reason.lower())
+            self.blocked.update(
+                BlockedIP.objects.filter(
+                    ip_address__in=chunk, is_active=True
+                ).values_list("ip_address", flat=True)
+            )
+        self.blocked_networks = None
+        self.flags = []
+
+    def is_blocked(self, flag):
+        """Whether a flag's IP, or its whole subnet, is blocked already"""
+        if flag.prefix_length is None:
+            return flag.ip_address in self.blocked
+        if self.blocked_networks is None:
+            self.blocked_networks = NetworkBlocklist(
+                BlockedNetwork.objects.filter(is_active=True).values_list(
+                    "network", flat=True
+                )
+            )
+        covering = self.blocked_networks.match(flag.ip_address)
+        return covering is not None and (
+            int(covering.rsplit("/", 1)[1]) <= flag.prefix_length
+        )
+
+    def add(
+        self,
+        ip_address,
+        reason,
+        request_count,
+        dedupe_reason=None,
+        prefix_length=None,
+    ):
+        """
+        Queue a flag unless the IP (or with prefix_length the subnet) is
+        blocked or was flagged within the last 24 hours (only by flags whose
+        reason contains dedupe_reason, if given). Returns True if a flag was
+        queued.
+        """
+        flag = SuspiciousIP(
+            ip_address=ip_address,
+            prefix_length=prefix_length,
+            reason=reason,
+            request_count=request_count,
+        )
+        if self.is_blocked(flag):
+            return False
+        recent_reasons = self.recent_reasons.get(flag.network, [])
+        if dedupe_reason:
+            # Case-insensitive like reason__contains on SQLite
+            dedupe_reason = dedupe_reason.lower()
+            recent_reasons = [r for r in recent_reasons if dedupe_reason in r]
+        if recent_reasons:
+            return False
+
+        self.flags.append(flag)
+        self.recent_reasons[flag.network].append(reason.lower())
+        return True
+
+    def save(self):
+        """Write the queued flags, returns how many were written"""
+        SuspiciousIP.objects.bulk_create(self.flags, batch_size=1000)
+        return len(self.flags)
+
+
 @shared_task
 def detect_anomalies():
     """
-    Celery task to detect suspicious IP addresses based on:
+    Celery task to detect suspicious IP addresses with the anomaly rules of
+    IP_TRACKING_ANOMALY_RULES (see ip_tracking.rules). The built-in rules
+    flag:
     1. High request volume (>100 requests/hour)
     2. Accessing sensitive paths (e.g., /admin, /login)
-
-    Runs hourly to flag suspicious IPs.
+    3. Repeated login attempts (>10 requests/hour to /login)
+
+    All rules are counted in one aggregate pass (see get_anomaly_counts)
+    and then applied in order, so an IP flagged by an earlier rule is not
+    flagged again by a later one in the same run, unless the later rule has
+    a dedupe_reason. IPs exceeding a rule with the "block" action are also
+    blocked.
+
+    Runs hourly to flag suspicious IPs. With IP_TRACKING_ROLLUPS_ENABLED set
+    the counts come from the per-minute rollup tables instead of RequestLog.
+    With IP_TRACKING_INCREMENTAL_DETECTION set detect_anomalies_incremental
+    takes over and this task does nothing.
     """
+    if use_incremental_detection():
+        return None
+    shards = getattr(settings, "IP_TRACKING_DETECTION_SHARDS", 1)
+    if shards > 1:
+        return fan_out_detection(shards)
     logger.info("Starting anomaly detection task...")
 
-    # Time range: last hour
-    one_hour_ago = timezone.now() - timedelta(hours=1)
+    plan = get_detection_plan()
+    candidates = get_anomaly_counts(
+        ip_addresses=get_prefilter_candidates(plan), plan=plan
+    )
+    return apply_anomaly_rules(plan, candidates)
 
-    # Sensitive paths to monitor
-    sensitive_paths = ["/admin", "/login", "/register", "/api"]
 
-    flagged_count = 0
+@shared_task
+def detect_anomalies_incremental():
+    """
+    Detect suspicious IP addresses from the request logs saved since the
+    last run (see IncrementalDetector), with IP_TRACKING_INCREMENTAL_DETECTION
+    set. Cheap enough to run every minute.
+    """
+    if not use_incremental_detection():
+        return None
+    plan = get_detection_plan()
+    candidates = IncrementalDetector(plan).run()
+    return apply_anomaly_rules(plan, candidates)
 
-    # 1. Detect high-volume IPs (>100 requests/hour)
-    high_volume_ips = (
-        RequestLog.objects.filter(timestamp__gte=one_hour_ago)
-        .values("ip_address")
-        .annotate(request_count=Count("id"))
-        .filter(request_count__gt=100)
+
+@shared_task
+def flag_realtime_ip(ip_address, claimed):
+    """
+    Create the flags (and the block, if configured) of an IP the realtime
+    detector saw crossing anomaly rules. claimed lists [rule name, sliding
+    count] pairs; rules no longer configured are ignored.
+    """
+    detector = get_realtime_detector()
+    rules = {rule.name: rule for rule in detector.plan.rules}
+    return detector.flag(
+        ip_address,
+        [(rules[name], count) for name, count in claimed if name in rules],
     )
 
-    for item in high_volume_ips:
-        ip_address = item["ip_address"]
-        request_count = item["request_count"]
 
-        # Check if already flagged recently (within last 24 hours)
-        recent_flag = SuspiciousIP.objects.filter(
-            ip_address=ip_address,
-            flagged_at__gte=timezone.now() - timedelta(hours=24),
-            is_resolved=False,
-        ).exists()
-
-        # Check if already blocked
-        is_blocked = BlockedIP.objects.filter(
-            ip_address=ip_address, is_active=True
-        ).exists()
-
-        if not recent_flag and not is_blocked:
-            SuspiciousIP.objects.create(
-                ip_address=ip_address,
-                reason=f"High request volume: {request_count} requests in the last hour",
-                request_count=request_count,
-            )
-            flagged_count += 1
-            logger.warning(
-                "Flagged IP %s for high volume: %s requests/hour",
-                ip_address,
-                request_count,
-            )
+def fan_out_detection(shards):
+    """
+    Split the IP space into shards and detect anomalies in each shard in
+    parallel with a chord of detect_anomalies_shard tasks, reduced by
+    merge_detection_results. Every shard evaluates the same point in time.
+    """
+    now = timezone.now()
+    ranges = get_shard_ranges(shards, now - timedelta(hours=1))
+    chord(
+        [
+            detect_anomalies_shard.s(lower, upper, now.isoformat())
+            for lower, upper in ranges
+        ]
+    )(merge_detection_results.s())
+    logger.info("Started anomaly detection in %s shards", len(ranges))
+    return {"shards": len(ranges), "timestamp": now.isoformat()}
+
+
+def get_shard_ranges(shards, since, sample_size=SHARD_SAMPLE_SIZE):
+    """
+    Split the IP addresses into at most shards (lower, upper) ranges of
+    about the same number of recent requests. Boundaries are quantiles of
+    the IPs of the latest sample_size requests, read with one OFFSET lookup
+    each so the ranges follow the database's ordering of ip_address.
+    """
+    if use_rollups():
+        recent = RequestRollup.objects.filter(bucket__gte=since)
+    else:
+        recent = RequestLog.objects.filter(timestamp__gte=since)
+    oldest = recent.order_by("-id").values_list("id", flat=True)[
+        sample_size - 1 : sample_size
+    ]
+    if oldest:
+        recent = recent.filter(id__gte=oldest[0])
+    size = recent.count()
+    ordered = recent.order_by("ip_address").values_list("ip_address", flat=True)
+
+    boundaries = []
+    for index in range(1, shards):
+        offset = size * index // shards
+        # Rows deleted since count() leave the slice empty
+        for boundary in ordered[offset : offset + 1]:
+            if boundary not in boundaries:
+                boundaries.append(boundary)
+    edges = [None, *boundaries, None]
+    return list(zip(edges, edges[1:]))
 
-    # 2. Detect IPs accessing sensitive paths excessively
-    for path_prefix in sensitive_paths:
-        sensitive_ips = (
-            RequestLog.objects.filter(
-                timestamp__gte=one_hour_ago, path__startswith=path_prefix
-            )
-            .values("ip_address")
-            .annotate(request_count=Count("id"))
-            .filter(request_count__gt=20)  # More than 20 attempts on sensitive paths
-        )
 
-        for item in sensitive_ips:
-            ip_address = item["ip_address"]
-            request_count = item["request_count"]
-
-            # Check if already flagged recently
-            recent_flag = SuspiciousIP.objects.filter(
-                ip_address=ip_address,
-                flagged_at__gte=timezone.now() - timedelta(hours=24),
-                is_resolved=False,
-            ).exists()
-
-            # Check if already blocked
-            is_blocked = BlockedIP.objects.filter(
-                ip_address=ip_address, is_active=True
-            ).exists()
-
-            if not recent_flag and not is_blocked:
-                SuspiciousIP.objects.create(
-                    ip_address=ip_address,
-                    reason=f"Excessive access to sensitive path '{path_prefix}': {request_count} requests in the last hour",
-                    request_count=request_count,
-                )
-                flagged_count += 1
-                logger.warning(
-                    "Flagged IP %s for sensitive path access: %s requests to %s",
-                    ip_address,
-                    request_count,
-                    path_prefix,
-                )
-
-    # 3. Detect failed login attempts (optional - requires tracking failed logins)
-    failed_login_ips = (
-        RequestLog.objects.filter(timestamp__gte=one_hour_ago, path="/login")
-        .values("ip_address")
-        .annotate(request_count=Count("id"))
-        .filter(request_count__gt=10)  # More than 10 login attempts
+@shared_task
+def detect_anomalies_shard(lower, upper, now=None):
+    """
+    Detect anomalies for the IP addresses in [lower, upper), one shard of
+    fan_out_detection. Flags and blocks are per IP, so shards do not need
+    to coordinate.
+    """
+    plan = get_detection_plan()
+    ip_range = (lower, upper)
+    candidates = plan.aggregate(
+        datetime.fromisoformat(now) if now else None,
+        ip_addresses=get_prefilter_candidates(plan),
+        ip_range=ip_range,
     )
+    return apply_anomaly_rules(plan, candidates)
 
-    for item in failed_login_ips:
-        ip_address = item["ip_address"]
-        request_count = item["request_count"]
 
-        recent_flag = SuspiciousIP.objects.filter(
-            ip_address=ip_address,
-            flagged_at__gte=timezone.now() - timedelta(hours=24),
-            is_resolved=False,
-            reason__contains="login",
-        ).exists()
-
-        is_blocked = BlockedIP.objects.filter(
-            ip_address=ip_address, is_active=True
-        ).exists()
-
-        if not recent_flag and not is_blocked:
-            SuspiciousIP.objects.create(
-                ip_address=ip_address,
-                reason=f"Possible brute force attack: {request_count} login attempts in the last hour",
-                request_count=request_count,
-            )
-            flagged_count += 1
-            logger.warning(
-                "Flagged IP %s for possible brute force: %s login attempts",
-                ip_address,
-                request_count,
-            )
+@shared_task
+def merge_detection_results(results):
+    """Add up the results of the detect_anomalies_shard tasks"""
+    flagged_count = sum(result["flagged_count"] for result in results)
+    blocked_count = sum(result["blocked_count"] for result in results)
+    logger.info(
+        "Anomaly detection completed in %s shards. Flagged %s suspicious IPs.",
+        len(results),
+        flagged_count,
+    )
+    return {
+        "flagged_count": flagged_count,
+        "blocked_count": blocked_count,
+        "shards": len(results),
+        "timestamp": timezone.now().isoformat(),
+    }
+
 
+def apply_anomaly_rules(plan, candidates):
+    """
+    Flag (and for "block" rules block) the IPs of get_anomaly_counts-style
+    candidates exceeding the plan's rules.
+    """
+    batch = SuspiciousIPBatch(item["ip_address"] for item in candidates)
+    block_reasons = {}
+
+    for rule, ip_address, request_count in plan.evaluate(candidates):
+        reason = rule.format_reason(request_count)
+        if batch.add(
+            ip_address, reason, request_count, dedupe_reason=rule.dedupe_reason
+        ):
+            logger.warning("Flagged IP %s (%s): %s", ip_address, rule.name, reason)
+            if rule.action == "block":
+                block_reasons.setdefault(ip_address, f"Automatically blocked: {reason}")
+
+    flagged_count = batch.save()
+    blocked = block_ips(block_reasons)
+    for ip_address in blocked:
+        logger.warning("Auto-blocked IP %s: %s", ip_address, block_reasons[ip_address])
     logger.info(
         "Anomaly detection completed. Flagged %s suspicious IPs.", flagged_count
     )
 
+    return {
+        "flagged_count": flagged_count,
+        "blocked_count": len(blocked),
+        "timestamp": timezone.now().isoformat(),
+    }
+
+
+@shared_task
+def detect_statistical_anomalies():
+    """
+    Flag IP addresses whose traffic is a statistical outlier (see
+    ip_tracking.baseline) with IP_TRACKING_BASELINE_ENABLED set. Runs
+    hourly, just after the hour it scores is complete.
+    """
+    if not use_baseline():
+        return None
+
+    traffic = TrafficMatrix.load()
+    outliers = StatisticalBaseline.from_settings().outliers(traffic)
+    batch = SuspiciousIPBatch(ip_address for ip_address, *_ in outliers)
+    for ip_address, feature, kind, score, count in outliers:
+        reason = describe_outlier(feature, kind, score, count)
+        if batch.add(ip_address, reason, count, dedupe_reason="statistical outlier"):
+            logger.warning("Flagged IP %s: %s", ip_address, reason)
+
+    flagged_count = batch.save()
+    logger.info(
+        "Statistical detection scored %s IPs. Flagged %s suspicious IPs.",
+        len(traffic.ip_addresses),
+        flagged_count,
+    )
+    return {"flagged_count": flagged_count, "timestamp": timezone.now().isoformat()}
+
+
+@shared_task
+def detect_path_scanners():
+    """
+    Flag IP addresses that requested more distinct paths than
+    IP_TRACKING_DISTINCT_PATHS_THRESHOLD, counted by the middleware in
+    Redis HyperLogLogs (see DistinctPathTracker), with
+    IP_TRACKING_DISTINCT_PATHS_ENABLED set. Vulnerability scanners stay
+    below the request volume rules but request thousands of paths.
+    """
+    if not use_distinct_paths():
+        return None
+
+    tracker = get_distinct_path_tracker()
+    try:
+        scanners = tracker.candidates()
+    except redis.RedisError as e:
+        logger.error("Distinct-path counts unavailable: %s", e)
+        return None
+
+    batch = SuspiciousIPBatch(ip_address for ip_address, _ in scanners)
+    for ip_address, count in scanners:
+        reason = describe_scanner(count, tracker.window)
+        if batch.add(ip_address, reason, count, dedupe_reason="vulnerability scan"):
+            logger.warning("Flagged IP %s: %s", ip_address, reason)
+
+    flagged_count = batch.save()
+    logger.info("Distinct-path detection flagged %s suspicious IPs.", flagged_count)
     return {"flagged_count": flagged_count, "timestamp": timezone.now().isoformat()}
 
 
+@shared_task
+def detect_subnet_anomalies():
+    """
+    Flag subnets whose IPs together made too many requests within the last
+    hour (see SubnetAggregator), with IP_TRACKING_SUBNET_DETECTION set.
+    Catches distributed scrapers that keep every single IP below the
+    per-IP thresholds.
+    """
+    if not use_subnet_detection():
+        return None
+
+    subnets = SubnetAggregator.from_settings().aggregate()
+    batch = SuspiciousIPBatch(subnet["ip_address"] for subnet in subnets)
+    for subnet in subnets:
+        reason = describe_subnet(subnet)
+        if batch.add(
+            subnet["ip_address"],
+            reason,
+            subnet["request_count"],
+            prefix_length=subnet["prefix_length"],
+        ):
+            logger.warning("Flagged subnet %s: %s", subnet["network"], reason)
+
+    flagged_count = batch.save()
+    logger.info(
+        "Subnet detection found %s busy subnets. Flagged %s.",
+        len(subnets),
+        flagged_count,
+    )
+    return {"flagged_count": flagged_count, "timestamp": timezone.now().isoformat()}
+
+
+def block_ips(reasons, ip_addresses=None):
+    """
+    Block IP addresses and resolve their open flags in bulk.
+
+    reasons maps IP addresses to BlockedIP reasons. ip_addresses may be a
+    subquery selecting the same IPs; otherwise the IPs are looked up
+    IN_CHUNK_SIZE at a time, so the number of IPs does not hit the database
+    parameter limit. Inactive blocks are reactivated and already active ones
+    left alone. Returns the IPs that were newly blocked.
+    """
+    if not reasons:
+        return []
+    if ip_addresses is None:
+        ip_address_chunks = chunked(list(reasons))
+    else:
+        ip_address_chunks = [ip_addresses]
+
+    existing = {
+        blocked.ip_address: blocked
+        for chunk in ip_address_chunks
+        for blocked in BlockedIP.objects.filter(ip_address__in=chunk)
+    }
+    created, reactivated = [], []
+    for ip_address, reason in reasons.items():
+        blocked = existing.get(ip_address)
+        if blocked is None:
+            created.append(
+                BlockedIP(ip_address=ip_address, reason=reason, is_active=True)
+            )
+        elif not blocked.is_active:
+            blocked.is_active = True
+            blocked.reason = reason
+            reactivated.append(blocked)
+
+    if created or reactivated:
+        with transaction.atomic():
+            # Mark all flags of the newly blocked IPs as resolved
+            for chunk in ip_address_chunks:
+                SuspiciousIP.objects.filter(
+                    ip_address__in=chunk,
+                    prefix_length__isnull=True,
+                    is_resolved=False,
+                ).exclude(
+                    ip_address__in=BlockedIP.objects.filter(is_active=True).values(
+                        "ip_address"
+                    )
+                ).update(
+                    is_resolved=True,
+                    resolved_at=timezone.now(),
+                    notes="Automatically blocked by system",
+                )
+            BlockedIP.objects.bulk_create(created, batch_size=1000)
+            BlockedIP.objects.bulk_update(
+                reactivated, ["is_active", "reason"], batch_size=1000
+            )
+            # Bulk writes skip the post_save signal
+            publish_blocklist_on_commit()
+    return [blocked.ip_address for blocked in created + reactivated]
+
+
+def block_networks(reasons):
+    """
+    Block subnets and resolve their open subnet flags in bulk, like
+    block_ips. reasons maps networks in CIDR notation to BlockedNetwork
+    reasons. Returns the networks that were newly blocked.
+    """
+    if not reasons:
+        return []
+
+    existing = {
+        blocked.network: blocked
+        for blocked in BlockedNetwork.objects.filter(network__in=list(reasons))
+    }
+    created, reactivated = [], []
+    for network, reason in reasons.items():
+        blocked = existing.get(network)
+        if blocked is None:
+            created.append(
+                BlockedNetwork(network=network, reason=reason, is_active=True)
+            )
+        elif not blocked.is_active:
+            blocked.is_active = True
+            blocked.reason = reason
+            reactivated.append(blocked)
+
+    newly_blocked = [blocked.network for blocked in created + reactivated]
+    if newly_blocked:
+        flags = Q()
+        for network in newly_blocked:
+            ip_address, prefix_length = network.rsplit("/", 1)
+            flags |= Q(ip_address=ip_address, prefix_length=int(prefix_length))
+        with transaction.atomic():
+            SuspiciousIP.objects.filter(flags, is_resolved=False).update(
+                is_resolved=True,
+                resolved_at=timezone.now(),
+                notes="Automatically blocked by system",
+            )
+            BlockedNetwork.objects.bulk_create(created, batch_size=1000)
+            BlockedNetwork.objects.bulk_update(
+                reactivated, ["is_active", "reason"], batch_size=1000
+            )
+            # Bulk writes skip the post_save signal
+            publish_blocklist_on_commit()
+    return newly_blocked
+
+
 @shared_task
 def cleanup_old_logs():
     """
@@ -158,6 +559,10 @@ def cleanup_old_logs():
     thirty_days_ago = timezone.now() - timedelta(days=30)
     deleted_count, _ = RequestLog.objects.filter(timestamp__lt=thirty_days_ago).delete()
     logger.info("Cleaned up %s old request logs", deleted_count)
+
+    # Rollups are kept for as long as the logs they summarize
+    RequestRollup.objects.filter(bucket__lt=thirty_days_ago).delete()
+    PathRollup.objects.filter(bucket__lt=thirty_days_ago).delete()
     return deleted_count
 
 
@@ -165,47 +570,118 @@ def cleanup_old_logs():
 def auto_block_suspicious_ips():
     """
     Optional task to automatically block IPs that have been flagged multiple times.
+    With IP_TRACKING_SUBNET_AUTO_BLOCK set, flagged subnets are blocked as
+    network ranges too.
     """
     # Find IPs flagged more than 3 times in the last 24 hours
     twenty_four_hours_ago = timezone.now() - timedelta(hours=24)
 
     suspicious_ips = (
         SuspiciousIP.objects.filter(
-            flagged_at__gte=twenty_four_hours_ago, is_resolved=False
+            flagged_at__gte=twenty_four_hours_ago,
+            prefix_length__isnull=True,
+            is_resolved=False,
         )
         .values("ip_address")
         .annotate(flag_count=Count("id"))
         .filter(flag_count__gte=3)
     )
 
-    blocked_count = 0
-    for item in suspicious_ips:
-        ip_address = item["ip_address"]
-        flag_count = item["flag_count"]
-
-        # Check if already blocked
-        already_blocked = BlockedIP.objects.filter(
-            ip_address=ip_address, is_active=True
-        ).exists()
-
-        if not already_blocked:
-            BlockedIP.objects.create(
-                ip_address=ip_address,
-                reason=f"Automatically blocked: Flagged {flag_count} times in 24 hours",
-                is_active=True,
-            )
-
-            # Mark all flags for this IP as resolved
-            SuspiciousIP.objects.filter(
-                ip_address=ip_address, is_resolved=False
-            ).update(
-                is_resolved=True,
-                resolved_at=timezone.now(),
-                notes="Automatically blocked by system",
-            )
+    flag_counts = {item["ip_address"]: item["flag_count"] for item in suspicious_ips}
+    blocked = block_ips(
+        {
+            ip_address: f"Automatically blocked: Flagged {flag_count} times in 24 hours"
+            for ip_address, flag_count in flag_counts.items()
+        },
+        suspicious_ips.values("ip_address"),
+    )
+    for ip_address in blocked:
+        logger.warning(
+            "Auto-blocked IP %s after %s flags", ip_address, flag_counts[ip_address]
+        )
 
-            blocked_count += 1
-            logger.warning("Auto-blocked IP %s after %s flags", ip_address, flag_count)
+    if getattr(settings, "IP_TRACKING_SUBNET_AUTO_BLOCK", False):
+        # Subnet detection flags a subnet at most once a day
+        subnet_flags = SuspiciousIP.objects.filter(
+            flagged_at__gte=twenty_four_hours_ago,
+            prefix_length__isnull=False,
+            is_resolved=False,
+        ).order_by("flagged_at")
+        blocked_networks = block_networks(
+            {
+                flag.network: f"Automatically blocked: {flag.reason}"
+                for flag in subnet_flags
+            }
+        )
+        for network in blocked_networks:
+            logger.warning("Auto-blocked subnet %s", network)
+        blocked += blocked_networks
 
-    logger.info("Auto-blocked %s IPs", blocked_count)
+    blocked_count = len(blocked)
+    logger.info("Auto-blocked %s IPs and networks", blocked_count)
     return blocked_count
+
+
+@shared_task
+def enrich_request_log_geolocation(max_ips=500, lookback_hours=24):
+    """
+    Fill in country/city for request logs saved without geolocation.
+
+    Works on unique IP addresses rather than rows: each IP is resolved once
+    (through the geolocation cache) and all of its pending rows are updated
+    with a single UPDATE. IPs that cannot be resolved are stored with empty
+    strings so they are not picked up again on the next run. IPs no backend
+    answered (API unavailable, rate budget used up) are left as they are
+    and retried on the next run.
+    """
+    since = timezone.now() - timedelta(hours=lookback_hours)
+    pending = RequestLog.objects.filter(
+        timestamp__gte=since, country__isnull=True, city__isnull=True
+    )
+
+    ip_addresses = list(
+        pending.order_by().values_list("ip_address", flat=True).distinct()[:max_ips]
+    )
+
+    locations = get_geolocation_many(ip_addresses)
+
+    updated_count = 0
+    for ip_address, (country, city) in locations.items():
+        updated_count += pending.filter(ip_address=ip_address).update(
+            country=country or "",
+            city=city or "",
+        )
+
+    logger.info(
+        "Enriched %s request logs for %s IPs, %s IPs left for the next run",
+        updated_count,
+        len(locations),
+        len(ip_addresses) - len(locations),
+    )
+    return {"ip_count": len(ip_addresses), "updated_count": updated_count}
+
+
+@shared_task
+def consume_request_log_stream(max_batches=50):
+    """
+    Write request logs from the Redis Stream to the database.
+    Stops once the stream is drained or max_batches batches were written,
+    so a backlog is spread over several runs.
+    """
+    stream = get_request_log_stream()
+    written = stream.consume(max_batches=max_batches)
+    logger.info("Wrote %s streamed request logs", written)
+    return written
+
+
+@shared_task
+def flush_request_rollups():
+    """
+    Move closed minutes of the Redis request counters into the
+    RequestRollup and PathRollup tables.
+    """
+    if not use_rollups():
+        return 0
+    flushed = get_rollup_tracker().flush()
+    logger.info("Flushed %s request rollup buckets", flushed)
+    return flushed
@@ -1,3 +1,1829 @@
-from django.test import TestCase
+import asyncio
+import ipaddress
+import json
+from collections import defaultdict
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import redis
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import AnonymousUser
+from django.contrib import admin
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import (
+    DataError,
+    DatabaseError,
+    OperationalError,
+    connection,
+    transaction,
+)
+from django.db.models import Count, Sum
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_ratelimit.core import get_usage
+from .admin import SuspiciousIPAdmin
+from .baseline import StatisticalBaseline, TrafficMatrix
+from .blocklist import (
+    BLOCKED_IP_CACHE_PREFIX,
+    BlocklistSnapshot,
+    BloomFilter,
+    MappedBlocklist,
+    NetworkBlocklist,
+    PrefixTrie,
+    get_network_blocklist,
+    publish_blocklist,
+    write_blocklist_file,
+)
+from .distinct_paths import DistinctPathTracker
+from . import geolocation, log_buffer
+from .geolocation import (
+    CircuitBreaker,
+    HTTPBackend,
+    LocalDatabaseBackend,
+    RateBudget,
+    SingleFlight,
+    GEOLOCATION_BATCH_SIZE,
+)
+from .heavy_hitters import CountMinSketch, HeavyHitterTracker, TopK
+from .incremental import IncrementalDetector, split_gaps
+from .log_buffer import RequestLogBuffer
+from .log_stream import RequestLogStream
+from .middleware import AsyncIPTrackingMiddleware
+from .models import (
+    BlockedIP,
+    BlockedNetwork,
+    DetectionCounter,
+    DetectionState,
+    PathRollup,
+    RequestLog,
+    RequestRollup,
+    SuspiciousIP,
+)
+from .realtime import SlidingWindowDetector
+from .rollups import (
+    ROLLUP_BUCKETS_KEY,
+    ROLLUP_KEY_PREFIX,
+    RollupTracker,
+    bucket_start,
+    get_bucket,
+    store_rollups,
+)
+from .redis_utils import get_async_redis
+from .rules import AnomalyRule, DetectionPlan, get_detection_plan
+from .sinks import (
+    BufferedORMSink,
+    FileSink,
+    NullSink,
+    ORMSink,
+    get_log_sink_path,
+)
+from .subnets import SubnetAggregator
+from .tasks import (
+    IN_CHUNK_SIZE,
+    SENSITIVE_PATHS,
+    SuspiciousIPBatch,
+    auto_block_suspicious_ips,
+    block_ips,
+    detect_anomalies,
+    detect_anomalies_incremental,
+    detect_anomalies_shard,
+    detect_path_scanners,
+    detect_subnet_anomalies,
+    enrich_request_log_geolocation,
+    flag_realtime_ip,
+    get_anomaly_counts,
+    get_shard_ranges,
+    merge_detection_results,
+)
 
-# Create your tests here.
+LOCMEM_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+}
+
+
+class StubGeolocationHandler(BaseHTTPRequestHandler):
+    """Answers ip-api.com style batch requests"""
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Echo a successful result for every IP in the batch"""
+        length = int(self.headers["Content-Length"])
+        ip_addresses = json.loads(self.rfile.read(length))
+        self.server.batches.append(ip_addresses)
+        if self.server.status != 200:
+            self.send_response(self.server.status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = json.dumps(
+            [
+                {"status": "success", "country": "Testland", "city": ip, "query": ip}
+                for ip in ip_addresses
+            ]
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class HTTPBackendBatchTests(TestCase):
+    """Batch geolocation lookups against a local stub server"""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubGeolocationHandler)
+        self.server.batches = []
+        self.server.status = 200
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        host, port = self.server.server_address
+        override = override_settings(
+            IP_TRACKING_GEOLOCATION_BATCH_API_URL=f"http://{host}:{port}/batch"
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        cache.clear()
+
+    def test_lookup_many_splits_into_batches(self):
+        ip_addresses = [f"203.0.{i // 256}.{i % 256}" for i in range(250)]
+
+        results = HTTPBackend().lookup_many(ip_addresses)
+
+        self.assertEqual(
+            [len(batch) for batch in self.server.batches],
+            [GEOLOCATION_BATCH_SIZE, GEOLOCATION_BATCH_SIZE, 50],
+        )
+        self.assertEqual(results["203.0.0.7"], ("Testland", "203.0.0.7"))
+        self.assertEqual(len(results), 250)
+
+    def test_lookup_many_uses_cache(self):
+        backend = HTTPBackend()
+        backend.lookup_many(["198.51.100.1", "198.51.100.2"])
+        results = backend.lookup_many(["198.51.100.1", "198.51.100.2", "198.51.100.3"])
+
+        self.assertEqual(self.server.batches[-1], ["198.51.100.3"])
+        self.assertEqual(results["198.51.100.1"], ("Testland", "198.51.100.1"))
+
+    def test_lookup_single_address(self):
+        self.assertEqual(HTTPBackend().lookup("192.0.2.10"), ("Testland", "192.0.2.10"))
+        self.assertEqual(self.server.batches, [["192.0.2.10"]])
+
+    def open_breaker(self, backend):
+        backend.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        backend.breaker.record_failure()
+
+    def test_single_lookup_closes_half_open_breaker(self):
+        backend = HTTPBackend()
+        self.open_breaker(backend)
+        self.assertEqual(backend.lookup("192.0.2.10"), (None, None))
+        self.assertEqual(self.server.batches, [])
+
+        backend.breaker.opened_until = time.monotonic() - 1  # Reset timeout over
+        self.assertEqual(backend.lookup("192.0.2.10"), ("Testland", "192.0.2.10"))
+        self.assertEqual(self.server.batches, [["192.0.2.10"]])
+        self.assertEqual(backend.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failed_trial_reopens_breaker(self):
+        backend = HTTPBackend()
+        self.open_breaker(backend)
+        backend.breaker.opened_until = time.monotonic() - 1
+        self.server.status = 500
+
+        self.assertEqual(backend.lookup("192.0.2.10"), (None, None))
+        self.assertEqual(len(self.server.batches), 1)
+        self.assertEqual(backend.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(backend.breaker.trips, 2)
+        self.assertEqual(backend.lookup("192.0.2.11"), (None, None))
+        self.assertEqual(len(self.server.batches), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class EnrichGeolocationTests(TestCase):
+    """Only IPs a backend answered are written, the rest are retried"""
+
+    def setUp(self):
+        cache.clear()
+        self.http = HTTPBackend()
+        self.http.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        self.http.breaker.record_failure()  # The API is unavailable
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        database = Path(directory.name) / "ranges.csv"
+        database.write_text("203.0.113.0,203.0.113.255,Testland,Testville\n")
+        self.local = LocalDatabaseBackend(database)
+
+    def locations(self):
+        return dict(RequestLog.objects.values_list("ip_address", "country"))
+
+    def test_open_breaker_leaves_rows_for_the_next_run(self):
+        create_logs("198.51.100.1", "/", 2)  # Only the API could answer
+        create_logs("203.0.113.5", "/", 1)
+        create_logs("10.0.0.1", "/", 1)  # Private, never resolvable
+
+        with mock.patch.object(geolocation, "_backends", [self.local, self.http]):
+            result = enrich_request_log_geolocation()
+        self.assertEqual(result["updated_count"], 2)
+        self.assertEqual(
+            self.locations(),
+            {"198.51.100.1": None, "203.0.113.5": "Testland", "10.0.0.1": ""},
+        )
+
+        # Without the API the local database's answer is final
+        with mock.patch.object(geolocation, "_backends", [self.local]):
+            enrich_request_log_geolocation()
+        self.assertEqual(self.locations()["198.51.100.1"], "")
+
+
+class LocalDatabaseBackendTests(TestCase):
+    """MMDB lookups, with the maxminddb reader mocked"""
+
+    def setUp(self):
+        records = {
+            "203.0.113.5": {
+                "country": {"names": {"en": "Testland"}},
+                "city": {"names": {"en": "Testville"}},
+            },
+            "2001:db8::5": {"country": {"names": {"en": "Testland"}}},
+            "192.0.2.5": {"continent": {"code": "EU"}},
+        }
+        patcher = mock.patch.object(geolocation, "maxminddb")
+        maxminddb = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.reader = maxminddb.open_database.return_value
+        self.reader.get.side_effect = lambda address: records.get(str(address))
+        self.backend = LocalDatabaseBackend("GeoLite2-City.mmdb")
+        maxminddb.open_database.assert_called_once_with("GeoLite2-City.mmdb")
+
+    def test_hit(self):
+        self.assertEqual(self.backend.lookup("203.0.113.5"), ("Testland", "Testville"))
+        # A record without a city
+        self.assertEqual(self.backend.lookup("2001:db8::5"), ("Testland", None))
+
+    def test_miss(self):
+        # A record without a country or city name
+        self.assertEqual(self.backend.lookup("192.0.2.5"), (None, None))
+
+    def test_not_in_database(self):
+        self.assertIsNone(self.backend.lookup("198.51.100.1"))
+        self.reader.get.assert_called_once_with(ipaddress.ip_address("198.51.100.1"))
+        # lookup_many gives the final answer for addresses the file lacks
+        self.assertEqual(
+            self.backend.lookup_many(["203.0.113.5", "198.51.100.1"]),
+            {"203.0.113.5": ("Testland", "Testville"), "198.51.100.1": (None, None)},
+        )
+
+    def test_invalid_address(self):
+        self.assertIsNone(self.backend.lookup("not-an-ip"))
+        self.reader.get.assert_not_called()
+
+
+class CircuitBreakerTests(TestCase):
+    """Closed -> open -> half-open -> closed or open again"""
+
+    def test_transitions(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+        breaker.opened_until = time.monotonic() - 1
+        self.assertTrue(breaker.allow())  # The trial call
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())  # Everyone else waits for it
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        breaker.opened_until = time.monotonic() - 1
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.stats()["trips"], 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RateBudgetTests(TestCase):
+    """The budget is shared through the cache and refuses calls beyond it"""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_limit_and_exhaust(self):
+        budget = RateBudget(limit=2)
+        self.assertTrue(budget.acquire())
+        self.assertTrue(RateBudget(limit=2).acquire())  # Another worker
+        self.assertFalse(budget.acquire())
+        self.assertEqual(budget.stats()["used"], 2)
+        self.assertEqual(budget.denied, 1)
+
+        cache.clear()
+        budget.exhaust()
+        self.assertFalse(budget.acquire())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SingleFlightTests(TestCase):
+    """Concurrent misses for one key run the fetch once"""
+
+    def test_concurrent_callers_share_one_fetch(self):
+        cache.clear()
+        singleflight = SingleFlight(wait_timeout=2)
+        calls = []
+        started = threading.Event()
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            time.sleep(0.2)
+            cache.set("geolocation_192.0.2.10", ("Testland", "City"))
+            return "Testland", "City"
+
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(
+                singleflight.do("geolocation_192.0.2.10", fetch)
+            )
+        )
+        leader.start()
+        started.wait(1)
+        followers = [
+            threading.Thread(
+                target=lambda: results.append(
+                    singleflight.do("geolocation_192.0.2.10", fetch)
+                )
+            )
+            for _ in range(3)
+        ]
+        for thread in followers:
+            thread.start()
+        for thread in [leader, *followers]:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [("Testland", "City")] * 4)
+        self.assertEqual(singleflight.stats()["coalesced"], 3)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BlocklistSnapshotTests(TestCase):
+    """Lookups before the first successful load use the per-IP check"""
+
+    def setUp(self):
+        cache.clear()
+        BlockedIP.objects.create(ip_address="198.51.100.1")
+        self.snapshot = BlocklistSnapshot()
+
+    def test_lookup_while_first_load_runs(self):
+        loading, release = threading.Event(), threading.Event()
+        load = self.snapshot.load
+
+        def slow_load(addresses, networks, version):
+            # Test database tables are locked for other threads
+            loading.set()
+            release.wait(5)
+            load(["198.51.100.1"], [], version)
+
+        with mock.patch.object(self.snapshot, "load", side_effect=slow_load):
+            loader = threading.Thread(target=self.snapshot.refresh)
+            loader.start()
+            loading.wait(5)
+            results = []
+            checker = threading.Thread(
+                target=lambda: results.append(self.snapshot.is_blocked("198.51.100.1"))
+            )
+            checker.start()
+            release.set()
+            loader.join()
+            checker.join()
+        self.assertEqual(results, [True])
+
+        # Before any load the per-IP check answers, async too
+        snapshot = BlocklistSnapshot()
+        snapshot.next_check = time.monotonic() + 60
+        self.assertTrue(snapshot.is_blocked("198.51.100.1"))
+        self.assertFalse(async_to_sync(snapshot.ais_blocked)("198.51.100.2"))
+
+    def test_failed_first_load_is_retried(self):
+        with mock.patch.object(
+            self.snapshot, "load", side_effect=DatabaseError("unavailable")
+        ):
+            self.assertTrue(self.snapshot.is_blocked("198.51.100.1"))
+            self.assertFalse(self.snapshot.is_blocked("198.51.100.2"))
+        self.assertIsNone(self.snapshot.addresses)
+
+        self.assertTrue(self.snapshot.is_blocked("198.51.100.1"))
+        self.assertEqual(self.snapshot.reloads, 1)
+        self.assertEqual(self.snapshot.addresses, frozenset(["198.51.100.1"]))
+
+    def test_network_blocklist_skips_addresses(self):
+        BlockedNetwork.objects.create(network="203.0.113.0/24")
+        with mock.patch("ip_tracking.blocklist._network_blocklist", None):
+            snapshot = get_network_blocklist()
+            self.assertIs(get_network_blocklist(), snapshot)
+        self.assertTrue(snapshot.networks_only)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(snapshot.is_network_blocked("203.0.113.5"))
+            self.assertFalse(snapshot.is_network_blocked("198.51.100.1"))
+        self.assertEqual(snapshot.addresses, frozenset())
+        self.assertEqual(len(snapshot.networks), 1)
+        self.assertFalse(
+            any(BlockedIP._meta.db_table in query["sql"] for query in queries)
+        )
+
+        snapshot = BlocklistSnapshot(networks_only=True)
+        self.assertTrue(async_to_sync(snapshot.ais_network_blocked)("203.0.113.5"))
+        self.assertEqual(snapshot.addresses, frozenset())
+
+
+async def async_get_response(request):
+    """Innermost handler of an async middleware chain"""
+    return HttpResponse()
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    IP_TRACKING_REQUEST_LOOKUP=True,
+    IP_TRACKING_BLOCKLIST_SNAPSHOT=False,
+    IP_TRACKING_DEFER_GEOLOCATION=True,
+)
+@mock.patch("ip_tracking.sinks._sink", NullSink())
+class RequestLookupTests(TestCase):
+    """Per-request cache lookups in the sync and async middleware"""
+
+    def setUp(self):
+        cache.clear()
+        self.middleware = AsyncIPTrackingMiddleware(async_get_response)
+        self.factory = RequestFactory()
+
+    def request(self, ip_address):
+        """GET request from ip_address"""
+        return self.factory.get("/api/", REMOTE_ADDR=ip_address)
+
+    def test_prefetched_block_flag(self):
+        cache.set(f"{BLOCKED_IP_CACHE_PREFIX}203.0.113.5", True)
+        with self.assertNumQueries(0):
+            response = self.middleware.process_request(self.request("203.0.113.5"))
+        self.assertEqual(response.status_code, 403)
+
+    def test_miss_is_written_back(self):
+        self.assertIsNone(self.middleware.process_request(self.request("10.0.0.5")))
+        self.assertIs(cache.get(f"{BLOCKED_IP_CACHE_PREFIX}10.0.0.5"), False)
+
+    def test_async_request(self):
+        cache.set(f"{BLOCKED_IP_CACHE_PREFIX}203.0.113.5", True)
+        response = async_to_sync(self.middleware.__acall__)(self.request("203.0.113.5"))
+        self.assertEqual(response.status_code, 403)
+
+        BlockedIP.objects.create(ip_address="203.0.113.6")
+        response = async_to_sync(self.middleware.__acall__)(self.request("203.0.113.6"))
+        self.assertEqual(response.status_code, 403)
+        self.assertIs(cache.get(f"{BLOCKED_IP_CACHE_PREFIX}203.0.113.6"), True)
+
+    @override_settings(IP_TRACKING_REQUEST_LOOKUP=False)
+    def test_async_request_without_lookup(self):
+        with mock.patch("ip_tracking.middleware.RequestCacheLookup") as lookup:
+            response = async_to_sync(self.middleware.__acall__)(
+                self.request("10.0.0.5")
+            )
+        self.assertEqual(response.status_code, 200)
+        lookup.assert_not_called()
+
+    def test_rate_limit_skips_redirected_requests(self):
+        for _ in range(3):
+            response = self.client.get("/dashboard/")
+            self.assertEqual(response.status_code, 302)
+
+        request = self.factory.get("/dashboard/")
+        request.user = AnonymousUser()
+        usage = get_usage(
+            request,
+            group="ip_tracking.views.dashboard",
+            key="user",
+            rate="100/h",
+            method="GET",
+        )
+        self.assertEqual(usage["count"], 0)
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    IP_TRACKING_BLOCKLIST_SNAPSHOT=False,
+    IP_TRACKING_DEFER_GEOLOCATION=True,
+)
+@mock.patch("ip_tracking.sinks._sink", ORMSink())
+class AsyncMiddlewareTests(TestCase):
+    """Requests through the ASGI handler run the async middleware"""
+
+    def setUp(self):
+        cache.clear()
+
+    async def test_request_is_logged(self):
+        response = await self.async_client.get(
+            "/api/", headers={"X-Forward-For": "10.0.0.7"}
+        )
+        self.assertEqual(response.status_code, 200)
+        log_entry = await RequestLog.objects.aget(ip_address="10.0.0.7")
+        self.assertEqual(log_entry.path, "/api/")
+
+    async def test_blocked_request(self):
+        await BlockedIP.objects.acreate(ip_address="10.0.0.8")
+        with mock.patch.object(
+            AsyncIPTrackingMiddleware, "process_request"
+        ) as process_request:
+            response = await self.async_client.get(
+                "/api/", headers={"X-Forward-For": "10.0.0.8"}
+            )
+        self.assertEqual(response.status_code, 403)
+        process_request.assert_not_called()
+        self.assertFalse(
+            await RequestLog.objects.filter(ip_address="10.0.0.8").aexists()
+        )
+
+    def test_async_clients_per_event_loop(self):
+        async def clients():
+            return (
+                get_async_redis(),
+                get_async_redis(),
+                geolocation.get_async_http_client(),
+            )
+
+        first, second = asyncio.run(clients()), async_to_sync(clients)()
+        self.assertIs(first[0], first[1])
+        self.assertIsNot(first[0], second[0])
+        self.assertIsNot(first[2], second[2])
+
+
+@mock.patch.object(RequestLogBuffer, "_ensure_flusher")
+class RequestLogBufferTests(TestCase):
+    """Buffered request logs are written, re-queued or dropped"""
+
+    def add_logs(self, buffer, count, ip_address="192.0.2.1"):
+        """Queue count unsaved request logs"""
+        return [
+            buffer.add(RequestLog(ip_address=ip_address, path=f"/{i}"))
+            for i in range(count)
+        ]
+
+    def test_flush(self, _):
+        buffer = RequestLogBuffer(batch_size=2)
+        self.add_logs(buffer, 3)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(buffer.flush(), 3)
+        inserts = [q for q in queries if q["sql"].startswith("INSERT")]
+        self.assertEqual(len(inserts), 2)
+        self.assertEqual(RequestLog.objects.count(), 3)
+        self.assertEqual(buffer.flush(), 0)
+        stats = buffer.stats()
+        self.assertEqual(
+            (stats["pending"], stats["flushed"], stats["flushes"]), (0, 3, 1)
+        )
+
+    def test_overflow(self, _):
+        buffer = RequestLogBuffer(max_pending=2)
+        self.assertEqual(self.add_logs(buffer, 3), [True, True, False])
+        self.assertEqual(buffer.stats()["dropped"], 1)
+
+    def test_failed_flush_is_requeued(self, _):
+        buffer = RequestLogBuffer(max_pending=3)
+        self.add_logs(buffer, 2)
+        with mock.patch.object(
+            RequestLog.objects, "bulk_create", side_effect=OperationalError("down")
+        ):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(buffer.stats()["pending"], 2)
+
+        # A failed batch only refills the room left by newer entries
+        entries = buffer.drain()
+        self.add_logs(buffer, 2, ip_address="192.0.2.2")
+        self.assertEqual(buffer.requeue(entries), 1)
+        stats = buffer.stats()
+        self.assertEqual(
+            (stats["pending"], stats["dropped"], stats["failed"]), (3, 1, 2)
+        )
+
+        self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(
+            list(RequestLog.objects.order_by("id").values_list("ip_address", "path")),
+            [("192.0.2.1", "/0"), ("192.0.2.2", "/0"), ("192.0.2.2", "/1")],
+        )
+
+    def test_rejected_row_is_dropped(self, _):
+        buffer = RequestLogBuffer()
+        self.add_logs(buffer, 2)
+        buffer.add(RequestLog(ip_address=None, path="/bad"))
+        self.add_logs(buffer, 1, ip_address="192.0.2.2")
+
+        self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(
+            list(RequestLog.objects.order_by("id").values_list("ip_address", "path")),
+            [("192.0.2.1", "/0"), ("192.0.2.1", "/1"), ("192.0.2.2", "/0")],
+        )
+        stats = buffer.stats()
+        self.assertEqual(
+            (stats["pending"], stats["rejected"], stats["failed"]), (0, 1, 0)
+        )
+
+        # Later flushes are not held back by the dropped row
+        self.add_logs(buffer, 1, ip_address="192.0.2.3")
+        self.assertEqual(buffer.flush(), 1)
+
+    def test_flushed_at_exit(self, _):
+        with mock.patch.object(log_buffer, "_buffer", None), mock.patch.object(
+            log_buffer.atexit, "register"
+        ) as register:
+            buffer = log_buffer.get_request_log_buffer()
+            self.assertIs(log_buffer.get_request_log_buffer(), buffer)
+        register.assert_called_once_with(buffer.flush)
+
+        self.add_logs(buffer, 2)
+        register.call_args.args[0]()
+        self.assertEqual(RequestLog.objects.count(), 2)
+
+
+class BlocklistStructureTests(TestCase):
+    """Prefix trie and Bloom filter used by the blocklist snapshot"""
+
+    def test_longest_prefix_match(self):
+        networks = NetworkBlocklist(
+            ["10.0.0.0/8", "10.1.0.0/16", "2001:db8::/32", "not a network"]
+        )
+        self.assertEqual(len(networks), 3)
+        self.assertEqual(networks.match("10.1.2.3"), "10.1.0.0/16")
+        self.assertEqual(networks.match("10.2.0.1"), "10.0.0.0/8")
+        self.assertEqual(networks.match("10.255.255.255"), "10.0.0.0/8")
+        self.assertIsNone(networks.match("11.0.0.0"))
+        self.assertEqual(networks.match("2001:db8:ffff::1"), "2001:db8::/32")
+        # Same integer as 10.0.0.1, but an IPv6 address
+        self.assertIsNone(networks.match("::a00:1"))
+        self.assertIsNone(networks.match("invalid"))
+
+    def test_trie_default_route(self):
+        trie = PrefixTrie(32)
+        trie.insert(ipaddress.ip_network("0.0.0.0/0"), "any")
+        trie.insert(ipaddress.ip_network("192.0.2.1/32"), "host")
+        self.assertEqual(
+            trie.longest_match(int(ipaddress.ip_address("192.0.2.1"))), "host"
+        )
+        self.assertEqual(
+            trie.longest_match(int(ipaddress.ip_address("192.0.2.2"))), "any"
+        )
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter.for_capacity(1000, 0.01)
+        members = [f"192.0.2.{i}" for i in range(256)]
+        for member in members:
+            bloom.add(member)
+        self.assertEqual(len(bloom), 256)
+        self.assertTrue(all(member in bloom for member in members))
+        others = [f"198.51.100.{i}" for i in range(256)]
+        self.assertLess(sum(other in bloom for other in others), 20)
+        self.assertLess(bloom.estimated_fp_rate(), 0.01)
+
+        copy = BloomFilter.from_payload(bloom.to_payload())
+        self.assertEqual(len(copy), 256)
+        self.assertTrue(all(member in copy for member in members))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MappedBlocklistTests(TestCase):
+    """Lookups against the memory-mapped blocklist file"""
+
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / "blocklist.bin"
+        for ip_address in ("192.0.2.1", "192.0.2.200", "2001:db8::1"):
+            BlockedIP.objects.create(ip_address=ip_address)
+        for network in (
+            "10.0.0.0/8",
+            "10.1.0.0/16",
+            "203.0.113.0/24",
+            "2001:db8:1::/48",
+        ):
+            BlockedNetwork.objects.create(network=network)
+
+    def test_range_edges(self):
+        write_blocklist_file(self.path)
+        blocklist = MappedBlocklist(self.path)
+        blocklist.refresh()
+        self.assertEqual(blocklist.stats()["size"], 3)
+        # 10.1.0.0/16 is merged into 10.0.0.0/8
+        self.assertEqual(blocklist.stats()["networks"], 3)
+        cases = {
+            # First range
+            "9.255.255.255": False,
+            "10.0.0.0": True,
+            "10.255.255.255": True,
+            "11.0.0.0": False,
+            "203.0.113.255": True,
+            # Last range
+            "2001:db8:0:ffff::": False,
+            "2001:db8:1::": True,
+            "2001:db8:1:ffff:ffff:ffff:ffff:ffff": True,
+            "2001:db8:2::": False,
+            # IPv6 addresses with the integer value of a blocked IPv4 one
+            "::a00:1": False,
+            "::ffff:10.0.0.1": True,
+            "::": False,
+            "ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff": False,
+        }
+        for ip_address, blocked in cases.items():
+            with self.subTest(ip_address=ip_address):
+                self.assertIs(blocklist.is_network_blocked(ip_address), blocked)
+
+        for ip_address in ("192.0.2.1", "192.0.2.200", "2001:db8::1", "10.1.2.3"):
+            self.assertTrue(blocklist.is_blocked(ip_address))
+        for ip_address in ("192.0.2.0", "192.0.2.2", "192.0.2.201", "2001:db8::2"):
+            self.assertFalse(blocklist.is_blocked(ip_address))
+        self.assertFalse(blocklist.is_blocked("invalid"))
+
+    def test_without_ranges(self):
+        BlockedNetwork.objects.all().delete()
+        write_blocklist_file(self.path)
+        blocklist = MappedBlocklist(self.path)
+        self.assertFalse(blocklist.is_network_blocked("10.0.0.1"))
+        self.assertTrue(blocklist.is_blocked("2001:db8::1"))
+
+    def test_missing_file(self):
+        blocklist = MappedBlocklist(self.path)
+        self.assertTrue(blocklist.is_blocked("192.0.2.1"))
+        self.assertFalse(blocklist.is_blocked("192.0.2.2"))
+        self.assertTrue(async_to_sync(blocklist.ais_blocked)("2001:db8::1"))
+        self.assertFalse(blocklist.is_network_blocked("10.0.0.1"))
+        self.assertFalse(self.path.exists())
+
+        # Mapped once the publisher has written it
+        write_blocklist_file(self.path)
+        blocklist.next_check = 0.0
+        self.assertTrue(blocklist.is_network_blocked("10.0.0.1"))
+        self.assertEqual(blocklist.reloads, 1)
+
+    def test_truncated_file(self):
+        write_blocklist_file(self.path)
+        contents = self.path.read_bytes()
+        truncated = self.path.with_name("truncated.bin")
+
+        # Never mapped: addresses fall back to the per-IP check
+        for size in (0, 10, len(contents) - 8):
+            with self.subTest(size=size):
+                truncated.write_bytes(contents[:size])
+                blocklist = MappedBlocklist(truncated)
+                with self.assertLogs("ip_tracking.blocklist", "ERROR"):
+                    self.assertTrue(blocklist.is_blocked("192.0.2.1"))
+                self.assertFalse(blocklist.is_blocked("192.0.2.2"))
+                self.assertFalse(blocklist.is_network_blocked("10.0.0.1"))
+                self.assertIsNone(blocklist.mapping)
+
+        # Already mapped: the previous generation is kept
+        blocklist = MappedBlocklist(self.path)
+        self.assertTrue(blocklist.is_network_blocked("10.0.0.1"))
+        generation = blocklist.generation
+        truncated.write_bytes(contents[:-8])
+        truncated.replace(self.path)
+        blocklist.next_check = 0.0
+        with self.assertLogs("ip_tracking.blocklist", "ERROR"):
+            self.assertTrue(blocklist.is_network_blocked("10.0.0.1"))
+        self.assertTrue(blocklist.is_blocked("2001:db8::1"))
+        self.assertEqual(blocklist.generation, generation)
+        self.assertEqual(blocklist.reloads, 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PublishBlocklistTests(TestCase):
+    """Block changes publish the blocklist once per transaction"""
+
+    def setUp(self):
+        cache.clear()
+
+    def publishes(self):
+        """Run the callbacks of the transaction, counting the publishes"""
+        patcher = mock.patch("ip_tracking.blocklist.publish_blocklist")
+        publish = patcher.start()
+        self.addCleanup(patcher.stop)
+        return publish, self.captureOnCommitCallbacks(execute=True)
+
+    def test_one_publish_per_transaction(self):
+        publish, callbacks = self.publishes()
+        with callbacks:
+            for i in range(3):
+                BlockedIP.objects.create(ip_address=f"192.0.2.{i}")
+            BlockedNetwork.objects.create(network="198.51.100.0/24")
+        publish.assert_called_once_with()
+
+        # The next transaction publishes again
+        with self.captureOnCommitCallbacks(execute=True):
+            BlockedIP.objects.create(ip_address="192.0.2.10")
+        self.assertEqual(publish.call_count, 2)
+
+    def test_rolled_back_savepoint(self):
+        publish, callbacks = self.publishes()
+        with callbacks:
+            try:
+                with transaction.atomic():
+                    BlockedIP.objects.create(ip_address="192.0.2.1")
+                    raise DatabaseError("rolled back")
+            except DatabaseError:
+                pass
+            BlockedIP.objects.create(ip_address="192.0.2.2")
+        publish.assert_called_once_with()
+
+    def test_rolled_back_transaction(self):
+        publish, callbacks = self.publishes()
+        with callbacks:
+            try:
+                with transaction.atomic():
+                    BlockedIP.objects.create(ip_address="192.0.2.1")
+                    raise DatabaseError("rolled back")
+            except DatabaseError:
+                pass
+        publish.assert_not_called()
+
+        # Nothing is left over from the rolled back changes
+        with self.captureOnCommitCallbacks(execute=True):
+            BlockedIP.objects.create(ip_address="192.0.2.2")
+        publish.assert_called_once_with()
+
+    def test_admin_block_action(self):
+        for i in range(3):
+            SuspiciousIP.objects.create(ip_address=f"192.0.2.{i}", reason="test")
+        model_admin = SuspiciousIPAdmin(SuspiciousIP, admin.site)
+        publish, callbacks = self.publishes()
+        with callbacks, mock.patch.object(model_admin, "message_user"):
+            model_admin.block_selected_ips(None, SuspiciousIP.objects.all())
+        publish.assert_called_once_with()
+        self.assertEqual(BlockedIP.objects.count(), 3)
+
+
+class RequestLogStreamTests(TestCase):
+    """Stream consumers claim pending entries and ack after writing"""
+
+    def setUp(self):
+        self.stream = RequestLogStream(batch_size=10)
+        self.stream._group_ready = True  # pylint: disable=protected-access
+        patcher = mock.patch("ip_tracking.log_stream.get_redis")
+        self.redis = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+    def entry(self, entry_id, ip_address):
+        """Stream entry as returned by XREADGROUP and XAUTOCLAIM"""
+        log_entry = RequestLog(ip_address=ip_address, path="/api/")
+        return entry_id, self.stream.entry_fields(log_entry)
+
+    def test_pending_entries_are_claimed(self):
+        self.redis.xautoclaim.return_value = [
+            "0-0",
+            [self.entry("1-0", "192.0.2.1"), ("2-0", None)],
+            [],
+        ]
+        self.redis.xreadgroup.side_effect = [
+            [["stream", [self.entry("3-0", "192.0.2.3")]]],
+            [],
+        ]
+        self.assertEqual(self.stream.consume("worker-1"), 2)
+
+        self.redis.xautoclaim.assert_called_once_with(
+            self.stream.stream,
+            self.stream.group,
+            "worker-1",
+            self.stream.claim_idle_time,
+            start_id="0-0",
+            count=10,
+        )
+        # Entries trimmed while pending are acknowledged too
+        self.assertEqual(
+            self.redis.xack.call_args_list,
+            [
+                mock.call(self.stream.stream, self.stream.group, "1-0", "2-0"),
+                mock.call(self.stream.stream, self.stream.group, "3-0"),
+            ],
+        )
+        self.assertEqual(
+            sorted(RequestLog.objects.values_list("ip_address", flat=True)),
+            ["192.0.2.1", "192.0.2.3"],
+        )
+
+    def test_ack_after_write(self):
+        self.redis.xautoclaim.return_value = ["0-0", [], []]
+        self.redis.xreadgroup.return_value = [
+            ["stream", [self.entry("1-0", "192.0.2.1")]]
+        ]
+        written = []
+        self.redis.xack.side_effect = lambda *args: written.append(
+            RequestLog.objects.count()
+        )
+        self.assertEqual(self.stream.consume("worker-1", max_batches=1), 1)
+        self.assertEqual(written, [1])
+
+        with mock.patch.object(
+            RequestLog.objects, "bulk_create", side_effect=OperationalError("down")
+        ):
+            self.assertEqual(self.stream.consume("worker-1"), 0)
+        self.assertEqual(self.redis.xack.call_count, 1)
+        self.assertEqual(self.stream.write_errors, 1)
+
+        # A row the database rejects is acknowledged with the rest of its
+        # batch instead of being claimed again on every pass
+        save = RequestLog.save
+
+        def reject_long_paths(log_entry, *args, **kwargs):
+            if len(log_entry.path) > 255:
+                raise DataError("value too long for type character varying(255)")
+            return save(log_entry, *args, **kwargs)
+
+        bad_id, bad_fields = self.entry("2-0", "192.0.2.2")
+        bad_fields["path"] = "/" * 300
+        self.redis.xreadgroup.side_effect = [
+            [["stream", [self.entry("1-1", "192.0.2.1"), (bad_id, bad_fields)]]],
+            [["stream", [self.entry("3-0", "192.0.2.3")]]],
+            [],
+        ]
+        self.redis.xack.side_effect = None
+        with mock.patch.object(
+            RequestLog.objects, "bulk_create", side_effect=DataError("too long")
+        ), mock.patch.object(
+            RequestLog, "save", autospec=True, side_effect=reject_long_paths
+        ):
+            self.assertEqual(self.stream.consume("worker-1", max_batches=1), 1)
+        self.assertEqual(
+            self.redis.xack.call_args,
+            mock.call(self.stream.stream, self.stream.group, "1-1", "2-0"),
+        )
+        self.assertEqual(self.stream.rejected, 1)
+
+        self.assertEqual(self.stream.consume("worker-1"), 1)
+        self.assertEqual(
+            sorted(RequestLog.objects.values_list("ip_address", flat=True)),
+            ["192.0.2.1", "192.0.2.1", "192.0.2.3"],
+        )
+
+    def test_consumer_backs_off(self):
+        failures = iter(
+            [redis.RedisError("down"), redis.RedisError("down"), None, 3, 3]
+        )
+
+        def consume(consumer, block=None):
+            failure = next(failures, KeyboardInterrupt())
+            if isinstance(failure, BaseException):
+                raise failure
+            if failure is None:
+                self.stream.write_errors += 1
+                return 0
+            return failure
+
+        with mock.patch(
+            "ip_tracking.management.commands.consume_request_logs."
+            "get_request_log_stream",
+            return_value=self.stream,
+        ), mock.patch.object(self.stream, "consume", side_effect=consume), mock.patch(
+            "ip_tracking.management.commands.consume_request_logs.time.sleep"
+        ) as sleep:
+            call_command(
+                "consume_request_logs",
+                max_backoff=1.5,
+                stdout=StringIO(),
+                stderr=StringIO(),
+            )
+        self.assertEqual(
+            sleep.call_args_list, [mock.call(0.5), mock.call(1), mock.call(1.5)]
+        )
+
+
+class LogSinkTests(TestCase):
+    """Request log sinks store, reject and count entries"""
+
+    def log_entry(self, ip_address="192.0.2.1"):
+        """Unsaved request log"""
+        return RequestLog(ip_address=ip_address, path="/api/", country="Testland")
+
+    def test_orm_sink(self):
+        sink = ORMSink()
+        self.assertTrue(sink.emit(self.log_entry()))
+        self.assertTrue(async_to_sync(sink.aemit)(self.log_entry("192.0.2.2")))
+        self.assertEqual(RequestLog.objects.count(), 2)
+        self.assertEqual(sink.stats()["emitted"], 2)
+
+    def test_failed_write(self):
+        sink = ORMSink()
+        with mock.patch.object(RequestLog, "save", side_effect=DatabaseError("down")):
+            self.assertFalse(sink.emit(self.log_entry()))
+        self.assertEqual((sink.stats()["errors"], sink.stats()["emitted"]), (1, 0))
+
+    @mock.patch.object(RequestLogBuffer, "_ensure_flusher")
+    def test_buffered_sink_rejects_when_full(self, _):
+        sink = BufferedORMSink()
+        with mock.patch.object(log_buffer, "_buffer", RequestLogBuffer(max_pending=1)):
+            self.assertTrue(sink.emit(self.log_entry()))
+            self.assertFalse(sink.emit(self.log_entry()))
+            stats = sink.stats()
+        self.assertEqual((stats["emitted"], stats["rejected"]), (1, 1))
+        self.assertEqual(stats["buffer"]["dropped"], 1)
+
+    def test_file_sink(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = Path(directory.name) / "request_logs.jsonl"
+        sink = FileSink(path)
+        self.addCleanup(lambda: sink._file and sink._file.close())
+
+        self.assertTrue(sink.emit(self.log_entry()))
+        loop_thread, write_threads = [], []
+        write = sink.write
+
+        def record_thread(log_entry):
+            write_threads.append(threading.get_ident())
+            return write(log_entry)
+
+        async def emit():
+            loop_thread.append(threading.get_ident())
+            return await sink.aemit(self.log_entry("192.0.2.2"))
+
+        with mock.patch.object(sink, "write", side_effect=record_thread):
+            self.assertTrue(async_to_sync(emit)())
+        # The blocking write ran off the event loop
+        self.assertNotEqual(write_threads, loop_thread)
+
+        lines = [json.loads(line) for line in path.read_text().splitlines()]
+        self.assertEqual(
+            [line["ip_address"] for line in lines], ["192.0.2.1", "192.0.2.2"]
+        )
+        self.assertEqual(lines[0]["country"], "Testland")
+        self.assertIsNone(lines[0]["city"])
+        self.assertEqual(RequestLog.objects.count(), 0)
+
+    def test_sink_path(self):
+        with self.settings(IP_TRACKING_LOG_SINK="ip_tracking.sinks.NullSink"):
+            self.assertEqual(get_log_sink_path(), "ip_tracking.sinks.NullSink")
+        with self.settings(IP_TRACKING_LOG_SINK="ip_tracking.sinks.BufferedORMSink"):
+            self.assertEqual(get_log_sink_path(), "ip_tracking.sinks.BufferedORMSink")
+        # The removed IP_TRACKING_LOG_BUFFER_ENABLED flag selects nothing
+        with self.settings(
+            IP_TRACKING_LOG_SINK=None, IP_TRACKING_LOG_BUFFER_ENABLED=True
+        ):
+            self.assertEqual(get_log_sink_path(), "ip_tracking.sinks.ORMSink")
+
+
+class RealtimeDetectorTests(TestCase):
+    """Sliding-window counts and the hand-off of crossed thresholds"""
+
+    def setUp(self):
+        self.rules = [
+            AnomalyRule("burst", 10, window=60, path_prefix="/api/"),
+            AnomalyRule("volume", 100, window=3600, action="block"),
+        ]
+        self.detector = SlidingWindowDetector(DetectionPlan(self.rules))
+
+    def test_weighted_sliding_count(self):
+        pipeline = mock.Mock()
+        # 15 seconds into the minute, 45 of the previous one still overlap
+        weights = self.detector.queue_counters(pipeline, "192.0.2.1", self.rules, 6015)
+        self.assertEqual(weights, [0.75, 1 - 2415 / 3600])
+        pipeline.incr.assert_any_call("ip_tracking:window:burst:192.0.2.1:100")
+        pipeline.get.assert_any_call("ip_tracking:window:burst:192.0.2.1:99")
+        pipeline.expire.assert_any_call("ip_tracking:window:burst:192.0.2.1:100", 120)
+
+        # 4 + 0.75 * 8 = 10 is not above the threshold, 4 + 0.75 * 10 is
+        self.assertEqual(
+            self.detector.exceeded(self.rules, [4, True, "8", 4, True, None], weights),
+            [],
+        )
+        self.assertEqual(
+            self.detector.exceeded(
+                self.rules, [4, True, "10", 101, True, None], weights
+            ),
+            [(self.rules[0], 11), (self.rules[1], 101)],
+        )
+
+    @mock.patch("ip_tracking.realtime.get_redis")
+    def test_crossing_is_handed_off(self, get_redis):
+        client = get_redis.return_value
+        client.pipeline.return_value.execute.return_value = [
+            11,
+            True,
+            None,
+            11,
+            True,
+            None,
+        ]
+        client.set.side_effect = [True, None]
+
+        with mock.patch.object(flag_realtime_ip, "delay") as delay:
+            claimed = self.detector.track("192.0.2.1", "/api/items", now=6015)
+            self.assertEqual(claimed, [(self.rules[0], 11)])
+            # Another request within the rule window does not claim it again
+            self.assertEqual(self.detector.track("192.0.2.1", "/api/items"), [])
+        delay.assert_called_once_with("192.0.2.1", [["burst", 11]])
+        client.set.assert_called_with(
+            "ip_tracking:window:flagged:192.0.2.1:rule:burst", 1, nx=True, ex=60
+        )
+        self.assertFalse(SuspiciousIP.objects.exists())
+
+    def test_flag_key_per_rule(self):
+        rules = self.rules + [
+            AnomalyRule("login", 20, path="/login/", dedupe_reason="login"),
+            AnomalyRule("slow_login", 50, window=86400, dedupe_reason="login"),
+        ]
+        keys = [self.detector.flag_key("192.0.2.1", rule) for rule in rules]
+        # The burst and volume flags expire with their own windows
+        self.assertEqual(
+            keys,
+            [
+                "ip_tracking:window:flagged:192.0.2.1:rule:burst",
+                "ip_tracking:window:flagged:192.0.2.1:rule:volume",
+                "ip_tracking:window:flagged:192.0.2.1:reason:login",
+                "ip_tracking:window:flagged:192.0.2.1:reason:login",
+            ],
+        )
+
+    def test_flag_task(self):
+        with mock.patch(
+            "ip_tracking.tasks.get_realtime_detector", return_value=self.detector
+        ):
+            reasons = flag_realtime_ip("192.0.2.1", [["burst", 11], ["gone", 5]])
+            self.assertEqual(
+                reasons, ["Anomaly rule 'burst': 11 requests in 60 seconds"]
+            )
+            # An open flag is not duplicated, a resolved one is flagged again
+            self.assertEqual(flag_realtime_ip("192.0.2.1", [["burst", 12]]), [])
+            SuspiciousIP.objects.update(is_resolved=True)
+            self.assertEqual(len(flag_realtime_ip("192.0.2.1", [["burst", 13]])), 1)
+        self.assertEqual(SuspiciousIP.objects.count(), 2)
+        self.assertFalse(BlockedIP.objects.exists())
+
+
+class HeavyHitterTests(TestCase):
+    """Count-Min Sketch, top-K eviction and the background merge"""
+
+    def test_sketch_never_undercounts(self):
+        sketch = CountMinSketch(width=16, depth=3)
+        counts = {f"192.0.2.{i}": i + 1 for i in range(40)}
+        for ip_address, count in counts.items():
+            sketch.add(ip_address, count)
+        self.assertEqual(sketch.total, sum(counts.values()))
+        for ip_address, count in counts.items():
+            self.assertGreaterEqual(sketch.estimate(ip_address), count)
+        self.assertEqual(
+            sum(count for _, _, count in sketch.cells()), sketch.total * sketch.depth
+        )
+
+        wide = CountMinSketch()
+        for ip_address, count in counts.items():
+            self.assertEqual(wide.add(ip_address, count), count)
+        self.assertEqual(wide.estimate("198.51.100.1"), 0)
+
+    def test_top_k_eviction(self):
+        top = TopK(k=3)
+        for item, estimate in [("a", 5), ("b", 1), ("c", 3)]:
+            top.offer(item, estimate)
+        top.offer("d", 1)  # Not above the smallest estimate
+        self.assertEqual(top.most_common(), [("a", 5), ("c", 3), ("b", 1)])
+
+        top.offer("e", 2)  # Evicts b
+        self.assertEqual(top.most_common(), [("a", 5), ("c", 3), ("e", 2)])
+
+        # A stale heap entry of e is skipped; c is the smallest now
+        top.offer("e", 4)
+        top.offer("f", 6)
+        self.assertEqual(top.most_common(), [("f", 6), ("a", 5), ("e", 4)])
+
+        for estimate in range(7, 30):
+            top.offer("a", estimate)
+        self.assertLessEqual(len(top.heap), 4 * top.k)
+        self.assertEqual(top.most_common()[0], ("a", 29))
+
+    @mock.patch("ip_tracking.heavy_hitters.get_redis")
+    def test_track_does_no_io(self, get_redis):
+        tracker = HeavyHitterTracker(k=2)
+        with mock.patch.object(tracker, "_ensure_merger") as ensure_merger:
+            for ip_address in ["192.0.2.1"] * 3 + ["192.0.2.2", "192.0.2.3"]:
+                tracker.track(ip_address)
+            async_to_sync(tracker.atrack)("192.0.2.1")
+        get_redis.assert_not_called()
+        self.assertEqual(ensure_merger.call_count, 6)
+        self.assertEqual(tracker.stats()["local_total"], 6)
+
+        # The merge adds every cell and scores the local top-K with the
+        # cluster-wide estimates HINCRBY returned
+        client = get_redis.return_value
+        pipeline = client.pipeline.return_value
+
+        def execute():
+            # Other workers counted nine times as much
+            return [10 * call.args[2] for call in pipeline.hincrby.call_args_list] + [
+                True
+            ]
+
+        pipeline.execute.side_effect = execute
+        tracker.merge()
+        self.assertEqual(tracker.stats()["merges"], 1)
+        self.assertEqual(tracker.stats()["local_total"], 0)
+        scores = pipeline.zadd.call_args.args[1]
+        self.assertEqual(scores["192.0.2.1"], 40)
+        self.assertEqual(len(scores), 2)
+
+
+def create_logs(ip_address, path, count, age=timedelta(minutes=5)):
+    """Bulk create count request logs for one IP and path"""
+    timestamp = timezone.now() - age
+    RequestLog.objects.bulk_create(
+        RequestLog(ip_address=ip_address, path=path, timestamp=timestamp)
+        for _ in range(count)
+    )
+
+
+class DetectAnomaliesTests(TestCase):
+    """Single-pass detection keeps the rule order and dedupe behavior"""
+
+    def setUp(self):
+        create_logs("198.51.100.1", "/", 101)  # High volume
+        create_logs("198.51.100.2", "/admin/users", 21)  # Sensitive path
+        create_logs("198.51.100.3", "/login", 22)  # Sensitive '/login' only
+        create_logs("198.51.100.4", "/login", 11)  # Brute force only
+        create_logs("198.51.100.5", "/login", 101)  # High volume + brute force
+        create_logs("198.51.100.6", "/", 200, age=timedelta(hours=2))  # Too old
+        create_logs("198.51.100.7", "/api/items", 21)
+        create_logs("198.51.100.7", "/register", 21)  # First prefix wins
+        create_logs("198.51.100.8", "/", 150)  # Already blocked
+        BlockedIP.objects.create(ip_address="198.51.100.8")
+
+    def flags(self):
+        return sorted(
+            (flag.ip_address, flag.reason.split(":")[0])
+            for flag in SuspiciousIP.objects.all()
+        )
+
+    expected_flags = [
+        ("198.51.100.1", "High request volume"),
+        ("198.51.100.2", "Excessive access to sensitive path '/admin'"),
+        ("198.51.100.3", "Excessive access to sensitive path '/login'"),
+        ("198.51.100.4", "Possible brute force attack"),
+        ("198.51.100.5", "High request volume"),
+        ("198.51.100.5", "Possible brute force attack"),
+        ("198.51.100.7", "Excessive access to sensitive path '/register'"),
+    ]
+
+    def test_rules_and_dedupe(self):
+        result = detect_anomalies()
+
+        self.assertEqual(result["flagged_count"], 7)
+        self.assertEqual(self.flags(), self.expected_flags)
+
+    def test_shards_match_single_run(self):
+        ranges = get_shard_ranges(3, timezone.now() - timedelta(hours=1))
+        self.assertEqual(len(ranges), 3)
+        self.assertEqual((ranges[0][0], ranges[-1][1]), (None, None))
+
+        result = merge_detection_results(
+            [detect_anomalies_shard(lower, upper) for lower, upper in ranges]
+        )
+        self.assertEqual(result["flagged_count"], 7)
+        self.assertEqual(self.flags(), self.expected_flags)
+
+    def test_shard_ranges_sample_latest_requests(self):
+        create_logs("198.51.100.9", "/", 10)
+        since = timezone.now() - timedelta(hours=1)
+        self.assertEqual(
+            get_shard_ranges(2, since, sample_size=10),
+            [(None, "198.51.100.9"), ("198.51.100.9", None)],
+        )
+        self.assertEqual(get_shard_ranges(2, timezone.now()), [(None, None)])
+
+    def test_recent_flags_are_not_repeated(self):
+        detect_anomalies()
+        self.assertEqual(detect_anomalies()["flagged_count"], 0)
+
+    def test_counts_match_per_rule_queries(self):
+        since = timezone.now() - timedelta(hours=1)
+        counts = {item["ip_address"]: item for item in get_anomaly_counts()}
+        recent = RequestLog.objects.filter(timestamp__gte=since)
+
+        def group_counts(queryset, threshold):
+            return {
+                item["ip_address"]: item["request_count"]
+                for item in queryset.values("ip_address")
+                .annotate(request_count=Count("id"))
+                .filter(request_count__gt=threshold)
+            }
+
+        expected = {"high_volume": group_counts(recent, 100)}
+        for prefix in SENSITIVE_PATHS:
+            expected[f"sensitive_{prefix.strip('/')}"] = group_counts(
+                recent.filter(path__startswith=prefix), 20
+            )
+        expected["brute_force"] = group_counts(recent.filter(path="/login"), 10)
+
+        for name, rule_counts in expected.items():
+            for ip_address, request_count in rule_counts.items():
+                self.assertEqual(counts[ip_address][name], request_count)
+        self.assertEqual(
+            set(counts), set().union(*(set(value) for value in expected.values()))
+        )
+
+
+class RollupTests(TestCase):
+    """Rollup counters are flushed, restored and read like RequestLog"""
+
+    def setUp(self):
+        patcher = mock.patch("ip_tracking.rollups.get_redis")
+        self.redis = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.pipeline = self.redis.pipeline.return_value
+        self.tracker = RollupTracker()
+
+    def test_track(self):
+        timestamp = timezone.now()
+        bucket = get_bucket(timestamp)
+        self.assertTrue(self.tracker.track("192.0.2.1", "/login", timestamp))
+        self.assertEqual(
+            [call.args for call in self.pipeline.hincrby.call_args_list],
+            [
+                (f"{ROLLUP_KEY_PREFIX}requests:{bucket}", "192.0.2.1", 1),
+                (f"{ROLLUP_KEY_PREFIX}paths:{bucket}", "192.0.2.1 /login", 1),
+                (f"{ROLLUP_KEY_PREFIX}paths:{bucket}", "192.0.2.1 /login$", 1),
+            ],
+        )
+
+        self.pipeline.execute.side_effect = redis.ConnectionError("down")
+        self.assertFalse(self.tracker.track("192.0.2.1", "/", timestamp))
+        self.assertEqual((self.tracker.tracked, self.tracker.errors), (1, 1))
+
+    def test_flush_adds_to_existing_rows(self):
+        self.redis.zrangebyscore.return_value = ["120"]
+        self.pipeline.execute.return_value = [
+            {"192.0.2.1": "3", "192.0.2.2": "1"},
+            {"192.0.2.1 /login": "2"},
+            2,
+            1,
+        ]
+        self.assertEqual(self.tracker.flush(), 1)
+        self.assertEqual(self.tracker.flush(), 1)
+
+        bucket = bucket_start(120)
+        self.assertEqual(
+            dict(
+                RequestRollup.objects.filter(bucket=bucket).values_list(
+                    "ip_address", "count"
+                )
+            ),
+            {"192.0.2.1": 6, "192.0.2.2": 2},
+        )
+        self.assertEqual(
+            list(PathRollup.objects.values_list("path_prefix", "count")),
+            [("/login", 4)],
+        )
+
+    def test_failed_flush_restores_counters(self):
+        self.redis.zrangebyscore.return_value = ["120", "180"]
+        self.pipeline.execute.return_value = [
+            {"192.0.2.1": "3"},
+            {"192.0.2.1 /login": "2"},
+            2,
+            1,
+        ]
+        with mock.patch(
+            "ip_tracking.rollups.store_rollups", side_effect=DatabaseError("down")
+        ) as store:
+            self.assertEqual(self.tracker.flush(), 0)
+        # The next buckets wait for the next flush
+        store.assert_called_once()
+
+        self.assertEqual(
+            [call.args for call in self.pipeline.hincrby.call_args_list],
+            [
+                (f"{ROLLUP_KEY_PREFIX}requests:120", "192.0.2.1", "3"),
+                (f"{ROLLUP_KEY_PREFIX}paths:120", "192.0.2.1 /login", "2"),
+            ],
+        )
+        self.pipeline.zadd.assert_called_once_with(ROLLUP_BUCKETS_KEY, {120: 120})
+        self.assertFalse(RequestRollup.objects.exists())
+
+    def store_logs_as_rollups(self):
+        """Replay the request logs through the tracker into the rollup tables"""
+        pipeline = mock.Mock()
+        for ip_address, path, timestamp in RequestLog.objects.values_list(
+            "ip_address", "path", "timestamp"
+        ):
+            self.tracker.queue_increments(pipeline, ip_address, path, timestamp)
+
+        counters = defaultdict(lambda: defaultdict(int))
+        for key, field, count in (
+            call.args for call in pipeline.hincrby.call_args_list
+        ):
+            counters[key][field] += count
+        for bucket in {int(key.rsplit(":", 1)[1]) for key in counters}:
+            store_rollups(
+                bucket,
+                counters[f"{ROLLUP_KEY_PREFIX}requests:{bucket}"],
+                counters[f"{ROLLUP_KEY_PREFIX}paths:{bucket}"],
+            )
+
+    def test_rollup_aggregate_matches_request_logs(self):
+        create_logs("198.51.100.1", "/", 101)  # Volume only...
+        create_logs("198.51.100.1", "/login", 5)  # ...counted by both passes
+        create_logs("198.51.100.2", "/admin/users", 21)  # Path rule only
+        create_logs("198.51.100.2", "/", 30)
+        create_logs("198.51.100.3", "/login", 11)  # Brute force and /login
+        create_logs("198.51.100.4", "/api/items", 21)
+        create_logs("198.51.100.5", "/", 10)  # Below every threshold
+        create_logs("198.51.100.6", "/", 200, age=timedelta(hours=2))  # Too old
+        self.store_logs_as_rollups()
+
+        def counts(rollups):
+            with self.settings(IP_TRACKING_ROLLUPS_ENABLED=rollups):
+                return sorted(
+                    get_detection_plan().aggregate(),
+                    key=lambda item: item["ip_address"],
+                )
+
+        expected = counts(rollups=False)
+        self.assertEqual(
+            [item["ip_address"] for item in expected],
+            ["198.51.100.1", "198.51.100.2", "198.51.100.3", "198.51.100.4"],
+        )
+        self.assertEqual(counts(rollups=True), expected)
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    IP_TRACKING_ANOMALY_RULES=[
+        {"name": "volume", "threshold": 50},
+        {
+            "name": "api_burst",
+            "path_prefix": "/api",
+            "window": 600,
+            "threshold": 5,
+            "action": "block",
+            "reason": "API burst: {count} requests",
+        },
+        {"name": "logins", "path": "/login", "threshold": 3, "dedupe_reason": "login"},
+    ],
+)
+class AnomalyRuleTests(TestCase):
+    """Configured anomaly rules are compiled into one aggregate"""
+
+    def setUp(self):
+        create_logs("198.51.100.1", "/api/items", 6)  # Burst within 10 minutes
+        create_logs("198.51.100.2", "/api/items", 6, age=timedelta(minutes=20))
+        create_logs("198.51.100.3", "/login", 4)
+        create_logs("198.51.100.4", "/", 51)
+
+    def test_one_query_for_all_rules(self):
+        with self.assertNumQueries(1):
+            counts = get_anomaly_counts()
+        self.assertEqual(
+            {item["ip_address"]: item["api_burst"] for item in counts},
+            {"198.51.100.1": 6, "198.51.100.3": 0, "198.51.100.4": 0},
+        )
+
+    def test_actions(self):
+        result = detect_anomalies()
+
+        self.assertEqual(result["flagged_count"], 3)
+        self.assertEqual(result["blocked_count"], 1)
+        self.assertEqual(
+            list(BlockedIP.objects.values_list("ip_address", "reason")),
+            [("198.51.100.1", "Automatically blocked: API burst: 6 requests")],
+        )
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class DetectionQueryCountTests(TestCase):
+    """The detection tasks issue the same queries for any number of IPs"""
+
+    def flag(self, ip_address, count=3):
+        SuspiciousIP.objects.bulk_create(
+            SuspiciousIP(ip_address=ip_address, reason="High request volume")
+            for _ in range(count)
+        )
+
+    def test_detect_anomalies_query_count(self):
+        for candidates in (2, 20):
+            SuspiciousIP.objects.all().delete()
+            RequestLog.objects.all().delete()
+            for i in range(candidates):
+                create_logs(f"203.0.113.{i}", "/login", 101)
+            # One aggregate, recent flags, blocked IPs and one bulk insert
+            with self.assertNumQueries(4):
+                result = detect_anomalies()
+            self.assertEqual(result["flagged_count"], candidates * 2)
+
+    def test_auto_block_query_count(self):
+        for candidates in (2, 20):
+            SuspiciousIP.objects.all().delete()
+            BlockedIP.objects.all().delete()
+            for i in range(candidates):
+                self.flag(f"203.0.113.{i}")
+            # Candidates, existing blocks, then resolve and insert inside a
+            # savepoint (a transaction outside of tests)
+            with self.assertNumQueries(6):
+                self.assertEqual(auto_block_suspicious_ips(), candidates)
+            self.assertFalse(SuspiciousIP.objects.filter(is_resolved=False).exists())
+
+    def test_batch_loads_candidates_only(self):
+        BlockedIP.objects.create(ip_address="203.0.113.1")
+        BlockedIP.objects.create(ip_address="198.51.100.1")
+        self.flag("203.0.113.2", count=1)
+        self.flag("198.51.100.2", count=1)
+
+        batch = SuspiciousIPBatch(["203.0.113.1", "203.0.113.2", "203.0.113.3"])
+        self.assertEqual(batch.blocked, {"203.0.113.1"})
+        self.assertEqual(list(batch.recent_reasons), ["203.0.113.2"])
+        self.assertFalse(batch.add("203.0.113.2", "High request volume", 101))
+        self.assertTrue(batch.add("203.0.113.3", "High request volume", 101))
+
+        # Flags and blocks are read IN_CHUNK_SIZE candidates at a time
+        candidates = [f"10.0.{i // 256}.{i % 256}" for i in range(IN_CHUNK_SIZE + 1)]
+        with self.assertNumQueries(4):
+            SuspiciousIPBatch(candidates)
+
+    def test_block_ips_in_chunks(self):
+        ip_addresses = [f"10.0.{i // 256}.{i % 256}" for i in range(IN_CHUNK_SIZE * 2)]
+        for ip_address in ip_addresses[:3]:
+            self.flag(ip_address, count=1)
+        with CaptureQueriesContext(connection) as queries:
+            blocked = block_ips({ip_address: "Blocked" for ip_address in ip_addresses})
+        self.assertEqual(blocked, ip_addresses)
+        self.assertEqual(BlockedIP.objects.count(), IN_CHUNK_SIZE * 2)
+        self.assertFalse(SuspiciousIP.objects.filter(is_resolved=False).exists())
+        lookups = [q for q in queries if q["sql"].startswith("SELECT")]
+        self.assertEqual(len(lookups), 2)
+
+    def test_auto_block_reactivates_inactive_blocks(self):
+        self.flag("203.0.113.1")
+        self.flag("203.0.113.2")
+        self.flag("203.0.113.3")
+        BlockedIP.objects.create(ip_address="203.0.113.1", is_active=False)
+        BlockedIP.objects.create(ip_address="203.0.113.2", is_active=True)
+
+        self.assertEqual(auto_block_suspicious_ips(), 2)
+        self.assertEqual(BlockedIP.objects.filter(is_active=True).count(), 3)
+        # Flags of the IP that was already blocked stay untouched
+        self.assertEqual(
+            set(
+                SuspiciousIP.objects.filter(is_resolved=False).values_list(
+                    "ip_address", flat=True
+                )
+            ),
+            {"203.0.113.2"},
+        )
+
+
+@override_settings(CACHES=LOCMEM_CACHES, IP_TRACKING_INCREMENTAL_DETECTION=True)
+class IncrementalDetectionTests(TestCase):
+    """Incremental detection only reads request logs above the watermark"""
+
+    def test_counts_accumulate_across_runs(self):
+        create_logs("198.51.100.1", "/login", 6)
+        create_logs("198.51.100.2", "/", 5, age=timedelta(hours=2))  # Too old
+        self.assertEqual(detect_anomalies_incremental()["flagged_count"], 0)
+
+        create_logs("198.51.100.1", "/login", 6)
+        result = detect_anomalies_incremental()
+
+        self.assertEqual(result["flagged_count"], 1)
+        self.assertEqual(
+            SuspiciousIP.objects.get().reason,
+            "Possible brute force attack: 12 login attempts in the last hour",
+        )
+        self.assertFalse(
+            DetectionCounter.objects.filter(ip_address="198.51.100.2").exists()
+        )
+        self.assertIsNone(detect_anomalies())
+
+    def test_query_count_does_not_depend_on_window(self):
+        create_logs("198.51.100.1", "/", 50)
+        detect_anomalies_incremental()
+        with CaptureQueriesContext(connection) as first:
+            create_logs("198.51.100.3", "/", 1)
+            detect_anomalies_incremental()
+
+        create_logs("198.51.100.2", "/", 500)
+        detect_anomalies_incremental()
+        with CaptureQueriesContext(connection) as second:
+            create_logs("198.51.100.3", "/", 1)
+            detect_anomalies_incremental()
+        self.assertEqual(len(first), len(second))
+
+    def counted(self, ip_address):
+        """Requests of an IP in the high_volume detection counters"""
+        return DetectionCounter.objects.filter(
+            ip_address=ip_address, rule="high_volume"
+        ).aggregate(total=Sum("count"))["total"]
+
+    def test_gap_filled_after_a_run(self):
+        create_logs("198.51.100.1", "/", 5)
+        ids = list(RequestLog.objects.order_by("id").values_list("id", flat=True))
+        # Ids still held by open transactions when the run starts
+        late = list(RequestLog.objects.filter(id__in=ids[2:4]).order_by("id"))
+        RequestLog.objects.filter(id__in=ids[2:4]).delete()
+        detector = IncrementalDetector()
+        detector.run()
+        self.assertEqual(self.counted("198.51.100.1"), 3)
+        self.assertEqual(
+            [gap[:2] for gap in DetectionState.objects.get().gaps],
+            [[ids[2], ids[3]]],
+        )
+
+        # One commits now, new rows arrive; nothing is counted twice
+        late[0].save(force_insert=True)
+        create_logs("198.51.100.1", "/", 1)
+        detector.run()
+        self.assertEqual(self.counted("198.51.100.1"), 5)
+        self.assertEqual(
+            [gap[:2] for gap in DetectionState.objects.get().gaps],
+            [[ids[3], ids[3]]],
+        )
+        self.assertEqual(detector.run(), [])
+        self.assertEqual(self.counted("198.51.100.1"), 5)
+
+        # The other one is given up on once it is too old
+        late[1].save(force_insert=True)
+        detector.run(now=timezone.now() + timedelta(seconds=detector.gap_timeout + 1))
+        self.assertEqual(self.counted("198.51.100.1"), 5)
+        self.assertEqual(DetectionState.objects.get().gaps, [])
+
+    def test_split_gaps(self):
+        self.assertEqual(
+            split_gaps([[1, 5, 0], [8, 8, 1], [10, 11, 2]], [1, 3, 8, 11]),
+            [[2, 2, 0], [4, 5, 0], [10, 10, 2]],
+        )
+
+
+class StatisticalBaselineTests(TestCase):
+    """Spikes against an IP's own baseline are flagged, steady traffic is not"""
+
+    def test_spike_and_steady_traffic(self):
+        end = timezone.now().replace(minute=0, second=0, microsecond=0)
+        for hours_ago in range(1, 26):
+            age = timezone.now() - end + timedelta(hours=hours_ago, minutes=-30)
+            create_logs("198.51.100.1", "/", 100, age=age)  # Busy NAT
+            create_logs("198.51.100.2", "/", 200 if hours_ago == 1 else 5, age=age)
+
+        traffic = TrafficMatrix.load()
+        outliers = StatisticalBaseline().outliers(traffic)
+
+        self.assertEqual(len(traffic.ip_addresses), 2)
+        self.assertEqual(
+            [(ip, feature, kind, count) for ip, feature, kind, _, count in outliers],
+            [("198.51.100.2", "requests", "spike", 200)],
+        )
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    IP_TRACKING_SUBNET_DETECTION=True,
+    IP_TRACKING_SUBNET_AUTO_BLOCK=True,
+)
+class SubnetDetectionTests(TestCase):
+    """Subnets are flagged once their IPs together exceed the threshold"""
+
+    def setUp(self):
+        for i in range(10):
+            create_logs(f"203.0.113.{i + 1}", "/", 60)  # Rotating scraper
+            create_logs(f"2001:db8:0:1::{i + 1:x}", "/", 60)
+        create_logs("198.51.100.1", "/", 99)  # Busy, but a single IP
+        create_logs("198.51.100.2", "/", 1)
+
+    def test_flag_and_block_subnets(self):
+        self.assertEqual(detect_anomalies()["flagged_count"], 0)
+        self.assertEqual(detect_subnet_anomalies()["flagged_count"], 2)
+        self.assertEqual(detect_subnet_anomalies()["flagged_count"], 0)
+        self.assertEqual(
+            sorted(flag.network for flag in SuspiciousIP.objects.all()),
+            ["2001:db8:0:1::/64", "203.0.113.0/24"],
+        )
+
+        self.assertEqual(auto_block_suspicious_ips(), 2)
+        self.assertEqual(
+            sorted(BlockedNetwork.objects.values_list("network", flat=True)),
+            ["2001:db8:0:1::/64", "203.0.113.0/24"],
+        )
+        self.assertFalse(BlockedIP.objects.exists())
+        self.assertFalse(SuspiciousIP.objects.filter(is_resolved=False).exists())
+
+    def test_ipv4_masked_in_query(self):
+        now = timezone.now()
+        aggregator = SubnetAggregator(threshold=500)
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                list(aggregator.ipv4_subnet_counts(now)),
+                [("203.0.113.0", 600, 10)],
+            )
+        # Only the IPv6 addresses are counted per IP
+        self.assertEqual(
+            sorted(ip_address for ip_address, _ in aggregator.per_ip_counts(now)),
+            sorted(f"2001:db8:0:1::{i + 1:x}" for i in range(10)),
+        )
+
+        wide = SubnetAggregator(ipv4_prefix=16, threshold=500)
+        self.assertEqual(list(wide.ipv4_subnet_counts(now)), [("203.0.0.0", 600, 10)])
+        self.assertEqual(
+            sorted(subnet["network"] for subnet in wide.aggregate(now)),
+            ["2001:db8:0:1::/64", "203.0.0.0/16"],
+        )
+
+        # Prefixes off an octet boundary are masked in Python
+        odd = SubnetAggregator(ipv4_prefix=20, min_ips=1, threshold=98)
+        self.assertEqual(
+            sorted(subnet["network"] for subnet in odd.aggregate(now)),
+            ["198.51.96.0/20", "2001:db8:0:1::/64", "203.0.112.0/20"],
+        )
+
+    def test_rows_masked_in_python_are_capped(self):
+        capped = SubnetAggregator(max_rows=4)
+        self.assertEqual(len(list(capped.per_ip_counts(timezone.now()))), 4)
+        self.assertEqual(
+            [subnet["network"] for subnet in capped.aggregate()], ["203.0.113.0/24"]
+        )
+
+
+class DistinctPathTests(TestCase):
+    """Candidate promotion, per-window expiry and detect_path_scanners"""
+
+    @mock.patch("ip_tracking.distinct_paths.get_redis")
+    def test_candidates_above_threshold(self, get_redis):
+        tracker = DistinctPathTracker(threshold=10)
+        pipeline = get_redis.return_value.pipeline.return_value
+        pipeline.execute.side_effect = [
+            [1, True, 10],  # The threshold itself is not enough
+            [0, True, 11],  # A path seen before adds nothing
+            [1, True, 11],
+            [1, True],
+        ]
+        with mock.patch.object(tracker, "current_window", return_value=100):
+            for path in ["/a", "/a", "/b"]:
+                tracker.track("192.0.2.1", path)
+
+        pipeline.zadd.assert_called_once_with(
+            tracker.candidates_key(100), {"192.0.2.1": 11}, gt=True
+        )
+        # The HyperLogLog of a window expires when the next window starts
+        pipeline.expireat.assert_called_with(
+            tracker.sketch_key("192.0.2.1", 100), 101 * 3600
+        )
+        pipeline.expire.assert_called_once_with(tracker.candidates_key(100), 7200)
+        self.assertEqual(tracker.stats()["tracked"], 3)
+        self.assertEqual(tracker.stats()["candidates_added"], 1)
+
+        pipeline.execute.side_effect = redis.ConnectionError("down")
+        tracker.track("192.0.2.1", "/c")
+        self.assertEqual(tracker.stats()["errors"], 1)
+
+    @mock.patch("ip_tracking.distinct_paths.get_redis")
+    def test_candidates_of_both_windows(self, get_redis):
+        tracker = DistinctPathTracker(threshold=10)
+        pipeline = get_redis.return_value.pipeline.return_value
+        pipeline.execute.return_value = [
+            [("192.0.2.1", 15.0), ("192.0.2.2", 12.0)],
+            [("192.0.2.2", 11.0), ("192.0.2.3", 30.0)],
+        ]
+        with mock.patch.object(tracker, "current_window", return_value=100):
+            found = tracker.candidates()
+
+        # The highest count of an IP over both windows
+        self.assertEqual(
+            found, [("192.0.2.3", 30), ("192.0.2.1", 15), ("192.0.2.2", 12)]
+        )
+        self.assertEqual(
+            [call.args[0] for call in pipeline.zrange.call_args_list],
+            [tracker.candidates_key(99), tracker.candidates_key(100)],
+        )
+        pipeline.pfcount.assert_not_called()
+
+    @override_settings(IP_TRACKING_DISTINCT_PATHS_ENABLED=True)
+    @mock.patch("ip_tracking.tasks.get_distinct_path_tracker")
+    def test_detect_path_scanners(self, get_tracker):
+        tracker = get_tracker.return_value
+        tracker.window = 3600
+        tracker.candidates.return_value = [("192.0.2.1", 250)]
+
+        self.assertEqual(detect_path_scanners()["flagged_count"], 1)
+        self.assertEqual(detect_path_scanners()["flagged_count"], 0)
+        flag = SuspiciousIP.objects.get()
+        self.assertEqual(flag.ip_address, "192.0.2.1")
+        self.assertTrue(flag.reason.startswith("Possible vulnerability scan"))
+
+        tracker.candidates.side_effect = redis.ConnectionError("down")
+        self.assertIsNone(detect_path_scanners())
+        with self.settings(IP_TRACKING_DISTINCT_PATHS_ENABLED=False):
+            self.assertIsNone(detect_path_scanners())
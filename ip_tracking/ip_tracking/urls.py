@@ -8,4 +8,6 @@ urlpatterns = [
     path("dashboard/", views.dashboard, name="dashboard"),
     path("api/", views.api_endpoint, name="api_endpoint"),
     path("api/key/", views.api_with_key, name="api_with_key"),
+    path("metrics/", views.metrics, name="metrics"),
+    path("metrics/top-talkers/", views.top_talkers, name="top_talkers"),
 ]
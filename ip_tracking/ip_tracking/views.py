@@ -1,10 +1,19 @@
+import redis
 from django.shortcuts import render, redirect
 from django.contrib.auth import authenticate, login as auth_login, logout as auth_logout
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.http import JsonResponse
 from django.views.decorators.http import require_http_methods
 from django_ratelimit.decorators import ratelimit
 from .models import RequestLog
+from .sinks import get_log_sink
+from .geolocation import get_geolocation_stats
+from .blocklist import get_blocklist_snapshot
+from .rollups import get_rollup_tracker, use_rollups
+from .realtime import get_realtime_detector, use_realtime_detection
+from .heavy_hitters import get_heavy_hitter_tracker, use_heavy_hitters
+from .distinct_paths import get_distinct_path_tracker, use_distinct_paths
 
 
 # pylint: disable=no-member
@@ -95,10 +104,69 @@ def dashboard(request):
         "user": request.user,
         "recent_logs": recent_logs,
         "client_ip": client_ip,
+        "top_talkers": get_top_talkers(limit=10) if request.user.is_staff else [],
     }
     return render(request, "ip_tracking/dashboard.html", context)
 
 
+@staff_member_required
+@require_http_methods(["GET"])
+def metrics(request):
+    """
+    Internal IP tracking metrics (staff only).
+    """
+    data = {
+        "log_sink": get_log_sink().stats(),
+        "geolocation": get_geolocation_stats(),
+        "blocklist": get_blocklist_snapshot().stats(),
+    }
+    if use_rollups():
+        data["rollups"] = get_rollup_tracker().stats()
+    if use_realtime_detection():
+        data["realtime_detection"] = get_realtime_detector().stats()
+    if use_heavy_hitters():
+        data["heavy_hitters"] = get_heavy_hitter_tracker().stats()
+    if use_distinct_paths():
+        data["distinct_paths"] = get_distinct_path_tracker().stats()
+    return JsonResponse(data)
+
+
+@staff_member_required
+@require_http_methods(["GET"])
+def top_talkers(request):
+    """
+    Approximate top talkers of the current window (staff only).
+    Accepts ?limit= (default 20) and ?windows=2 to add the previous window.
+    """
+    try:
+        limit = min(int(request.GET.get("limit", 20)), 1000)
+        windows = 2 if request.GET.get("windows") == "2" else 1
+    except ValueError:
+        return JsonResponse({"error": "limit must be an integer"}, status=400)
+
+    if not use_heavy_hitters():
+        return JsonResponse({"enabled": False, "top_talkers": []})
+    return JsonResponse(
+        {
+            "enabled": True,
+            "top_talkers": [
+                {"ip_address": ip_address, "requests": estimate}
+                for ip_address, estimate in get_top_talkers(limit, windows)
+            ],
+        }
+    )
+
+
+def get_top_talkers(limit, windows=1):
+    """Top talkers from the heavy-hitter tracker, empty if unavailable"""
+    if not use_heavy_hitters():
+        return []
+    try:
+        return get_heavy_hitter_tracker().top_talkers(limit, windows)
+    except redis.RedisError:
+        return []
+
+
 @login_required
 def logout_view(request):
     """